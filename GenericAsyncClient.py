@@ -0,0 +1,246 @@
+#python GenericAsyncClient.py
+import asyncio
+import time
+import functools
+import traceback
+import sys
+import argparse
+sys.path.append('../')
+from pyserver.GenericServer import *
+
+#always flush output by default
+print = functools.partial(print, flush=True)
+
+#asyncio version of GenericClient: no threads, each client is a task on one event loop, so one process can run lots of them
+#same wire format as GenericClient, so it talks to any GenericHeader server (GenericServer, UnoServer...)
+#use it with GenericHeader like GenericClient, eg class Bot(GenericHeader, GenericAsyncClient)
+#HOW IT WORKS:
+# await client.connect() opens the connection and starts a reader task that calls parse_message on each message
+#  handlers (@header_code) run there, on the loop, so they must not block
+# send_message is not a coroutine: it writes into the connection's buffer, so handlers can send too
+#  await client.drain() waits for the buffer to go out if you send a lot
+# messages that no handler took come out of `async for header, msg in client`
+# request=True returns an asyncio Future for the server's reply (see GenericHeader REQUESTS)
+# await client.wait_for(predicate) waits until predicate() is true, it's checked after each received message
+# a frame over max_frame_size, or a message a handler fails on, closes the connection (pending requests fail)
+class GenericAsyncClient(GenericServer):
+    max_frame_size = MAX_FRAME_SIZE
+
+    def __init__(self, host, port, debug=False, log=None, max_frame_size=None):
+        self.host = host
+        self.port = port
+        self.debug = debug
+        #dprint + message logging, see GenericServer LOGGING
+        self.log = Log(enabled=debug) if log is None else log
+        self.max_data_size = 2048
+        if max_frame_size is not None:
+            self.max_frame_size = max_frame_size
+        self.running = False
+        self.dprint("In async client class")
+        #asyncio streams, set by connect
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        #save time of last message sent, can be used to debug / check progress
+        self.last_send = time.time()
+        self.metrics = Metrics()
+        #last metrics_snapshot from the server, see request_metrics
+        self.server_metrics = None
+        #REQUESTS: rid -> Future of requests we haven't got the reply to
+        self.requests = {}
+        self.next_rid = 0
+        #(header, msg) of messages no handler took, None once the connection is closed
+        self.messages = asyncio.Queue()
+        #set (and replaced by a new one) after each received message, see wait_for
+        self.received = asyncio.Event()
+
+    #fcn to connect to the server and start reading, raises OSError if the server can't be reached
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        set_nodelay(self.writer.get_extra_info('socket'))
+        self.running = True
+        self.reader_task = asyncio.create_task(self.read_messages())
+
+    #reader task, parses messages until the connection closes
+    async def read_messages(self):
+        prefix = FrameReader.prefix
+        log = self.log
+        try:
+            while self.running:
+                size = prefix.unpack(await self.reader.readexactly(prefix.size))[0]
+                if size > self.max_frame_size:
+                    #the length is the peer's word, same as FrameReader
+                    raise ProtocolError("frame of {}B, max_frame_size is {}B".format(size, self.max_frame_size))
+                data = await self.reader.readexactly(size)
+                if log.enabled and log.keep('recv'):
+                    log.record('recv', data=data)
+                self.handle_message(data)
+                self.notify_received()
+        except (asyncio.IncompleteReadError, OSError):
+            self.dprint("connection closed by server.")
+        except Exception:
+            #a frame we won't take or a message a handler fails on: can't tell what the server meant any more
+            traceback.print_exc()
+            self.log.log('handler_error')
+        finally:
+            self.writer.close()
+            self.connection_closed()
+
+    #fcn called by the reader task with each received message
+    def handle_message(self, data):
+        self.count_in(data)
+        self.parse_message(data)
+
+    #default: handlers take what they have a code for, the rest goes to the message iterator
+    def parse_message(self, data):
+        decoded, header, msg = self.decode(data)
+        if not decoded:
+            self.messages.put_nowait((header, msg))
+
+    #fcn to wake up everything in wait_for
+    def notify_received(self):
+        received = self.received
+        self.received = asyncio.Event()
+        received.set()
+
+    #fcn to wake up everyone waiting on the server, nothing more is coming
+    def connection_closed(self):
+        if not self.running and self.reader_task is None:
+            return
+        self.running = False
+        self.reader_task = None
+        requests = list(self.requests.values())
+        self.requests.clear()
+        for future in requests:
+            if not future.done():
+                future.set_exception(ConnectionError("connection to server closed"))
+        self.messages.put_nowait(None)
+        self.notify_received()
+
+    #fcn to wait until predicate() is true, eg await client.wait_for(client.my_turn)
+    #returns the last value of predicate(), so a false value on timeout or once the connection closed
+    async def wait_for(self, predicate, timeout=None):
+        async def wait():
+            while not predicate() and self.running:
+                await self.received.wait()
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return predicate()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.messages.get()
+        if item is None:
+            #leave it for any other iterator
+            self.messages.put_nowait(None)
+            raise StopAsyncIteration
+        return item
+
+    #fcn to send data to server, returns right away (see drain)
+    #request=True returns an asyncio Future that completes with (header, data) of the server's reply,
+    #after the reply went through parse_message. None if the server sent nothing back, see GenericHeader REQUESTS
+    def send_message(self, msg, request=False, **kwargs):
+        future = None
+        if request:
+            future = asyncio.get_running_loop().create_future()
+            rid = self.next_rid
+            self.next_rid = (rid + 1) % 2**32
+            self.requests[rid] = future
+            kwargs['rid'] = rid
+        frame = self.encode_parts(msg, **kwargs)
+        self.last_send = time.time()
+        self.writer.writelines(frame)
+        self.metrics.message_out(kwargs.get('header'), sum(map(len, frame)))
+        return future
+
+    #fcn to wait until the server has taken what was sent (or the buffer is small enough again)
+    async def drain(self):
+        await self.writer.drain()
+
+    #fcn to complete the Future of request rid with the server's reply
+    def complete_request(self, rid, reply):
+        future = self.requests.pop(rid, None)
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    #fcn to ask a GenericHeader server for its metrics_snapshot, it ends up in self.server_metrics
+    def request_metrics(self):
+        return GenericAsyncClient.send_message(self, "", header=METRICS_CODE, request=True)
+
+    #fcn to answer a GenericHeader server's heartbeat, so it doesn't drop us as idle (see GenericServer IDLE CONNECTIONS)
+    def send_heartbeat(self):
+        GenericAsyncClient.send_message(self, "", header=HEARTBEAT_CODE)
+
+    #fcn to get what a GenericHeader server publishes on topic from now on (see GenericServer TOPICS), returns the request's Future
+    def subscribe(self, topic):
+        return GenericAsyncClient.send_message(self, topic, header=SUBSCRIBE_CODE, request=True)
+
+    def unsubscribe(self, topic):
+        return GenericAsyncClient.send_message(self, topic, header=UNSUBSCRIBE_CODE, request=True)
+
+    #fcn to close connection, can be called multiple times without error
+    async def end(self):
+        self.dprint("end client:")
+        reader_task = self.reader_task
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if reader_task is not None:
+            reader_task.cancel()
+            try:
+                await reader_task
+            except asyncio.CancelledError:
+                pass
+        self.connection_closed()
+        self.dprint("done.")
+
+#example of how to use the async client with header, talks to ExampleServerWithHeader like ExampleClientWithHeader
+class ExampleAsyncClientWithHeader(GenericHeader, GenericAsyncClient):
+    def __init__(self, host, port, debug=True):
+        super().__init__(host, port, debug)
+        self.tid = None
+        self.set_header()
+
+    @header_code(1)
+    def set_tid(self, data):
+        #recieve header=1 from server
+        self.tid = int(data.decode('utf-8'))
+        self.dprint("my tid is ", self.tid)
+
+    def send_message(self, hdr, msg, request=False):
+        self.dprint("sending message:", msg, "with header: ", hdr)
+        return super().send_message(msg, header=hdr, request=request)
+
+#one session: get our tid, ask for the server's test state
+async def run_example_client(host, port, debug):
+    client = ExampleAsyncClientWithHeader(host, port, debug=debug)
+    await client.connect()
+    await client.send_message(1, "Sent a tidreq msg", request=True)
+    await client.send_message(101, "Test, requesting your state", request=True)
+    print("C{} has state vars: {}, {}, {}".format(client.tid, client.test_var_int, client.test_var_arr, client.test_var_str))
+    await client.end()
+    return client.tid
+
+async def run_example_clients(host, port, num_clients, debug):
+    tids = await asyncio.gather(*[run_example_client(host, port, debug) for i in range(num_clients)])
+    print("{} clients done, tids {}".format(num_clients, sorted(tids)))
+
+#test out the async client, many sessions on one loop (run GenericServer.py first)
+def main():
+    parser = argparse.ArgumentParser(description="example async clients, many sessions on one loop")
+    parser.add_argument('--clients', type=int, default=5)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1020)
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    asyncio.run(run_example_clients(args.host, args.port, args.clients, debug=args.debug))
+
+if __name__ == "__main__":
+    main()
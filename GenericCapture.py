@@ -0,0 +1,123 @@
+import time
+import mmap
+import struct
+from threading import Lock
+
+#Capture: records what a server gets and sends, to replay it later against a server (see replay.py)
+#HOW IT WORKS:
+# server(capture=Capture(path)) writes a record for: a client connecting, each message it handles (as handle_message gets it,
+#  without the length prefix), each frame it queues for a client (as it goes on the wire, length prefix included), a client going
+# records are [8B seconds since run()][1B kind][4B tid][4B size][data], after a header with the server's framing
+#  (so replay knows how to send messages + read replies) and seed, whatever the server's random was seeded with (-1 if unknown)
+#  give it when the game state depends on random (eg UnoServer decks): random.seed(seed) before making the server,
+#  and replay.py seeds the server it replays against the same way
+# records go through a big write buffer under a lock, so a record costs about two memcpys while the server runs
+CAPTURE_MAGIC = b'PYSCAP01'
+CAPTURE_CONNECT = 0
+CAPTURE_RECV = 1
+CAPTURE_SEND = 2
+CAPTURE_DISCONNECT = 3
+CAPTURE_KINDS = {CAPTURE_CONNECT: 'connect', CAPTURE_RECV: 'recv', CAPTURE_SEND: 'send', CAPTURE_DISCONNECT: 'disconnect'}
+
+#magic, start time (time.time()), framed, header_size, seed
+capture_header = struct.Struct("!8sdBBq")
+#time, kind, tid, size
+capture_record = struct.Struct("!dBII")
+
+class Capture:
+    def __init__(self, path, seed=None, buffer_size=1 << 20):
+        self.path = path
+        self.seed = seed
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.lock = Lock()
+        self.start_time = None
+        self.closed = False
+
+    #fcn to write the header, called by server.run() (after set_header, so header_size is known)
+    def start(self, server):
+        with self.lock:
+            if self.start_time is not None:
+                return
+            #GenericHeader servers frame messages, base servers take whatever recv returns
+            framed = hasattr(server, 'header_size')
+            header_size = server.header_size if framed else 0
+            self.file.write(capture_header.pack(CAPTURE_MAGIC, time.time(), framed, header_size, -1 if self.seed is None else self.seed))
+            self.start_time = time.perf_counter()
+
+    def connect(self, tid):
+        self.record(CAPTURE_CONNECT, tid)
+
+    #fcn to record a message the server got from tid, data is bytes or a view of them
+    def recv(self, tid, data):
+        self.record(CAPTURE_RECV, tid, data)
+
+    def disconnect(self, tid):
+        self.record(CAPTURE_DISCONNECT, tid)
+
+    #fcn to write one record
+    def record(self, kind, tid, data=b''):
+        with self.lock:
+            if self.closed or self.start_time is None:
+                return
+            self.file.write(capture_record.pack(time.perf_counter() - self.start_time, kind, tid, len(data)))
+            self.file.write(data)
+
+    #fcn to record a frame queued for tid (tuple of bytes, see encode_parts)
+    def send(self, tid, frame):
+        with self.lock:
+            if self.closed or self.start_time is None:
+                return
+            self.file.write(capture_record.pack(time.perf_counter() - self.start_time, CAPTURE_SEND, tid, sum(map(len, frame))))
+            for part in frame:
+                self.file.write(part)
+
+    #fcn to write out the buffer, can be called multiple times without error
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.close()
+
+#reads a capture file through mmap, records come out as (time, kind, tid, data) with data a memoryview into the file
+#(so only valid until close)
+#a record cut short (server killed while capturing) ends it
+class CaptureReader:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        magic, self.start_time, framed, self.header_size, seed = capture_header.unpack_from(self.mm, 0)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        self.framed = bool(framed)
+        self.seed = None if seed == -1 else seed
+
+    def __iter__(self):
+        offset = capture_header.size
+        size = len(self.mm)
+        while offset + capture_record.size <= size:
+            t, kind, tid, length = capture_record.unpack_from(self.mm, offset)
+            offset += capture_record.size
+            if offset + length > size:
+                break
+            yield t, kind, tid, self.view[offset:offset + length]
+            offset += length
+
+    #fcn to count records (+ their bytes) by kind, and the time they cover
+    def summary(self):
+        counts = {name: 0 for name in CAPTURE_KINDS.values()}
+        sizes = {name: 0 for name in CAPTURE_KINDS.values()}
+        duration = 0
+        for t, kind, tid, data in self:
+            name = CAPTURE_KINDS[kind]
+            counts[name] += 1
+            sizes[name] += len(data)
+            duration = t
+        return {'records': sum(counts.values()), 'counts': counts, 'bytes': sizes, 'duration': duration,
+                'framed': self.framed, 'header_size': self.header_size, 'seed': self.seed}
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+        self.file.close()
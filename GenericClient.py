@@ -1,9 +1,12 @@
 import socket
 import os
-from threading import Thread
+from threading import Thread, Lock, Condition
+from concurrent.futures import Future
 import atexit
 import time
 import functools
+import traceback
+import argparse
 import sys
 sys.path.append('../')
 from pyserver.GenericServer import *
@@ -14,11 +17,14 @@ print = functools.partial(print, flush=True)
 
 #Generic client class, it's similar to GenericServer but now only spawns 1 thread (for receiving)
 class GenericClient(GenericServer):
-    def __init__(self, host, port, debug=False):
+    def __init__(self, host, port, debug=False, log=None):
         self.host = host
         self.port = port
         self.debug = debug
+        #dprint + message logging, see GenericServer LOGGING
+        self.log = Log(enabled=debug) if log is None else log
         #This should be good for most (all?) applications
+        #(with GenericHeader framing this is only the starting size of the receive buffer)
         self.max_data_size = 2048
         
         self.running = True
@@ -27,12 +33,24 @@ class GenericClient(GenericServer):
         atexit.register(self.close_connection, self.client_socket)
         try:
             self.client_socket.connect((host,port))
+            set_nodelay(self.client_socket)
         except socket.error as e:
             self.dprint("Error contacting server: ", str(e))
             exit()
         self.receiver_thread = Thread(target=self.thread_for_client)
         #save time of last message sent, can be used to debug / check progress
         self.last_send = time.time()
+        self.metrics = Metrics()
+        #last metrics_snapshot from the server, see request_metrics
+        self.server_metrics = None
+        #REQUESTS (GenericHeader only): rid -> Future of requests we haven't got the reply to
+        self.requests = {}
+        self.next_rid = 0
+        self.request_lock = Lock()
+        #handlers can send from the receiver thread too (eg heartbeats), so frames from two threads don't get mixed
+        self.send_lock = Lock()
+        #notified after each received message, see wait_for
+        self.received = Condition()
 
     #start client
     def run(self):
@@ -42,35 +60,111 @@ class GenericClient(GenericServer):
         self.dprint("initialised child thread")
         atexit.register(self.close_connection, self.client_socket)
         
+        reader = self.new_reader()
+        log = self.log
         #Parse messages in loop
         while self.running:
             try:
-                data = self.client_socket.recv(self.max_data_size)
+                messages = reader.recv_messages(self.client_socket)
             except:
                 self.dprint("connection dropped.")
-                exit()
+                break
+            if messages is None:
+                self.dprint("connection closed by server.")
+                break
+
             try:
-                msg =  data.decode('utf-8')
-                self.dprint("RECV: ", msg)
-            except:
-                self.dprint("RECV: data can't be converted to utf8")
-            
-            self.parse_message(data)
+                for data in messages:
+                    if log.enabled and log.keep('recv'):
+                        #data is a view into the receive buffer, copy it for the writer thread
+                        log.record('recv', data=bytes(data))
+                    self.handle_message(data)
+            except Exception:
+                #can't tell what the server meant any more (eg a ProtocolError), drop the connection so nobody waits on it forever
+                traceback.print_exc()
+                self.log.log('handler_error')
+                break
+            with self.received:
+                self.received.notify_all()
 
+        self.connection_closed()
         self.close_connection(self.client_socket)
 
+    #fcn called by the read loop with each received message
+    def handle_message(self, data):
+        self.count_in(data)
+        self.parse_message(data)
+
+    #fcn to wake up everyone waiting on the server, nothing more is coming
+    def connection_closed(self):
+        self.running = False
+        with self.request_lock:
+            requests = list(self.requests.values())
+            self.requests.clear()
+        for future in requests:
+            future.set_exception(ConnectionError("connection to server closed"))
+        with self.received:
+            self.received.notify_all()
+
+    #fcn to block until predicate() is true, it's checked after each received message. eg client.wait_for(client.my_turn)
+    #returns the last value of predicate(), so a false value on timeout or once the connection closed
+    def wait_for(self, predicate, timeout=None):
+        with self.received:
+            self.received.wait_for(lambda: predicate() or not self.running, timeout)
+        return predicate()
+
     #fcn to send data to server
-    def send_message(self, msg, **kwargs):
+    #request=True (GenericHeader only) returns a Future that completes with (header, data) of the server's reply,
+    #after the reply went through parse_message. None if the server sent nothing back, see GenericHeader REQUESTS
+    def send_message(self, msg, request=False, **kwargs):
         #self.dprint("msg: ", msg, "kwargs", kwargs)
-        self.client_socket.sendall(self.encode(msg, **kwargs))
+        future = None
+        if request:
+            future = Future()
+            with self.request_lock:
+                rid = self.next_rid
+                self.next_rid = (rid + 1) % 2**32
+                self.requests[rid] = future
+            kwargs['rid'] = rid
+        buffers = list(self.encode_parts(msg, **kwargs))
+        size = sum(map(len, buffers))
+        #before sending, so a reply can't arrive before it
         self.last_send = time.time()
+        with self.send_lock:
+            while buffers:
+                buffers = skip_sent(buffers, send_some(self.client_socket, buffers))
+        self.metrics.message_out(kwargs.get('header'), size)
+        return future
+
+    #fcn to complete the Future of request rid with the server's reply
+    def complete_request(self, rid, reply):
+        with self.request_lock:
+            future = self.requests.pop(rid, None)
+        if future is not None:
+            future.set_result(reply)
+
+    #fcn to ask a GenericHeader server for its metrics_snapshot, it ends up in self.server_metrics
+    def request_metrics(self):
+        GenericClient.send_message(self, "", header=METRICS_CODE)
+
+    #fcn to answer a GenericHeader server's heartbeat, so it doesn't drop us as idle (see GenericServer IDLE CONNECTIONS)
+    def send_heartbeat(self):
+        GenericClient.send_message(self, "", header=HEARTBEAT_CODE)
+
+    #fcn to get what a GenericHeader server publishes on topic from now on (see GenericServer TOPICS), returns the request's Future
+    def subscribe(self, topic):
+        return GenericClient.send_message(self, topic, header=SUBSCRIBE_CODE, request=True)
+
+    def unsubscribe(self, topic):
+        return GenericClient.send_message(self, topic, header=UNSUBSCRIBE_CODE, request=True)
 
     #fcn to close connection, can be called multiple times without error
     def end(self):
         self.dprint("end client:")
-        self.running = False
         self.close_connection(self.client_socket)
+        self.connection_closed()
         self.dprint("done.")
+        self.log.flush()
 
 #example of how to use client with ExampleClient + main below
 class ExampleClient(GenericClient):
@@ -108,8 +202,9 @@ class ExampleClientWithHeader(GenericHeader, GenericClient):
     def __init__(self, host, port, debug=True):
         super().__init__(host, port, debug)
         self.tid = None
-        self.set_header(codes=[1], fcns=[self.set_tid])
+        self.set_header()
 
+    @header_code(1)
     def set_tid(self, data):
         #recieve header=1 from server
         self.tid = int(data.decode('utf-8')) 
@@ -123,20 +218,22 @@ class ExampleClientWithHeader(GenericHeader, GenericClient):
 
         self.dprint("got header:msg", header, msg)
 
-    def send_message(self, hdr, msg, wait_before_sending=0):
+    def send_message(self, hdr, msg, wait_before_sending=0, request=False):
         time.sleep(wait_before_sending)
         self.dprint("sending message:", msg, "with header: ", hdr)
-        super().send_message(msg, header=hdr)
+        return super().send_message(msg, header=hdr, request=request)
   
 #test out the client class
 def main():
-    #TODO make these cmd line args
-    run_example = False
-    run_example_with_header = True 
-    host = '127.0.0.1'
-    port = 1020
+    parser = argparse.ArgumentParser(description="example client, run GenericServer.py first")
+    parser.add_argument('--example', choices=['plain', 'header'], default='header', help="ExampleClient or ExampleClientWithHeader")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1020)
+    args = parser.parse_args()
+    host = args.host
+    port = args.port
 
-    if run_example:
+    if args.example == 'plain':
         print("creating client")
         client = ExampleClient(host, port, debug=True)    
         client.run()    
@@ -161,12 +258,12 @@ def main():
 
         print("C{} ended.".format(tid))
         client.end()
-    elif run_example_with_header:
+    else:
         print("creating client")
         client = ExampleClientWithHeader(host, port, debug=True)    
         client.run()    
-        client.send_message(1, "Sent a tidreq msg")
-        time.sleep(1)
+        #wait for the reply instead of sleeping
+        client.send_message(1, "Sent a tidreq msg", request=True).result(5)
         tid = client.tid 
         #tid 0 send to all, tid 1 send to 0, tid 2 send to 1
         #now, bc is 2, sent to x is 3+x
@@ -180,8 +277,7 @@ def main():
             print("t2 send")
             client.send_message(4, "This should be C 2->1", wait_before_sending=1)
 
-        client.send_message(101, "Test, requesting your state", wait_before_sending=1)
-        time.sleep(2)
+        client.send_message(101, "Test, requesting your state", wait_before_sending=1, request=True).result(5)
         print("Checking if client has correct state vars: {}, {}, {}".format(client.test_var_int, client.test_var_arr, client.test_var_str ))
         #if > 4, theres a mistake somewhere, just abort
         if tid == 0 or tid > 4:
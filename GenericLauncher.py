@@ -0,0 +1,149 @@
+#python GenericLauncher.py
+import sys
+import argparse
+import socket
+import multiprocessing
+from threading import Thread, current_thread
+sys.path.append('../')
+from pyserver.GenericServer import *
+
+#Launcher that runs one server per process, all on the same host/port, so a server can use more than one core
+#HOW IT WORKS:
+# a GenericServer (accept loop, client threads and parse_message) runs on one core because of the GIL
+# the launcher starts num_workers processes and each one runs its own server_class(max_connections, host, port, **kwargs)
+# with SO_REUSEPORT (linux/bsd) each worker binds its own socket and the kernel spreads new connections over the workers
+#  without it (reuse_port=False) the launcher listens once and all workers accept on that shared socket
+# tids are per worker: send_message only reaches clients of the same worker, and so does any state kept in the server object
+# broadcast_message reaches the clients of every worker through a BroadcastChannel (broadcast=True)
+# target(server, stop) runs in each worker after server.run() (default: wait for stop), the worker ends its server after it returns
+class GenericLauncher:
+    def __init__(self, server_class, num_workers, max_connections, host, port, broadcast=True, reuse_port=None, target=None, **kwargs):
+        self.server_class = server_class
+        self.num_workers = num_workers
+        self.max_connections = max_connections
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+        self.target = target
+        #use SO_REUSEPORT when the OS has it
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT') if reuse_port is None else reuse_port
+        #fork where we can, workers then don't have to import the server's module again
+        if 'fork' in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context('fork')
+        else:
+            self.context = multiprocessing.get_context('spawn')
+        self.channel = BroadcastChannel(num_workers, self.context) if broadcast else None
+        self.stop = self.context.Event()
+        self.processes = []
+        #only used without reuse_port
+        self.server_socket = None
+
+    #start worker processes
+    def run(self):
+        if not self.reuse_port:
+            self.server_socket = socket.socket()
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(max(self.max_connections, socket.SOMAXCONN))
+        for worker_id in range(self.num_workers):
+            kwargs = dict(self.kwargs)
+            if self.reuse_port:
+                kwargs['reuse_port'] = True
+            else:
+                kwargs['server_socket'] = self.server_socket
+            process = self.context.Process(target=run_worker, daemon=True,
+                args=(worker_id, self.server_class, (self.max_connections, self.host, self.port), kwargs, self.channel, self.stop, self.target))
+            self.processes.append(process)
+            process.start()
+
+    #fcn to wait for the workers to finish (eg target returned in all of them)
+    def wait(self, timeout=None):
+        for process in self.processes:
+            process.join(timeout)
+
+    #fcn to stop all workers, can be called multiple times without error
+    def end(self, timeout=5):
+        self.stop.set()
+        self.wait(timeout)
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout)
+        if self.server_socket is not None:
+            self.server_socket.close()
+
+#fcn that runs in each worker process
+def run_worker(worker_id, server_class, args, kwargs, channel, stop, target):
+    if channel is not None:
+        channel.worker_id = worker_id
+    server = server_class(*args, channel=channel, **kwargs)
+    server.run()
+    try:
+        if target is None:
+            stop.wait()
+        else:
+            target(server, stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.end()
+
+#sends broadcast frames (already encoded, see GenericServer.send_frame) between the launcher's workers
+#each worker has a queue the others put frames in, and a thread that sends what arrives to its own clients
+class BroadcastChannel:
+    def __init__(self, num_workers, context=multiprocessing):
+        self.queues = [context.Queue() for i in range(num_workers)]
+        #set in the worker process
+        self.worker_id = None
+        self.thread = None
+
+    #fcn to start sending other workers' broadcasts to server's clients
+    def listen(self, server):
+        for queue in self.queues:
+            #don't hang on exit when a worker stopped reading
+            queue.cancel_join_thread()
+        self.thread = Thread(target=self.thread_for_channel, args=(server,), daemon=True)
+        self.thread.start()
+
+    def thread_for_channel(self, server):
+        queue = self.queues[self.worker_id]
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            frame, key = item
+            server.send_frame(frame, server.client_tids(), key=key)
+
+    #fcn to send frame to the clients of every other worker
+    def publish(self, frame, key=None):
+        for worker_id, queue in enumerate(self.queues):
+            if worker_id != self.worker_id:
+                queue.put((frame, key))
+
+    #fcn to stop the channel thread, before the worker exits and its queues get closed
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queues[self.worker_id].put(None)
+            if self.thread is not current_thread():
+                self.thread.join(1)
+
+
+#main, script to test
+def main():
+    parser = argparse.ArgumentParser(description="example server, one process per worker on a shared port")
+    parser.add_argument('--workers', type=int, default=4, help="server processes")
+    parser.add_argument('--connections', type=int, default=5, help="max connections per worker")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1020)
+    args = parser.parse_args()
+
+    print("starting {} server processes".format(args.workers))
+    launcher = GenericLauncher(ExampleServerWithHeader, args.workers, args.connections, args.host, args.port, debug=True)
+    launcher.run()
+    try:
+        launcher.wait()
+    except KeyboardInterrupt:
+        pass
+    launcher.end()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#python GenericLog.py
+import sys
+import time
+import json
+import atexit
+from collections import deque
+from threading import Thread, Condition
+
+#Log: structured logging for servers/clients (self.log, dprint goes through it). While it's off a call site costs one check
+#HOW IT WORKS:
+# a record is an event name + args + named fields, eg log.log('recv', tid=3, data=b'...')
+# the caller never formats anything: records go in a ring buffer (size records, when it's full the oldest is dropped)
+#  and a background writer thread formats and writes them in batches, so logging doesn't slow the receive loop down
+# sample={'recv': 100} keeps 1 in every 100 'recv' records, so busy events can stay on in production
+# when building a record costs something (eg copying a buffer), check before building it:
+#   if log.enabled and log.keep('recv'):
+#       log.record('recv', tid=tid, data=bytes(data))
+# fmt='text' writes "time event args key=value ...", fmt='json' writes one json object per line
+# the writer thread is only started once the log is enabled
+class Log:
+    def __init__(self, enabled=False, out=None, size=10000, sample=None, fmt='text'):
+        #None: sys.stdout (looked up when writing)
+        self.out = out
+        self.size = size
+        #event -> keep 1 in n
+        self.sample = dict(sample or {})
+        self.fmt = fmt
+        self.counts = {}
+        #(time, event, args, fields)
+        self.records = deque()
+        self.cond = Condition()
+        #records thrown away because the buffer was full
+        self.dropped = 0
+        self.dropped_written = 0
+        #writer has taken records out of the buffer and not written them yet (see flush)
+        self.writing = False
+        self.thread = None
+        self.enabled = False
+        if enabled:
+            self.enable()
+
+    #fcn to turn logging on, sample updates the sampling rates
+    def enable(self, sample=None):
+        if sample is not None:
+            self.sample.update(sample)
+        if self.thread is None:
+            self.thread = Thread(target=self.thread_for_writer, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    #True if the next record of event should be logged (log is on + sampling)
+    def keep(self, event):
+        if not self.enabled:
+            return False
+        every = self.sample.get(event)
+        if every is None:
+            return True
+        n = self.counts.get(event, 0)
+        self.counts[event] = n + 1
+        return n % every == 0
+
+    #fcn to log a record of event, if keep(event)
+    def log(self, event, *args, **fields):
+        if self.keep(event):
+            self.record(event, *args, **fields)
+
+    #fcn to log a record without checking keep (call sites that checked it already)
+    def record(self, event, *args, **fields):
+        record = (time.time(), event, args, fields)
+        with self.cond:
+            if len(self.records) >= self.size:
+                self.records.popleft()
+                self.dropped += 1
+            self.records.append(record)
+            if len(self.records) == 1:
+                #writer may be waiting for records
+                self.cond.notify_all()
+
+    #fcn to wait (up to timeout) until everything logged so far is written
+    def flush(self, timeout=1):
+        if self.thread is None:
+            return
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.records) == 0 and not self.writing, timeout)
+
+    def thread_for_writer(self):
+        while True:
+            with self.cond:
+                while len(self.records) == 0:
+                    self.cond.wait()
+                records = self.records
+                self.records = deque()
+                dropped = self.dropped
+                self.writing = True
+            lines = [self.format_record(record) for record in records]
+            if dropped != self.dropped_written:
+                lines.append(self.format_record((time.time(), 'log_dropped', (), {'records': dropped - self.dropped_written})))
+                self.dropped_written = dropped
+            out = self.out if self.out is not None else sys.stdout
+            try:
+                out.write('\n'.join(lines) + '\n')
+                out.flush()
+            except (OSError, ValueError):
+                #stream closed (eg at exit)
+                pass
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+    #fcn to turn a record into one line, runs on the writer thread. Can be overridden
+    def format_record(self, record):
+        t, event, args, fields = record
+        if self.fmt == 'json':
+            obj = {'time': t, 'event': event}
+            if args:
+                obj['args'] = [format_value(arg) for arg in args]
+            for key, value in fields.items():
+                obj[key] = format_value(value)
+            return json.dumps(obj, default=str)
+        parts = ["{:.6f}".format(t), event]
+        parts.extend(str(format_value(arg)) for arg in args)
+        parts.extend("{}={}".format(key, format_value(value)) for key, value in fields.items())
+        return ' '.join(parts)
+
+#fcn to make a value printable: bytes as utf8 text when they are, otherwise as repr (messages can be pickles/structs)
+def format_value(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        try:
+            return str(value, 'utf-8')
+        except UnicodeDecodeError:
+            return repr(bytes(value))
+    return value
+
+
+#main, script to test
+def main():
+    log = Log(enabled=True, sample={'recv': 3})
+    for i in range(10):
+        log.log('recv', tid=i % 2, data="msg {}".format(i).encode())
+    log.log('debug', "hello", 1, [2])
+    log.log('send', tid=0, data=b'\x80\x04binary')
+    log.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,24 @@
 import socket
-from threading import Thread
+import selectors
+from threading import Thread, Lock, Condition, current_thread, local
 import atexit
 import time
 import pickle
+import struct
+from collections import deque
 import functools
+import traceback
+import argparse
+import sys
+sys.path.append('../')
+from pyserver.GenericLog import *
+from pyserver.GenericCapture import *
 #always flush output by default, useful in testing
 print = functools.partial(print, flush=True)
 
+#biggest message a GenericHeader server/client takes by default, a peer that sends a bigger one is disconnected (see FrameReader)
+MAX_FRAME_SIZE = 1 << 22
+
 #Server class that connects via sockets to multiple parties, using 1 thread per client + 1 thread for server/recieving
 #Generic interface to be inherited by other applications, typically overwrite parse_msg function
 #HOW IT WORKS:
@@ -16,45 +28,155 @@ print = functools.partial(print, flush=True)
 # If you (server) wants to send a message,
 #  use broadcast(msg) to send to all 
 #  or send_to(tid, msg) to send to single thread/client
+#  or publish(topic, msg) to send to the clients subscribed to topic (see TOPICS)
+# Sends don't block: the message goes in the client's outbound queue (max queue_size msgs) and a writer thread per client sends it
+#  everything queued by the time the writer gets to it goes out in one sendmsg (writev), frames are never joined (see send_some)
+#  slow_policy says what to do with a client whose queue is full: 'drop_oldest', 'coalesce' (replace an older msg with the same header) or 'disconnect'
 # Optionally run end before exiting. This should be taken care of by atexit handler though
+#EVENT LOOP MODE (event_loop=True):
+# instead of 1 thread per client (+1 writer), a single thread runs a selector over every socket
+# parse_message/send_message/broadcast_message work the same, so subclasses don't need changes
+# outbound queues are written out by the loop when the socket is writable
+#CLIENT SLOTS: the arrays below are indexed by tid. When a client goes (EOF, error or disconnect_client) its slot is
+# torn down once (remove_client), on_disconnect(tid) is called and the tid goes on a free list for a later client,
+# so the arrays stay as big as the most clients connected at once. live_tids has the tids that are connected now
+#MULTI PROCESS: one server only uses one core (GIL), GenericLauncher runs a server per process on the same port
+#IDLE CONNECTIONS: a dead client (eg half open TCP) never sends EOF, so its slot would stay forever and get every broadcast
+# heartbeat=n: clients that sent nothing for n seconds get a HEARTBEAT_CODE message (GenericHeader servers), clients answer it
+# idle_timeout=n: clients that sent nothing for n seconds are disconnected (default 3 heartbeats when heartbeat is set)
+# any message counts, so busy clients are never pinged. The read loops only note the time of each recv,
+#  the checks are in one TimerWheel (one thread, or the event loop) instead of a timer per connection
+#TOPICS: topic (any hashable, str for topics clients pick) -> set of subscribed tids, each client's topics are kept by tid
+# so they are dropped when it goes. subscribe/unsubscribe(tid, topic) on the server, or clients send SUBSCRIBE_CODE /
+# UNSUBSCRIBE_CODE (GenericHeader servers, overwrite subscribe to check what a client may subscribe to)
+# publish(topic, msg) encodes msg once and queues the same bytes for each subscriber, so it costs the same however many
+# other clients there are. Topics are per server process (broadcasts go to other processes through a channel, publishes don't)
+#CAPTURE: capture=Capture(path) records every connect, message received, frame sent and disconnect to a file,
+# replay.py plays it back against a server (see GenericCapture)
+#LOGGING: dprint and per message records ('recv', 'send', 'connect', 'disconnect') go through self.log (see GenericLog)
+# with logging off nothing is formatted or decoded, with it on a background thread writes them (sample busy events)
+#METRICS: self.metrics counts messages + bytes in/out per header code, handler times, accepts. metrics_snapshot() has
+# all of it + connections and queue depths (GenericHeader servers also send it to clients that ask with METRICS_CODE)
 class GenericServer:
-    def __init__(self, max_connections, host, port, debug=False):
+    #GenericHeader framing only, max_frame_size=n sets it per server
+    max_frame_size = MAX_FRAME_SIZE
+
+    def __init__(self, max_connections, host, port, debug=False, event_loop=False, queue_size=256, slow_policy='disconnect',
+                 reuse_port=False, server_socket=None, channel=None, log=None, heartbeat=None, idle_timeout=None, capture=None,
+                 max_frame_size=None):
         self.max_connections = max_connections
         self.host = host
         self.port = port
         self.debug = debug
+        #dprint + message logging (see GenericLog), can be shared by several servers/clients. On when debug is
+        self.log = Log(enabled=debug) if log is None else log
+        #records traffic for replay (see GenericCapture), None if off
+        self.capture = capture
         #This should be good for most (all?) applications
+        #(with GenericHeader framing this is only the starting size of the receive buffer)
         self.max_data_size = 2048
+        if max_frame_size is not None:
+            self.max_frame_size = max_frame_size
         #array for each client thread
         self.threads = []
         #boolean array for each client thread (running/not running)
         self.thread_status = []
         #array for each socket connection
         self.connections = []
+        #array of outbound queues for each client, and what to do when one is full
+        self.out_queues = []
+        #tids of connected clients, and tids of gone clients to reuse (oldest first)
+        self.live_tids = set()
+        self.free_tids = deque()
+        self.clients_lock = Lock()
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        #IDLE CONNECTIONS: time.monotonic() of the last recv from each client
+        self.last_active = []
+        if heartbeat is not None and idle_timeout is None:
+            idle_timeout = 3*heartbeat
+        if heartbeat is not None and heartbeat >= idle_timeout:
+            raise ValueError("heartbeat ({}) has to be shorter than idle_timeout ({})".format(heartbeat, idle_timeout))
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        #TOPICS: topic -> set of tids, and each client's set of topics by tid (None if it has none)
+        self.topics = {}
+        self.client_topics = []
+        self.topics_lock = Lock()
+        #clients disconnected for being idle
+        self.idle_dropped = 0
+        self.idle_wheel = None
+        if idle_timeout is not None:
+            #a check runs at most a quarter of the shortest wait late
+            tick = (heartbeat or idle_timeout) / 4
+            self.idle_wheel = TimerWheel(tick, int(idle_timeout / tick) + 2)
         self.running = True
         self.dprint("In server class")
-        self.server_socket = socket.socket()
+        #MULTI PROCESS (see GenericLauncher): reuse_port lets several servers listen on the same host/port,
+        #server_socket is an already listening socket to accept on instead (eg one shared by forked processes)
+        self.reuse_port = reuse_port
+        self.listening = server_socket is not None
+        self.server_socket = socket.socket() if server_socket is None else server_socket
+        #channel also sends broadcasts to clients of the other processes
+        self.channel = channel
         atexit.register(self.close_connection, self.server_socket)
-        self.server_thread = Thread(target=self.thread_for_server)
+        self.event_loop = event_loop
+        if event_loop:
+            #array of message readers for each client (only used by event loop)
+            self.readers = []
+            #array of partly sent data for each client (only used by event loop)
+            self.partials = []
+            #tids with data queued from other threads, loop picks them up after a wakeup
+            self.pending_writes = set()
+            #tids to flush once the loop has handled everything select() returned, so msgs of one tick go out together
+            self.loop_writes = set()
+            self.send_lock = Lock()
+            self.selector = selectors.DefaultSelector()
+            #writing a byte to wakeup_send breaks the loop out of select()
+            self.wakeup_recv, self.wakeup_send = socket.socketpair()
+            atexit.register(self.close_connection, self.wakeup_send)
+            atexit.register(self.close_connection, self.wakeup_recv)
+            self.server_thread = Thread(target=self.event_loop_for_server)
+        else:
+            #array of writer threads for each client
+            self.writers = []
+            self.server_thread = Thread(target=self.thread_for_server)
+            if self.idle_wheel is not None:
+                self.idle_thread = Thread(target=self.thread_for_idle, daemon=True)
         #save time of last message sent, can be used to debug / check progress of server
         self.last_send = 0
+        self.metrics = Metrics()
 
     #start server
     def run(self):
+        if self.capture is not None:
+            self.capture.start(self)
+        if self.channel is not None:
+            self.channel.listen(self)
         self.server_thread.start()
+        if self.idle_wheel is not None and not self.event_loop:
+            self.idle_thread.start()
+
+    #fcn to bind + listen on host/port, unless we were given a listening socket
+    def listen(self, backlog):
+        if self.listening:
+            return
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(backlog)
+        self.listening = True
         
     #fcn to handle creating client threads
     def thread_for_server(self):
         self.dprint("run...")
         try:
-            self.server_socket.bind((self.host, self.port))
+            self.listen(self.max_connections)
         except socket.error as e:
             self.dprint("Error in binding: ", str(e))
             exit()
 
         self.dprint("Established socket, waiting for connection...")
-        self.server_socket.listen(self.max_connections)
-        tid = 0
         while self.running:
             self.dprint("waiting for accept..")
             try:
@@ -64,64 +186,541 @@ class GenericServer:
                 self.dprint("exception: ", e)
                 continue
             self.dprint("SERVER CONNECT TO ", client)
+            set_nodelay(client)
+            tid = self.new_tid()
             client_thread = Thread(target=self.thread_for_client, args=(client, tid), daemon=True)
-            self.threads.append(client_thread)
-            self.thread_status.append(True)
-            self.connections.append(client)
-            tid +=1 
+            writer_thread = Thread(target=self.thread_for_writer, args=(client, tid), daemon=True)
+            self.threads[tid] = client_thread
+            self.writers[tid] = writer_thread
+            self.add_client(client, tid)
             client_thread.start()
+            writer_thread.start()
             
     #fcn to handle reading messages in thread
+    #the slot is torn down when this thread stops, so only this thread frees tid
     def thread_for_client(self, connection, tid):
         self.dprint("initialised child thread")
-        atexit.register(self.close_connection, connection)
         
+        reader = self.new_reader()
+        log = self.log
+        capture = self.capture
         #Parse messages in loop
-        while self.thread_status[tid]:
+        try:
+            while self.thread_status[tid]:
+                try:
+                    messages = reader.recv_messages(connection)
+                except:
+                    self.dprint("connection dropped.")
+                    break
+                if messages is None:
+                    self.dprint("connection closed by client.")
+                    break
+
+                self.last_active[tid] = time.monotonic()
+                for data in messages:
+                    if log.enabled and log.keep('recv'):
+                        #data is a view into the receive buffer, copy it for the writer thread
+                        log.record('recv', tid=tid, data=bytes(data))
+                    if capture is not None:
+                        capture.recv(tid, data)
+                    try:
+                        self.handle_message(data, tid)
+                    except ProtocolError as e:
+                        self.dprint("protocol error: ", e)
+                        self.log.log('protocol_error', tid=tid)
+                        return
+                    except Exception:
+                        #same as the event loop: the client whose message a handler fails on is dropped
+                        traceback.print_exc()
+                        self.log.log('handler_error', tid=tid)
+                        return
+        finally:
+            self.remove_client(tid)
+
+    #fcn to send queued messages to one client in its own thread, so a slow client only holds up itself
+    def thread_for_writer(self, connection, tid):
+        queue = self.out_queues[tid]
+        while True:
+            frames = queue.get_all()
+            if frames is None:
+                break
+            buffers = [part for frame in frames for part in frame]
             try:
-                data = connection.recv(self.max_data_size)
+                while buffers:
+                    buffers = skip_sent(buffers, send_some(connection, buffers))
             except:
                 self.dprint("connection dropped.")
-                exit()
-            
+                #wake the reader up, it tears the slot down (tid may already be someone else's, so only use our own objects)
+                queue.close()
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
+
+    #fcn to run the idle checks (thread per client mode)
+    def thread_for_idle(self):
+        while self.running:
+            time.sleep(self.idle_wheel.tick)
+            self.check_idle(time.monotonic())
+
+    #fcn to handle every client from one thread (event_loop=True)
+    def event_loop_for_server(self):
+        self.dprint("run event loop...")
+        try:
+            #this mode is meant for lots of clients, so don't let a small backlog drop connects
+            self.listen(max(self.max_connections, socket.SOMAXCONN))
+        except socket.error as e:
+            self.dprint("Error in binding: ", str(e))
+            exit()
+
+        self.dprint("Established socket, waiting for connection...")
+        self.server_socket.setblocking(False)
+        self.wakeup_recv.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        #wake up every tick for the idle checks
+        timeout = self.idle_wheel.tick if self.idle_wheel is not None else None
+        while self.running:
             try:
-                msg =  data.decode('utf-8')
-                self.dprint("RECV: ", msg)
-            except:
-                self.dprint("RECV: data can't be converted to utf8")
+                events = self.selector.select(timeout)
+            except Exception as e:
+                self.dprint("Error in select. Server possibly ended?")
+                self.dprint("exception: ", e)
+                break
+            for key, mask in events:
+                if key.fileobj is self.server_socket:
+                    self.accept_client()
+                elif key.fileobj is self.wakeup_recv:
+                    self.handle_wakeup()
+                else:
+                    tid = key.data
+                    if self.connections[tid] is not key.fileobj:
+                        #dropped earlier in this tick (and maybe its tid reused already)
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.read_client(key.fileobj, tid)
+                    if mask & selectors.EVENT_WRITE and self.thread_status[tid]:
+                        self.loop_writes.add(tid)
+            if self.idle_wheel is not None:
+                self.check_idle(time.monotonic())
+            self.flush_loop_writes()
+        self.selector.close()
+
+    #fcn to accept all waiting connections (event loop)
+    def accept_client(self):
+        while True:
+            try:
+                client, addr = self.server_socket.accept()
+            except BlockingIOError:
+                return
+            except Exception as e:
+                self.dprint("Error in accept. Server possibly ended?")
+                self.dprint("exception: ", e)
+                return
+            self.dprint("SERVER CONNECT TO ", client)
+            set_nodelay(client)
+            client.setblocking(False)
+            tid = self.new_tid()
+            #no thread per client in this mode
+            self.partials[tid] = None
+            self.readers[tid] = self.new_reader()
+            self.add_client(client, tid)
+            self.selector.register(client, selectors.EVENT_READ, tid)
+
+    #fcn to get a tid for a new client: the oldest free one, or a new slot at the end of the arrays
+    def new_tid(self):
+        with self.clients_lock:
+            if self.free_tids:
+                return self.free_tids.popleft()
+            tid = len(self.connections)
+            self.threads.append(None)
+            self.thread_status.append(False)
+            self.out_queues.append(None)
+            self.connections.append(None)
+            self.last_active.append(0)
+            self.client_topics.append(None)
+            if self.event_loop:
+                self.partials.append(None)
+                self.readers.append(None)
+            else:
+                self.writers.append(None)
+        return tid
+
+    #fcn to put a new client's connection in slot tid, it's live from here on
+    def add_client(self, client, tid):
+        self.out_queues[tid] = OutboundQueue(self.queue_size, self.slow_policy)
+        self.connections[tid] = client
+        now = time.monotonic()
+        self.last_active[tid] = now
+        with self.clients_lock:
+            self.thread_status[tid] = True
+            self.live_tids.add(tid)
+        if self.idle_wheel is not None:
+            self.idle_wheel.schedule(tid, now + (self.heartbeat or self.idle_timeout))
+        self.metrics.accepted()
+        self.log.log('connect', tid=tid)
+        if self.capture is not None:
+            self.capture.connect(tid)
+
+    #fcn to tear a client down once its connection is gone, can be called multiple times without error
+    #after on_disconnect(tid) returns, release_tid(tid) lets tid be given to a new client
+    def remove_client(self, tid):
+        with self.clients_lock:
+            if not self.thread_status[tid]:
+                return
+            self.thread_status[tid] = False
+            self.live_tids.discard(tid)
+        if self.idle_wheel is not None:
+            self.idle_wheel.cancel(tid)
+        self.unsubscribe_all(tid)
+        self.out_queues[tid].close()
+        self.close_connection(self.connections[tid])
+        self.log.log('disconnect', tid=tid)
+        if self.capture is not None:
+            self.capture.disconnect(tid)
+        self.on_disconnect(tid)
+        self.release_tid(tid)
+
+    #fcn to give tid's slot back for a new client. Overwrite to hold it back while the app still has work queued for the old client
+    #(a new client in the slot would get it), call super().release_tid(tid) once that work is done
+    def release_tid(self, tid):
+        with self.clients_lock:
+            self.free_tids.append(tid)
+
+    #fcn called once for every client that is gone, overwrite to drop what the app keeps per tid
+    def on_disconnect(self, tid):
+        self.dprint("client disconnected", tid)
+
+    #tids of every connected client
+    def client_tids(self):
+        return tuple(self.live_tids)
+
+    #fcn to check the clients whose wait ran out by now (see IDLE CONNECTIONS): ping them, or disconnect them if they
+    #sent nothing for idle_timeout. A client that sent something since is just checked again later
+    def check_idle(self, now):
+        tids = self.idle_wheel.expire(now)
+        if not tids:
+            return
+        pings = []
+        with self.clients_lock:
+            for tid in tids:
+                if not self.thread_status[tid]:
+                    continue
+                last_active = self.last_active[tid]
+                if now - last_active >= self.idle_timeout:
+                    self.dprint("client", tid, "sent nothing for", self.idle_timeout, "s, disconnecting")
+                    self.log.log('idle', tid=tid)
+                    self.idle_dropped += 1
+                    self.disconnect_client(tid)
+                    continue
+                if self.heartbeat is not None and now - last_active >= self.heartbeat:
+                    pings.append(tid)
+                    #ping again each heartbeat until it answers or times out
+                    deadline = min(last_active + self.idle_timeout, now + self.heartbeat)
+                else:
+                    deadline = last_active + (self.heartbeat or self.idle_timeout)
+                self.idle_wheel.schedule(tid, deadline)
+        frame = self.heartbeat_frame()
+        if pings and frame is not None:
+            self.send_frame(frame, pings, key=HEARTBEAT_CODE)
+
+    #encoded heartbeat, None if the server can't send one (base server has no header codes, so idle_timeout only)
+    def heartbeat_frame(self):
+        return None
+
+    #fcn to read from a client that is ready (event loop)
+    def read_client(self, connection, tid):
+        try:
+            messages = self.readers[tid].recv_messages(connection)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception:
+            messages = None
+        if messages is None:
+            self.dprint("connection dropped.")
+            self.drop_client(tid)
+            return
+
+        self.last_active[tid] = time.monotonic()
+        log = self.log
+        capture = self.capture
+        for data in messages:
+            if log.enabled and log.keep('recv'):
+                log.record('recv', tid=tid, data=bytes(data))
+            if capture is not None:
+                capture.recv(tid, data)
+            try:
+                self.handle_message(data, tid)
+            except ProtocolError as e:
+                #the client sent something that doesn't decode, no need for a traceback
+                self.dprint("protocol error: ", e)
+                self.log.log('protocol_error', tid=tid)
+                self.drop_client(tid)
+                return
+            except Exception:
+                #the loop serves everyone, so a message a handler chokes on only costs its own client the connection
+                #(like a client thread dying in thread mode)
+                traceback.print_exc()
+                self.log.log('handler_error', tid=tid)
+                self.drop_client(tid)
+                return
+
+    #fcn to get the loop to write a client's queue (event loop)
+    #from the loop itself it's written at the end of this tick, with anything else queued for it in the meantime
+    def wake_writer(self, tid):
+        if current_thread() is self.server_thread:
+            self.loop_writes.add(tid)
+            return
+        with self.send_lock:
+            #only the first pending tid needs to wake the loop up
+            wake = len(self.pending_writes) == 0
+            self.pending_writes.add(tid)
+        if wake:
+            try:
+                self.wakeup_send.send(b'\0')
+            except OSError:
+                pass
 
-            self.parse_message(data, tid)
+    #fcn to write pending data for other threads' sends (event loop)
+    def handle_wakeup(self):
+        try:
+            self.wakeup_recv.recv(self.max_data_size)
+        except BlockingIOError:
+            pass
+        with self.send_lock:
+            tids = self.pending_writes
+            self.pending_writes = set()
+        self.loop_writes |= tids
+
+    #fcn to write out every client that got something this tick (event loop)
+    def flush_loop_writes(self):
+        tids = self.loop_writes
+        self.loop_writes = set()
+        for tid in tids:
+            if self.thread_status[tid]:
+                self.flush_client(tid)
+
+    #fcn to send as much queued data as the socket takes, only called on the loop thread (event loop)
+    def flush_client(self, tid):
+        connection = self.connections[tid]
+        queue = self.out_queues[tid]
+        #buffers left over from the last time the socket was full
+        buffers = self.partials[tid]
+        while True:
+            if buffers is None:
+                frames = queue.get_all(block=False)
+                if frames is None:
+                    #queue closed, client was disconnected
+                    self.drop_client(tid)
+                    return
+                if len(frames) == 0:
+                    break
+                buffers = [part for frame in frames for part in frame]
+            try:
+                sent = send_some(connection, buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+            except Exception:
+                self.dprint("connection dropped.")
+                self.drop_client(tid)
+                return
+            buffers = skip_sent(buffers, sent) or None
+            if buffers is not None:
+                break
+        self.partials[tid] = buffers
+        #only wait for writable while there is something left to send
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if buffers is not None else selectors.EVENT_READ
+        if self.selector.get_key(connection).events != events:
+            self.selector.modify(connection, events, tid)
 
-        self.close_connection(connection)
+    #fcn to stop serving a client (event loop)
+    def drop_client(self, tid):
+        self.partials[tid] = None
+        try:
+            self.selector.unregister(self.connections[tid])
+        except (KeyError, ValueError):
+            pass
+        self.remove_client(tid)
+
+    #fcn to cut off a client (eg too slow to keep up). Its reader thread / the loop then stops like for any dropped connection
+    def disconnect_client(self, tid):
+        self.out_queues[tid].close()
+        if self.event_loop:
+            self.wake_writer(tid)
+        else:
+            try:
+                self.connections[tid].shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
-    #fcn to send data to all clients
+    #fcn to send data to all clients. msg is encoded once and the same bytes are queued for everyone
+    #with a channel, clients of the other processes get it too
     def broadcast_message(self, msg, **kwargs):
-        for tid in range(len(self.connections)):
-            self.send_message(msg, tid, **kwargs)
+        frame = self.encode_parts(msg, **kwargs)
+        self.send_frame(frame, self.client_tids(), key=kwargs.get('header'))
+        if self.channel is not None:
+            self.channel.publish(frame, kwargs.get('header'))
+
+    #fcn to send data to every client subscribed to topic. msg is encoded once, returns how many clients it was queued for
+    def publish(self, topic, msg, **kwargs):
+        if not self.topics.get(topic):
+            return 0
+        frame = self.encode_parts(msg, **kwargs)
+        with self.topics_lock:
+            tids = tuple(self.topics.get(topic, ()))
+        self.send_frame(frame, tids, key=kwargs.get('header'))
+        return len(tids)
+
+    #fcn to add tid to topic's subscribers, returns False if it can't (client gone)
+    def subscribe(self, tid, topic):
+        with self.topics_lock:
+            if not self.thread_status[tid]:
+                return False
+            self.topics.setdefault(topic, set()).add(tid)
+            if self.client_topics[tid] is None:
+                self.client_topics[tid] = set()
+            self.client_topics[tid].add(topic)
+        return True
 
-    #fcn to send data to specified client
+    #fcn to take tid off topic's subscribers, can be called multiple times without error
+    def unsubscribe(self, tid, topic):
+        with self.topics_lock:
+            self.remove_subscriber(tid, topic)
+            if self.client_topics[tid] is not None:
+                self.client_topics[tid].discard(topic)
+
+    def unsubscribe_all(self, tid):
+        with self.topics_lock:
+            topics = self.client_topics[tid]
+            self.client_topics[tid] = None
+            for topic in topics or ():
+                self.remove_subscriber(tid, topic)
+
+    #fcn to drop topic and all its subscriptions, eg when what it was about is gone
+    def close_topic(self, topic):
+        with self.topics_lock:
+            for tid in self.topics.pop(topic, ()):
+                if self.client_topics[tid] is not None:
+                    self.client_topics[tid].discard(topic)
+
+    #call with topics_lock held. Empty topics are dropped
+    def remove_subscriber(self, tid, topic):
+        tids = self.topics.get(topic)
+        if tids is not None:
+            tids.discard(tid)
+            if not tids:
+                del self.topics[topic]
+
+    #fcn to send data to specified client (queued, returns right away)
+    #the first message to a client while its request is handled is the reply to it (see GenericHeader REQUESTS)
     def send_message(self, msg, tid, **kwargs):
-        connection = self.connections[tid]
-        connection.sendall(self.encode(msg, **kwargs))
+        rid = self.reply_rid(tid)
+        if rid is None:
+            self.queue_frame(self.encode_parts(msg, **kwargs), tid, key=kwargs.get('header'))
+        else:
+            #no key, and reply=True so the queue never drops it
+            self.queue_frame(self.encode_parts(msg, rid=rid, **kwargs), tid, code=kwargs.get('header'), reply=True)
         self.last_send = time.time()
 
+    #fcn to send an already encoded message (output of encode_parts, or encode) to each client in tids
+    #use this to send one msg to a group of clients without encoding it for each of them
+    def send_frame(self, frame, tids, key=None):
+        if type(frame) is not tuple:
+            frame = (frame,)
+        for tid in tids:
+            self.queue_frame(frame, tid, key)
+        self.last_send = time.time()
+
+    #fcn to put an encoded message (tuple of bytes, see encode_parts) in a client's outbound queue. key is used by the 'coalesce' policy
+    #code is the message's header code for metrics + logs, key by default (replies have a code but no key)
+    #reply=True for replies to requests, see OutboundQueue
+    def queue_frame(self, frame, tid, key=None, code=None, reply=False):
+        if not self.thread_status[tid]:
+            return
+        if code is None:
+            code = key
+        size = sum(map(len, frame))
+        self.metrics.message_out(code, size)
+        if self.log.enabled and self.log.keep('send'):
+            self.log.record('send', tid=tid, code=code, size=size)
+        if self.capture is not None:
+            self.capture.send(tid, frame)
+        if not self.out_queues[tid].put(frame, key, reply):
+            self.dprint("client", tid, "can't keep up, disconnecting")
+            self.disconnect_client(tid)
+            return
+        if self.event_loop:
+            self.wake_writer(tid)
+
     #fcn to close all connections, can be called multiple times without error
     def end(self):
         self.dprint("end server:")
         self.running = False
-        for connection in self.connections:
-            self.close_connection(connection)
+        for tid in self.client_tids():
+            self.out_queues[tid].close()
+            self.close_connection(self.connections[tid])
         self.close_connection(self.server_socket)
+        if self.channel is not None:
+            self.channel.close()
+        if self.event_loop:
+            #wake the loop so it sees running=False
+            try:
+                self.wakeup_send.send(b'\0')
+            except OSError:
+                pass
         self.dprint("done.")
+        if self.capture is not None:
+            self.capture.close()
+        self.log.flush()
 
-    #fcn to print if debug is on
+    #fcn called by the read loops with each received message
+    def handle_message(self, data, tid):
+        self.count_in(data)
+        self.parse_message(data, tid)
+
+    #request id to tag a message to tid with, base server has no requests
+    def reply_rid(self, tid):
+        return None
+
+    #fcn to count a received message in metrics. Base server has no header codes, so everything is code None
+    def count_in(self, data):
+        self.metrics.message_in(None, len(data))
+
+    #fcn to get all metrics: self.metrics counters + connections + outbound queue depths
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        tids = self.client_tids()
+        depths = [len(self.out_queues[tid]) for tid in tids]
+        snapshot['connections'] = len(tids)
+        #slots = most clients connected at once, free_tids = slots waiting for a new client
+        snapshot['slots'] = len(self.connections)
+        snapshot['free_tids'] = len(self.free_tids)
+        snapshot['queue_depth'] = {'total': sum(depths), 'max': max(depths, default=0)}
+        snapshot['queue_dropped'] = sum(queue.dropped for queue in self.out_queues if queue is not None)
+        snapshot['idle_dropped'] = self.idle_dropped
+        snapshot['topics'] = len(self.topics)
+        snapshot['last_send'] = self.last_send
+        return snapshot
+
+    #fcn to make the object that splits received bytes into messages, one per connection
+    #base server has no framing, so every recv is one message (see GenericHeader for framed version)
+    def new_reader(self):
+        return RawReader(self.max_data_size)
+
+    #fcn to print if debug is on. Logged as a 'debug' record, so it's written by the log's thread (see GenericLog)
     def dprint(self, *print_args):
         if self.debug:
-            print(*print_args)
+            self.log.log('debug', *print_args)
 
     #exit handler fcn, can be called multiple times on same connection without error
     def close_connection(self, connection):
         self.dprint("Closing connection")
+        try:
+            #close alone doesn't wake up a thread blocked in recv/accept on it, or tell the peer right away
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         connection.close()
 
 
@@ -130,85 +729,787 @@ class GenericServer:
         self.dprint("Using base (str) encode!")
         return str.encode(obj)
 
+    #encoded message as a tuple of bytes, sent back to back without joining them (see send_some)
+    def encode_parts(self, obj, **kwargs):
+        return (self.encode(obj, **kwargs),)
+
     #fcn to apply logic of server. (including decode) Example below
     def parse_message(self, data, tid):
         #remember to decode data here!
         pass
 
 
+#counters behind metrics_snapshot. Updates can come from any thread, so they take a lock; it is almost never contended
+#and each update is a couple of dict ops, so it is cheap enough to leave on
+#handler times go in a histogram with power of 2 buckets: bucket i counts times in [2^(i-1), 2^i) ns
+class Metrics:
+    num_buckets = 48
+    #accept rate is over this many seconds
+    accept_window = 60
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start_time = time.time()
+        #header code -> count
+        self.msgs_in = {}
+        self.bytes_in = {}
+        self.msgs_out = {}
+        self.bytes_out = {}
+        #header code -> [calls, total ns, max ns, buckets, handler name or None]
+        self.handlers = {}
+        self.accepts = 0
+        #[second, accepts in that second] for the last accept_window seconds
+        self.accept_seconds = deque()
+
+    def message_in(self, code, size):
+        with self.lock:
+            self.msgs_in[code] = self.msgs_in.get(code, 0) + 1
+            self.bytes_in[code] = self.bytes_in.get(code, 0) + size
+
+    def message_out(self, code, size):
+        with self.lock:
+            self.msgs_out[code] = self.msgs_out.get(code, 0) + 1
+            self.bytes_out[code] = self.bytes_out.get(code, 0) + size
+
+    #keyed by code, not handler name: partials/lambdas have no __name__ and two handlers can share one. name is only a label
+    def handler_time(self, code, ns, name=None):
+        with self.lock:
+            stats = self.handlers.get(code)
+            if stats is None:
+                stats = self.handlers[code] = [0, 0, 0, [0]*self.num_buckets, name]
+            stats[0] += 1
+            stats[1] += ns
+            if ns > stats[2]:
+                stats[2] = ns
+            stats[3][min(ns.bit_length(), self.num_buckets - 1)] += 1
+
+    def accepted(self):
+        now = int(time.time())
+        with self.lock:
+            self.accepts += 1
+            if self.accept_seconds and self.accept_seconds[-1][0] == now:
+                self.accept_seconds[-1][1] += 1
+            else:
+                self.accept_seconds.append([now, 1])
+                while self.accept_seconds[0][0] <= now - self.accept_window:
+                    self.accept_seconds.popleft()
+
+    #fcn to get accepts/sec over the last accept_window seconds
+    def accept_rate(self):
+        now = int(time.time())
+        with self.lock:
+            recent = sum(count for second, count in self.accept_seconds if second > now - self.accept_window)
+        return recent / min(self.accept_window, max(1, now - int(self.start_time)))
+
+    #fcn to estimate a percentile (0-1) from the buckets, returns the bucket's upper bound in ns
+    @staticmethod
+    def bucket_percentile(buckets, q):
+        target = q * sum(buckets)
+        seen = 0
+        for i, count in enumerate(buckets):
+            seen += count
+            if count > 0 and seen >= target:
+                return 1 << i
+        return 0
+
+    #fcn to copy all counters into plain dicts (safe to pickle / print)
+    def snapshot(self):
+        with self.lock:
+            snapshot = {
+                'time': time.time(),
+                'uptime': time.time() - self.start_time,
+                'msgs_in': dict(self.msgs_in),
+                'bytes_in': dict(self.bytes_in),
+                'msgs_out': dict(self.msgs_out),
+                'bytes_out': dict(self.bytes_out),
+                'accepts': self.accepts,
+            }
+            handlers = {code: (stats[0], stats[1], stats[2], list(stats[3]), stats[4]) for code, stats in self.handlers.items()}
+        snapshot['accept_rate'] = self.accept_rate()
+        snapshot['handlers'] = {}
+        for code, (calls, total, longest, buckets, name) in handlers.items():
+            snapshot['handlers'][code] = {
+                'name': name,
+                'calls': calls,
+                'mean_us': total / calls / 1e3,
+                'p50_us': self.bucket_percentile(buckets, 0.5) / 1e3,
+                'p99_us': self.bucket_percentile(buckets, 0.99) / 1e3,
+                'max_us': longest / 1e3,
+                'buckets': buckets,
+            }
+        return snapshot
+
+#most buffers one sendmsg takes (IOV_MAX, 1024 on linux)
+MAX_IOV = 1024
+
+#fcn to send buffers with one syscall (sendmsg = writev), returns number of bytes sent
+#falls back to joining them where sockets have no sendmsg (windows)
+def send_some(connection, buffers):
+    if not hasattr(connection, 'sendmsg'):
+        return connection.send(b''.join(buffers))
+    if len(buffers) > MAX_IOV:
+        buffers = buffers[:MAX_IOV]
+    return connection.sendmsg(buffers)
+
+#fcn to drop the first sent bytes from buffers, returns the list of what is left to send
+def skip_sent(buffers, sent):
+    for i, buffer in enumerate(buffers):
+        if sent < len(buffer):
+            if sent == 0:
+                return buffers[i:]
+            return [memoryview(buffer)[sent:]] + buffers[i + 1:]
+        sent -= len(buffer)
+    return []
+
+#fcn to send small messages right away instead of waiting to merge them (Nagle), we batch them ourselves
+def set_nodelay(connection):
+    try:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        #not a TCP socket
+        pass
+
+#timer wheel: num_slots buckets of tick seconds each, a key is put in the bucket its deadline falls in
+#so scheduling/cancelling a key is O(1), and each tick only looks at the keys of the buckets it passes, however many keys there are
+#deadlines more than one turn of the wheel away stay in their bucket until a turn they are due in
+#expire() is called by whoever drives the wheel (see GenericServer.check_idle), there are no timer threads
+class TimerWheel:
+    def __init__(self, tick, num_slots):
+        self.tick = tick
+        self.slots = [set() for i in range(num_slots)]
+        #key -> (tick number, deadline)
+        self.timers = {}
+        #ticks before this one were expired already
+        self.current = int(time.monotonic() / tick)
+        self.lock = Lock()
+
+    #fcn to (re)schedule key for deadline (time.monotonic() time), replaces its old deadline
+    def schedule(self, key, deadline):
+        #never in a bucket that was passed already
+        tick = max(int(deadline / self.tick), self.current)
+        with self.lock:
+            self.remove(key)
+            self.timers[key] = (tick, deadline)
+            self.slots[tick % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def remove(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            self.slots[timer[0] % len(self.slots)].discard(key)
+
+    #fcn to take out every key whose deadline is <= now, returns a list of them
+    def expire(self, now):
+        last = int(now / self.tick)
+        if last < self.current:
+            return []
+        expired = []
+        with self.lock:
+            #after a long pause every bucket is looked at once
+            for tick in range(self.current, min(last, self.current + len(self.slots) - 1) + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for key in [key for key in slot if self.timers[key][1] <= now]:
+                    slot.discard(key)
+                    del self.timers[key]
+                    expired.append(key)
+            #this tick's bucket can still get keys due later in it, look at it again next time
+            self.current = last
+        return expired
+
+    def __len__(self):
+        return len(self.timers)
+
+#bounded queue of encoded messages waiting to be sent to one client
+#when it is full (client reads slower than we send), policy decides what happens:
+# 'drop_oldest': throw away the oldest queued message
+# 'coalesce': throw away an older queued message with the same key (header code), or the oldest if there is none
+# 'disconnect': close the queue, put returns False and the server disconnects the client
+#replies to requests (reply=True) are never thrown away, a client's Future would never complete. If only replies are
+#queued there is nothing to drop, so put returns False and the client is disconnected (its requests fail with the connection)
+class OutboundQueue:
+    policies = ('drop_oldest', 'coalesce', 'disconnect')
+
+    def __init__(self, max_size=256, policy='disconnect'):
+        if policy not in self.policies:
+            raise ValueError("Unknown slow client policy {}, use one of {}".format(policy, self.policies))
+        self.max_size = max_size
+        self.policy = policy
+        #(key, frame, reply) triples
+        self.frames = deque()
+        self.cond = Condition()
+        self.closed = False
+        #number of messages thrown away because the client was too slow
+        self.dropped = 0
+
+    #returns False if the client should be disconnected
+    def put(self, frame, key=None, reply=False):
+        with self.cond:
+            if self.closed:
+                return True
+            if len(self.frames) >= self.max_size and (self.policy == 'disconnect' or not self.make_space(key)):
+                self.closed = True
+                self.frames.clear()
+                self.cond.notify_all()
+                return False
+            self.frames.append((key, frame, reply))
+            self.cond.notify()
+        return True
+
+    #fcn to drop one queued message that isn't a reply, returns False if there is none
+    def make_space(self, key):
+        if self.policy == 'coalesce' and key is not None:
+            for i, (queued_key, frame, reply) in enumerate(self.frames):
+                if queued_key == key and not reply:
+                    del self.frames[i]
+                    self.dropped += 1
+                    return True
+        for i, (queued_key, frame, reply) in enumerate(self.frames):
+            if not reply:
+                del self.frames[i]
+                self.dropped += 1
+                return True
+        return False
+
+    #returns list of all queued frames ([] if none and block=False), None once closed
+    def get_all(self, block=True):
+        with self.cond:
+            while block and len(self.frames) == 0 and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+            frames = [frame for key, frame, reply in self.frames]
+            self.frames.clear()
+            return frames
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.frames.clear()
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.frames)
+
+#Readers: take a connection and return the list of messages received on it (None once connection is closed)
+#no framing, whatever a single recv returns is passed on as a message
+class RawReader:
+    def __init__(self, max_data_size):
+        self.max_data_size = max_data_size
+
+    def recv_messages(self, connection):
+        data = connection.recv(self.max_data_size)
+        if not data:
+            return None
+        return [data]
+
+#a peer broke the protocol (eg a frame over max_frame_size, or a message that doesn't decode). Its connection is closed
+class ProtocolError(ValueError):
+    pass
+
+#length prefixed frames: [4B big endian length][frame]. Used by GenericHeader
+#receives with recv_into into one preallocated buffer, and returns each complete frame as a memoryview of that buffer
+#so partial frames are never copied per chunk. NOTE: returned frames are only valid until the next recv_messages call
+#a frame bigger than size gets a bigger buffer for as long as it takes, a length over max_frame_size is a ProtocolError
+#(the length is the peer's word, it can't make us allocate whatever it says)
+class FrameReader:
+    prefix = struct.Struct("!I")
+    max_frame_size = MAX_FRAME_SIZE
+
+    def __init__(self, size=2048, max_frame_size=None):
+        self.size = size
+        if max_frame_size is not None:
+            self.max_frame_size = max_frame_size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        #unprocessed data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+        #full size (prefix included) of the partial frame at start, 0 if not known yet
+        self.needed = 0
+
+    def recv_messages(self, connection):
+        self.make_room()
+        n = connection.recv_into(self.view[self.end:])
+        if n == 0:
+            return None
+        self.end += n
+        return self.frames()
+
+    #fcn to cut all complete frames out of the buffer
+    def frames(self):
+        frames = []
+        prefix_size = self.prefix.size
+        self.needed = 0
+        while self.end - self.start >= prefix_size:
+            length = self.prefix.unpack_from(self.buffer, self.start)[0]
+            if length > self.max_frame_size:
+                raise ProtocolError("frame of {}B, max_frame_size is {}B".format(length, self.max_frame_size))
+            frame_end = self.start + prefix_size + length
+            if frame_end > self.end:
+                self.needed = frame_end - self.start
+                break
+            frames.append(self.view[self.start + prefix_size:frame_end])
+            self.start = frame_end
+        return frames
+
+    #fcn to make sure there is space for the rest of the partial frame before receiving
+    def make_room(self):
+        pending = self.end - self.start
+        needed = max(self.needed, pending + 1)
+        if len(self.buffer) > self.size and needed <= self.size:
+            #the big frame was handled, go back to a normal sized buffer
+            self.resize(self.size, pending)
+        elif pending == 0:
+            self.start = self.end = 0
+        elif needed > len(self.buffer):
+            #frame is bigger than the buffer: switch to a bigger one
+            self.resize(min(max(needed, 2*len(self.buffer)), self.prefix.size + self.max_frame_size), pending)
+        elif self.start + needed > len(self.buffer):
+            #not enough space left at the end: move the partial frame to the front
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+            self.start = 0
+            self.end = pending
+
+    #fcn to switch to a new buffer of size with the pending data at its front (old views stay valid)
+    def resize(self, size, pending):
+        buffer = bytearray(size)
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+
+#Serializers turn objects into bytes and back with dumps/loads. GenericHeader uses pickle unless a code has its own
+class PickleSerializer:
+    def dumps(self, obj):
+        return pickle.dumps(obj)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+#Fields for StructSerializer: pack(value, out) appends the value to bytearray out,
+#unpack(buffer, offset) returns (value, offset after the value)
+#fixed size value, fmt is a struct format char eg 'B', 'h', 'i', 'd', '?'
+class StructField:
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.struct = struct.Struct("!" + fmt)
+
+    def pack(self, value, out):
+        out += self.struct.pack(value)
+
+    def unpack(self, buffer, offset):
+        return self.struct.unpack_from(buffer, offset)[0], offset + self.struct.size
+
+#one of a fixed list of values, sent as its index (1B)
+class EnumField:
+    def __init__(self, values):
+        self.values = list(values)
+        self.indexes = {value: i for i, value in enumerate(self.values)}
+
+    def pack(self, value, out):
+        out.append(self.indexes[value])
+
+    def unpack(self, buffer, offset):
+        return self.values[buffer[offset]], offset + 1
+
+#utf8 string, up to 65535 bytes
+class StringField:
+    size = struct.Struct("!H")
+
+    def pack(self, value, out):
+        data = value.encode('utf-8')
+        out += self.size.pack(len(data))
+        out += data
+
+    def unpack(self, buffer, offset):
+        n = self.size.unpack_from(buffer, offset)[0]
+        offset += self.size.size
+        return str(buffer[offset:offset + n], 'utf-8'), offset + n
+
+#list of items of the same field, up to 65535 items (size_fmt='B' for up to 255 with a 1B length)
+#a field can define pack_many(values, out)/unpack_many(buffer, offset, n) to do a whole list at once
+class ListField:
+    def __init__(self, item, size_fmt='H'):
+        self.item = as_field(item)
+        self.size = struct.Struct("!" + size_fmt)
+
+    def pack(self, values, out):
+        out += self.size.pack(len(values))
+        if type(self.item) is StructField:
+            #whole list in one struct call
+            out += struct.pack("!{}{}".format(len(values), self.item.fmt), *values)
+            return
+        if hasattr(self.item, 'pack_many'):
+            self.item.pack_many(values, out)
+            return
+        for value in values:
+            self.item.pack(value, out)
+
+    def unpack(self, buffer, offset):
+        n = self.size.unpack_from(buffer, offset)[0]
+        offset += self.size.size
+        if type(self.item) is StructField:
+            fmt = "!{}{}".format(n, self.item.fmt)
+            return list(struct.unpack_from(fmt, buffer, offset)), offset + struct.calcsize(fmt)
+        if hasattr(self.item, 'unpack_many'):
+            return self.item.unpack_many(buffer, offset, n)
+        values = []
+        for i in range(n):
+            value, offset = self.item.unpack(buffer, offset)
+            values.append(value)
+        return values, offset
+
+#field that can also be None (1B flag first)
+class OptionalField:
+    def __init__(self, item):
+        self.item = as_field(item)
+
+    def pack(self, value, out):
+        if value is None:
+            out.append(0)
+        else:
+            out.append(1)
+            self.item.pack(value, out)
+
+    def unpack(self, buffer, offset):
+        if buffer[offset] == 0:
+            return None, offset + 1
+        return self.item.unpack(buffer, offset + 1)
+
+#fcn to allow struct format chars in place of fields in a schema
+def as_field(field):
+    if isinstance(field, str):
+        return StructField(field)
+    return field
+
+#compact binary serializer for dicts with a known set of keys, no field names or type info goes on the wire
+#schema is a list of (key, field), where field is a struct format char or one of the fields above (or another StructSerializer)
+#eg StructSerializer([('index', 'h'), ('chosen_color', EnumField(['', 'red']))])
+#unlike pickle, loads can only ever build the values in the schema, so it is safe on data from clients
+class StructSerializer:
+    def __init__(self, schema):
+        self.schema = [(key, as_field(field)) for key, field in schema]
+        self.keys = [key for key, field in self.schema]
+        #if every field has a fixed size, the whole dict is packed with a single struct call
+        self.fixed = None
+        if all(type(field) in (StructField, EnumField) for key, field in self.schema):
+            self.fixed = struct.Struct("!" + "".join(field.fmt if type(field) is StructField else "B" for key, field in self.schema))
+            self.enums = [(i, key, field) for i, (key, field) in enumerate(self.schema) if type(field) is EnumField]
+
+    def dumps(self, obj):
+        if self.fixed is not None:
+            values = [obj[key] for key in self.keys]
+            for i, key, field in self.enums:
+                values[i] = field.indexes[values[i]]
+            return self.fixed.pack(*values)
+        out = bytearray()
+        self.pack(obj, out)
+        return bytes(out)
+
+    #data comes from a peer: whatever is wrong with it (too short, enum index out of range, bad utf8, ...) is a ProtocolError
+    def loads(self, data):
+        try:
+            if self.fixed is not None and len(data) == self.fixed.size:
+                obj = dict(zip(self.keys, self.fixed.unpack(data)))
+                for i, key, field in self.enums:
+                    obj[key] = field.values[obj[key]]
+                return obj
+            obj, offset = self.unpack(data, 0)
+        except (struct.error, IndexError, KeyError, ValueError) as e:
+            raise ProtocolError("StructSerializer: can't decode {}B: {!r}".format(len(data), e)) from e
+        if offset != len(data):
+            raise ProtocolError("StructSerializer: {} bytes left over after decoding".format(len(data) - offset))
+        return obj
+
+    def pack(self, obj, out):
+        for key, field in self.schema:
+            field.pack(obj[key], out)
+
+    def unpack(self, buffer, offset):
+        obj = {}
+        for key, field in self.schema:
+            obj[key], offset = field.unpack(buffer, offset)
+        return obj, offset
+
+
+#decorator to make a GenericHeader method the handler for a header code, set_header picks these up. eg:
+#   @header_code(3)
+#   def update_state(self, data, tid=None):
+def header_code(code):
+    def register(fcn):
+        fcn.header_code = code
+        return fcn
+    return register
+
+#header codes from FIRST_RESERVED_CODE up are used by GenericHeader itself, apps should use codes below it
+FIRST_RESERVED_CODE = 250
+METRICS_CODE = 250 #client asks for the server's metrics_snapshot, server sends it back (pickled) with the same code
+REQUEST_CODE = 251 #wraps a message as a request/reply: [REQUEST_CODE][4B request id][header][data], see REQUESTS below
+HEARTBEAT_CODE = 252 #server checks an idle client is still there, the client sends one back (see GenericServer IDLE CONNECTIONS)
+SUBSCRIBE_CODE = 253 #client subscribes to the topic named in the message (utf-8), see GenericServer TOPICS
+UNSUBSCRIBE_CODE = 254 #client unsubscribes from the topic named in the message
+
+#a request a client sent us (tid, rid). Handling it can be deferred to other threads (see GenericHeader.defer),
+#it's answered once one message was sent to tid, or with an empty reply once all its handling is done
+class Request:
+    rid_struct = struct.Struct("!I")
+
+    def __init__(self, tid, rid):
+        self.tid = tid
+        self.rid = rid
+        self.replied = False
+        #deferred handlers that haven't run yet
+        self.pending = 0
+        self.lock = Lock()
+
 #inherit from this to allow sending objects, and defining a generic header to allow more functionality
 # How to send objs? Sends a pickled dict { key: value,... } where self.__dict__[key] = value
+# Every message is framed with its length (see FrameReader), so messages are never merged/split. They can be up to
+#  max_frame_size bytes (GenericServer(max_frame_size=...), 4 MiB by default)
+# Handlers are kept in a dict (code -> fcn) so finding one costs the same no matter how many codes there are
+# Objects are pickled by default, set_serializer(code, serializer) picks another serializer (eg StructSerializer) for a code
+#REQUESTS: a client can send a message with request=True, it gets a Future back (see GenericClient.send_message)
+# the server handles it as usual, the first message it sends that client while handling it is tagged with the request id,
+# the client handles that reply as usual and then completes the Future with (header, data)
+# if the handler sent the client nothing, the server sends an empty reply and the Future gets None
+# handlers that hand work to other threads wrap it with self.defer(fcn) so the reply is still tagged
 class GenericHeader:
+    default_serializer = PickleSerializer()
+
     #sets header. Tells decode function what to do for diff codes. any fcn in fcns should be a self fcn and take in data (as bytestring) + kwargs
+    #methods decorated with @header_code are registered automatically, codes/fcns can still be given as lists
     def set_header(self, header_size=None, codes=None, fcns=None, object_send=True):
+        self.handlers = {}
+        #code -> serializer, for codes that don't use default_serializer
+        self.serializers = {}
         if object_send:
             #without any special codes given, only has object send functionality
             object_recv_code = 0
-            self.codes = [object_recv_code]
-            object_recv_fcn = self.set_state
-            self.fcns = [object_recv_fcn]
-        else:
-            self.codes = []
-            self.fcns = []
+            self.handlers[object_recv_code] = self.set_state
+
+        #walk the classes base first, so a subclass can take over a code
+        for cls in reversed(type(self).__mro__):
+            for name, attr in vars(cls).items():
+                code = getattr(attr, 'header_code', None)
+                if code is not None:
+                    #getattr on self so an undecorated override of the method is used
+                    self.handlers[code] = getattr(self, name)
 
         if codes is not None:
-            self.codes += codes
-            
-        
-        if fcns is not None:
-            self.fcns += fcns
+            for code, fcn in zip(codes, fcns):
+                self.handlers[code] = fcn
             
         if header_size is not None:
             self.header_size = header_size
         else:
-            self.header_size = 1 + len(self.codes)//256 #256 = 1B
+            self.header_size = self.min_header_size()
         self.dprint("Set header size to ", self.header_size)
+        #request being handled on this thread (server)
+        self.request_local = local()
 
-    def encode(self, obj, header=None, pickle=False, **kwargs):
+    #fcn to add/replace a handler after set_header
+    def register_handler(self, code, fcn):
+        self.handlers[code] = fcn
+        self.header_size = max(self.header_size, self.min_header_size())
+
+    #fcn to use serializer for objects sent with this code (both ways, so both sides need to set it)
+    def set_serializer(self, code, serializer):
+        self.serializers[code] = serializer
+
+    #number of bytes needed to fit the biggest code (256 = 1B)
+    def min_header_size(self):
+        return max(1, (max(self.handlers, default=0).bit_length() + 7) // 8)
+
+    #app codes + handlers (reserved codes not included)
+    @property
+    def codes(self):
+        return [code for code in self.handlers if code < FIRST_RESERVED_CODE]
+
+    @property
+    def fcns(self):
+        return [fcn for code, fcn in self.handlers.items() if code < FIRST_RESERVED_CODE]
+
+    #pickle=True sends obj as an object, with the serializer for this header code
+    #returns the whole frame as one bytes object, servers send encode_parts instead
+    def encode(self, obj, header=None, pickle=False, rid=None, **kwargs):
+        head, data = self.encode_parts(obj, header, pickle, rid)
+        return head + data
+
+    #frame as (length prefix + header, data), so data isn't copied to put the header in front of it
+    #rid: tag the message as request/reply rid (see REQUESTS)
+    def encode_parts(self, obj, header=None, pickle=False, rid=None, **kwargs):
         if header is  None:
             #Ideally, this won't happen. In case it does, give it an invalid code
-            header = max(self.codes)+1 
-        header = header.to_bytes(self.header_size, "big")
+            header = max(self.codes, default=0)+1 
         data = obj
         if pickle:
-            data = self.obj_to_bytestring(data)
+            data = self.obj_to_bytestring(data, header)
         else:
             data = str.encode(data)
-        return header + data
-        
+        header = header.to_bytes(self.header_size, "big")
+        if rid is not None:
+            header = self.request_header(rid) + header
+        return (FrameReader.prefix.pack(len(header) + len(data)) + header, data)
+
+    def request_header(self, rid):
+        return REQUEST_CODE.to_bytes(self.header_size, "big") + Request.rid_struct.pack(rid)
+
+    #messages are length prefixed frames, at most max_frame_size bytes
+    def new_reader(self):
+        return FrameReader(self.max_data_size, self.max_frame_size)
+
 
     #returns status, header, data. (status True indicates message already processed)
+    #msg may be a memoryview into the receive buffer, data is copied out once here for the handlers
     def decode(self, msg, **kwargs):
         header = int.from_bytes(msg[:self.header_size], "big")
-        data = msg[self.header_size:]
+        data = bytes(msg[self.header_size:])
         #self.dprint("DECODE: header={} from bytestring={}".format(header, msg[:self.header_size]))
-        for code, fcn in zip(self.codes, self.fcns):
-            if header == code:
-                fcn(data, **kwargs)
-                return True, None, None
-        else:
-            #was not a special message. assume that data is a string /not pickled.
-            return False, header, data.decode('utf-8')
+        fcn = self.handlers.get(header)
+        if fcn is None:
+            return self.unknown_code(header, data, **kwargs)
+        start = time.perf_counter_ns()
+        fcn(data, **kwargs)
+        self.metrics.handler_time(header, time.perf_counter_ns() - start, getattr(fcn, '__name__', None))
+        return True, None, None
+
+    #requests are unwrapped here, everything else goes to parse_message
+    #server: handles the request, see reply_rid. client (tid=None): handles the reply and completes the request's Future
+    def handle_message(self, data, tid=None):
+        self.count_in(data)
+        if int.from_bytes(data[:self.header_size], "big") != REQUEST_CODE:
+            if tid is None:
+                self.parse_message(data)
+            else:
+                self.parse_message(data, tid)
+            return
+        offset = self.header_size + Request.rid_struct.size
+        rid = Request.rid_struct.unpack_from(data, self.header_size)[0]
+        msg = data[offset:]
+        if tid is None:
+            if len(msg) == 0:
+                #server had nothing to send back
+                self.complete_request(rid, None)
+                return
+            self.parse_message(msg)
+            self.complete_request(rid, (int.from_bytes(msg[:self.header_size], "big"), bytes(msg[self.header_size:])))
+            return
+        request = Request(tid, rid)
+        previous = getattr(self.request_local, 'request', None)
+        self.request_local.request = request
+        try:
+            self.parse_message(msg, tid)
+        finally:
+            self.request_local.request = previous
+        self.finish_request(request)
+
+    #rid if the message is the reply to the request handled on this thread, otherwise None
+    def reply_rid(self, tid):
+        request = getattr(self.request_local, 'request', None)
+        if request is None or request.tid != tid:
+            return None
+        with request.lock:
+            if request.replied:
+                return None
+            request.replied = True
+        return request.rid
+
+    #fcn to send an empty reply if nothing answered request, once none of its handling is left
+    def finish_request(self, request):
+        with request.lock:
+            if request.replied or request.pending > 0:
+                return
+            request.replied = True
+        header = self.request_header(request.rid)
+        self.queue_frame((FrameReader.prefix.pack(len(header)) + header,), request.tid, code=REQUEST_CODE, reply=True)
+
+    #fcn to wrap fcn so it runs as part of the request handled on this thread, eg before handing it to a worker thread:
+    #   self.workers.submit(room_id, self.defer(self.play_move), room, seat, move)
+    #messages fcn sends can then still be the reply. Returns fcn as is when no request is being handled
+    def defer(self, fcn):
+        request = getattr(self.request_local, 'request', None)
+        if request is None:
+            return fcn
+        with request.lock:
+            request.pending += 1
+        def deferred(*args, **kwargs):
+            previous = getattr(self.request_local, 'request', None)
+            self.request_local.request = request
+            try:
+                return fcn(*args, **kwargs)
+            finally:
+                self.request_local.request = previous
+                with request.lock:
+                    request.pending -= 1
+                self.finish_request(request)
+        return deferred
+
+    #messages are counted by header code, requests/replies by the code of the message they wrap (empty replies as REQUEST_CODE)
+    def count_in(self, data):
+        code = int.from_bytes(data[:self.header_size], "big")
+        offset = self.header_size + Request.rid_struct.size
+        if code == REQUEST_CODE and len(data) > offset:
+            code = int.from_bytes(data[offset:offset + self.header_size], "big")
+        self.metrics.message_in(code, len(data) + FrameReader.prefix.size)
+
+    #server: a client asked for our metrics, send them. client (tid=None): the server's metrics arrived
+    @header_code(METRICS_CODE)
+    def metrics_request(self, data, tid=None):
+        if tid is None:
+            self.server_metrics = self.bytestring_to_obj(data, METRICS_CODE)
+            return
+        self.send_message(self.metrics_snapshot(), tid, header=METRICS_CODE, pickle=True)
+
+    #server: client answered a heartbeat (the recv already counted as activity). client (tid=None): answer the server's
+    @header_code(HEARTBEAT_CODE)
+    def heartbeat_request(self, data, tid=None):
+        if tid is None:
+            self.send_heartbeat()
+
+    #server: client subscribes to a topic (see GenericServer TOPICS). Sent by clients only
+    @header_code(SUBSCRIBE_CODE)
+    def subscribe_request(self, data, tid=None):
+        if tid is not None:
+            self.subscribe(tid, data.decode('utf-8'))
+
+    @header_code(UNSUBSCRIBE_CODE)
+    def unsubscribe_request(self, data, tid=None):
+        if tid is not None:
+            self.unsubscribe(tid, data.decode('utf-8'))
+
+    #server: the same bytes go to every client it pings
+    def heartbeat_frame(self):
+        return self.encode_parts("", header=HEARTBEAT_CODE)
+
+    #fallback for codes with no handler. Can be overridden
+    def unknown_code(self, header, data, **kwargs):
+        #was not a special message. assume that data is a string /not pickled.
+        return False, header, data.decode('utf-8')
 
     def set_state(self, data, **kwargs):
-        state = self.bytestring_to_obj(data)
+        state = self.bytestring_to_obj(data, 0)
         self.dprint("received state: ", state)
         for key in state:
             self.__dict__[key] = state[key]
         
-    #fcn to change object to byte str
-    def obj_to_bytestring(self, obj):
-        return pickle.dumps(obj)
+    #fcn to change object to byte str, code picks the serializer
+    def obj_to_bytestring(self, obj, code=None):
+        return self.serializers.get(code, self.default_serializer).dumps(obj)
 
-    #fcn to convert byte str to object
-    def bytestring_to_obj(self, bytestring):
-        return pickle.loads(bytestring)
+    #fcn to convert byte str to object, code picks the serializer
+    def bytestring_to_obj(self, bytestring, code=None):
+        return self.serializers.get(code, self.default_serializer).loads(bytestring)
 
 
 #here is an example of a parse_message function, and an example main below
 class ExampleServer(GenericServer):
-    def __init__(self, max_connections, host, port, debug=True):
-        super().__init__(max_connections, host, port, debug)
+    def __init__(self, max_connections, host, port, debug=True, **kwargs):
+        super().__init__(max_connections, host, port, debug, **kwargs)
 
     def parse_message(self, msg, tid):
         #sample / test function
@@ -237,14 +1538,15 @@ class ExampleServer(GenericServer):
         return header, msg
 
 class ExampleServerWithHeader(GenericHeader, GenericServer):
-    def __init__(self, max_connections, host, port, debug=True):
-        super().__init__(max_connections, host, port, debug)
-        self.set_header(codes=[1], fcns=[self.tid_request])
+    def __init__(self, max_connections, host, port, debug=True, **kwargs):
+        super().__init__(max_connections, host, port, debug, **kwargs)
+        self.set_header()
         #these 3 are to test the genericHeader object send functionality
         self.test_var_int = 1
         self.test_var_str = "hi"
         self.test_var_arr = [1, 2, ["asd"]]
 
+    @header_code(1)
     def tid_request(self, data, tid=None):
         if tid is None:
             self.dprint("ERROR: tid should not be None in tid_request")
@@ -287,17 +1589,20 @@ class ExampleServerWithHeader(GenericHeader, GenericServer):
 
 #main, script to test
 def main():
-    #TODO make these cmd line args
-    run_example = False
-    run_example_with_header = True 
-    host = '127.0.0.1'
-    port = 1020
-    
+    parser = argparse.ArgumentParser(description="example server, run GenericClient.py clients against it")
+    parser.add_argument('--example', choices=['plain', 'header'], default='header', help="ExampleServer or ExampleServerWithHeader")
+    parser.add_argument('--connections', type=int, default=5, help="max connections")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1020)
+    #serve clients from one selector loop instead of 1 thread each
+    parser.add_argument('--event-loop', action='store_true')
+    args = parser.parse_args()
+
     print("creating server thread")
-    if run_example:
-        serv = ExampleServer(5, host, port, debug=True)
-    elif run_example_with_header:
-        serv = ExampleServerWithHeader(5, host, port, debug=True)
+    if args.example == 'plain':
+        serv = ExampleServer(args.connections, args.host, args.port, debug=True, event_loop=args.event_loop)
+    else:
+        serv = ExampleServerWithHeader(args.connections, args.host, args.port, debug=True, event_loop=args.event_loop)
 
     serv.run()
     i = 0
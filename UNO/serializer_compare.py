@@ -0,0 +1,53 @@
+#python UNO/serializer_compare.py
+#compares pickle with the uno_protocol StructSerializers on payloads from real (randomly played) games:
+#bytes per message, and time to dumps/loads one message
+import sys
+import io
+import random
+import contextlib
+import timeit
+sys.path.append('../')
+from pyserver.GenericServer import *
+from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
+
+#fcn to play random games, returns the (state payloads, move payloads) the server would have sent/received
+def collect_payloads(num_games=20, num_players=4, max_moves=300):
+    states = []
+    moves = []
+    #card effects print, keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(num_games):
+            game = uno.UnoGame(num_players)
+            game.start()
+            for n in range(max_moves):
+                if game.winner is not None:
+                    break
+                color = random.choice(uno.CARD_COLORS)
+                hand = game.player_hands[game.turn]
+                options = [ind for ind in range(len(hand)) if game.valid_move(ind, other_info=color)]
+                index = random.choice(options) if options else len(hand)
+                moves.append({'index': index, 'chosen_color': color if game.requires_color(index) else ''})
+                game.play_card(index, other_info=color)
+                for player in range(num_players):
+                    states.append(game.get_player_state(player))
+    return states, moves
+
+def compare(name, payloads, serializer, repeat=3):
+    pickler = PickleSerializer()
+    print("{} ({} payloads):".format(name, len(payloads)))
+    for label, ser in (("pickle", pickler), ("struct", serializer)):
+        data = [ser.dumps(obj) for obj in payloads]
+        size = sum(len(d) for d in data) / len(data)
+        dumps_time = min(timeit.repeat(lambda: [ser.dumps(obj) for obj in payloads], number=1, repeat=repeat)) / len(payloads)
+        loads_time = min(timeit.repeat(lambda: [ser.loads(d) for d in data], number=1, repeat=repeat)) / len(payloads)
+        print("  {:7s} {:8.1f} B/msg  dumps {:7.2f} us  loads {:7.2f} us".format(label, size, dumps_time*1e6, loads_time*1e6))
+
+def main():
+    random.seed(0)
+    states, moves = collect_payloads()
+    compare("player state (STATE_CODE)", states, STATE_SERIALIZER)
+    compare("move (MOVE_CODE)", moves, MOVE_SERIALIZER)
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,56 @@
 import random
+from array import array
+from bisect import bisect_left
 
 
 #card fcns, they take in object of type UnoGame and update it
 def plus_2(uno_game):
-    print("+2!")
+    if uno_game.verbose:
+        print("+2!")
     #uno_game.player_draw(uno_game.next_player(), 2) drawing handled in player_draw
     uno_game.stack.append(2)
 
 def turn_reverse(uno_game):
-    print("no u")
+    if uno_game.verbose:
+        print("no u")
     uno_game.turn_dir *= -1
 
 def turn_skip(uno_game):
-    print("skippd")
+    if uno_game.verbose:
+        print("skippd")
     uno_game.turn = uno_game.next_player() #gets updated again after this
 
 def change_color(uno_game):
-    print("color change!")
-    uno_game.current_card.set_card(color=uno_game.chosen_color)
+    if uno_game.verbose:
+        print("color change!")
+    #new card instead of set_card, cards can be shared (see CompactUnoDeck)
+    uno_game.current_card = UnoCard(uno_game.chosen_color, eff=uno_game.current_card.eff)
 
 def plus_4(uno_game):
-    print("+4!")
+    if uno_game.verbose:
+        print("+4!")
     uno_game.stack.append(4)
     change_color(uno_game)
 
 def no_eff(uno_game):
     pass
 
+#how many cards each +x card adds to the stack
+PLUS_VALUES = {plus_2: 2, plus_4: 4}
+#index legal_moves gives for drawing (any index that isn't a card in the hand draws)
+DRAW_MOVE = -1
+#cards dealt to each player in start
+HAND_SIZE = 6
+
 
 #Basic uno game
+#compact=True keeps the deck as an array of card codes (see CompactUnoDeck), for hosting lots of games
 class UnoGame():
-    def __init__(self, num_players):
-        self.deck = UnoDeck()
+    #print card effects / winner
+    verbose = True
+
+    def __init__(self, num_players, compact=False):
+        self.deck = self.new_deck(compact)
         self.num_players = num_players
         self.player_hands = [[]]*self.num_players
         self.current_card = None
@@ -44,11 +63,15 @@ class UnoGame():
         #records user's choice of color for +4 / color change
         self.chosen_color = ''
         self.winner = None
-        self.colors = ['red', 'yellow', 'green', 'blue']
+        self.colors = CARD_COLORS
+
+    #fcn to make the game's deck (shuffled)
+    def new_deck(self, compact):
+        return CompactUnoDeck() if compact else UnoDeck()
 
     def start(self):
         for i in range(self.num_players):
-            hand = self.deck.draw(6)
+            hand = UnoHand(self.deck.draw(HAND_SIZE))
             self.player_hands[i] = hand
         self.current_card = self.deck.draw_one()
         while self.current_card.color not in self.colors: #if black card, just draw another
@@ -90,16 +113,31 @@ class UnoGame():
         card = self.player_hands[player][index]
         #nothing on stack, can play normally
         if len(self.stack) == 0:
-            return (card.color in self.current_card.color) or (card.number == self.current_card.number) or (card.eff.__name__ != "no_eff" and card.eff.__name__ == self.current_card.eff.__name__)
+            return (card.color in self.current_card.color) or (card.number == self.current_card.number) or (card.eff is not no_eff and card.eff is self.current_card.eff)
         #else, must play +x card, since draw case handled above
-        if 'plus' in card.eff.__name__:
+        curr_plus = PLUS_VALUES.get(card.eff)
+        if curr_plus is not None:
             prev_plus = self.stack[-1]
-            curr_plus =  int(card.eff.__name__[-1])
             #if +2, you can play +2 or +4, but if +4, you must play +4
             return curr_plus >= prev_plus
         #If not a plus card, invalid
         return False
 
+    #fcn to get every move player can make: indexes of the cards valid_move allows (ascending), then DRAW_MOVE
+    #same rules as valid_move, but looked up in the hand's index (see UnoHand) instead of checking every card
+    def legal_moves(self, player=None):
+        if player is None:
+            player = self.turn
+        if self.winner is not None:
+            return []
+        hand = self.player_hands[player]
+        if not isinstance(hand, UnoHand):
+            #hands set from outside (eg set_state) are plain lists
+            hand = self.player_hands[player] = UnoHand(hand)
+        moves = hand.legal_moves(self.current_card, self.stack)
+        moves.append(DRAW_MOVE)
+        return moves
+
     def requires_color(self, index):
         #check if playing card would require user to pick color
         return 0 <= index < len(self.player_hands[self.turn]) and self.player_hands[self.turn][index].color == ''
@@ -107,7 +145,8 @@ class UnoGame():
     def check_winner(self, player):
         if len(self.player_hands[player]) == 0:
             self.winner = player
-            print(player, " has won!")
+            if self.verbose:
+                print(player, " has won!")
             return True
         return False
 
@@ -141,6 +180,78 @@ class UnoGame():
         ret_dict['player_id'] = player_id # in case someone joins, this lets us assign tid=player_id in server
         return ret_dict
 
+    #compact version of get_player_state for delta updates (see uno_protocol): cards as card codes, other hands as counts
+    def get_sync_state(self, player_id):
+        sync_state = {}
+        sync_state['turn'] = self.turn
+        sync_state['current_card'] = UNKNOWN_CARD_CODE if self.current_card is None else card_to_code(self.current_card)
+        sync_state['stack'] = list(self.stack)
+        sync_state['turn_dir'] = self.turn_dir
+        sync_state['winner'] = -1 if self.winner is None else self.winner
+        sync_state['num_players'] = self.num_players
+        sync_state['player_id'] = player_id
+        sync_state['hand_counts'] = [len(hand) for hand in self.player_hands]
+        sync_state['hand'] = [card_to_code(card) for card in self.player_hands[player_id]]
+        return sync_state
+
+    #what anyone at the table sees (eg spectators): get_sync_state without a hand or player_id
+    def get_public_state(self):
+        public_state = {}
+        public_state['turn'] = self.turn
+        public_state['current_card'] = UNKNOWN_CARD_CODE if self.current_card is None else card_to_code(self.current_card)
+        public_state['stack'] = list(self.stack)
+        public_state['turn_dir'] = self.turn_dir
+        public_state['winner'] = -1 if self.winner is None else self.winner
+        public_state['num_players'] = self.num_players
+        public_state['hand_counts'] = [len(hand) for hand in self.player_hands]
+        return public_state
+
+    #everything needed to carry on the game later: get_sync_state for all players + deck order + deck seed
+    #cards are card codes, see set_snapshot
+    def get_snapshot(self):
+        snapshot = {}
+        snapshot['num_players'] = self.num_players
+        snapshot['turn'] = self.turn
+        snapshot['turn_dir'] = self.turn_dir
+        snapshot['stack'] = list(self.stack)
+        snapshot['chosen_color'] = self.chosen_color
+        snapshot['winner'] = -1 if self.winner is None else self.winner
+        snapshot['current_card'] = UNKNOWN_CARD_CODE if self.current_card is None else card_to_code(self.current_card)
+        snapshot['hands'] = [[card_to_code(card) for card in hand] for hand in self.player_hands]
+        if isinstance(self.deck, CompactUnoDeck):
+            snapshot['deck'] = list(self.deck.cards[self.deck.top:])
+            snapshot['discard'] = list(self.deck.discard_pile)
+        else:
+            snapshot['deck'] = [card_to_code(card) for card in self.deck.cards[self.deck.top:]]
+            snapshot['discard'] = [card_to_code(card) for card in self.deck.discard_pile]
+        snapshot['seed'] = self.deck.seed
+        return snapshot
+
+    #fcn to put the game in the state of a get_snapshot dict, the game then plays on exactly like the one it came from
+    def set_snapshot(self, snapshot):
+        self.num_players = snapshot['num_players']
+        self.turn = snapshot['turn']
+        self.turn_dir = snapshot['turn_dir']
+        self.stack = list(snapshot['stack'])
+        self.chosen_color = snapshot['chosen_color']
+        self.winner = None if snapshot['winner'] == -1 else snapshot['winner']
+        compact = isinstance(self.deck, CompactUnoDeck)
+        #shared cards for a compact game, its own card objects otherwise
+        if compact:
+            to_card = code_to_card
+        else:
+            to_card = lambda code: UnoCard(*CARD_TABLE[code])
+        self.current_card = None if snapshot['current_card'] == UNKNOWN_CARD_CODE else to_card(snapshot['current_card'])
+        self.player_hands = [UnoHand(to_card(code) for code in hand) for hand in snapshot['hands']]
+        if compact:
+            self.deck.cards = array('B', snapshot['deck'])
+            self.deck.discard_pile = array('B', snapshot['discard'])
+        else:
+            self.deck.cards = [to_card(code) for code in snapshot['deck']]
+            self.deck.discard_pile = [to_card(code) for code in snapshot['discard']]
+        self.deck.top = 0
+        self.deck.seed = snapshot['seed']
+
     def __str__(self):
         ret = ""
         for i in range(self.num_players):
@@ -150,24 +261,34 @@ class UnoGame():
         ret += "current card: " + str(self.current_card) + ". Turn: {}".format(self.turn) 
         return ret
 
+#cards are drawn from the front, top is the index of the next card so drawing doesn't copy the rest of the deck
+#each deck shuffles with its own seed (a new one after every shuffle), so the deck order + seed is all it takes to
+#know what it will draw next, eg to restore a game from a snapshot (see uno_log). Seeds come from random, so random.seed still works
 class UnoDeck():
-    def __init__(self):
+    def __init__(self, seed=None):
+        self.seed = random.getrandbits(64) if seed is None else seed
         self.cards = []
+        self.top = 0
         self.discard_pile = []
         self.reset_deck()
 
     def draw(self, n=1):
-        if len(self.cards) < n:
+        if len(self) < n:
             self.return_discard_to_deck()
-        ret = self.cards[:n]
-        self.cards = self.cards[n:]
+        ret = self.cards[self.top:self.top+n]
+        self.top += len(ret)
         return ret
 
     def draw_one(self):
         return self.draw(n=1)[0]
 
     def shuffle(self):
-        random.shuffle(self.cards)
+        #drop the drawn cards first so they don't get shuffled back in
+        self.cards = self.cards[self.top:]
+        self.top = 0
+        rng = random.Random(self.seed)
+        rng.shuffle(self.cards)
+        self.seed = rng.getrandbits(64)
 
     def reset_deck(self, nums=10):
         colors = ['red', 'blue', 'green', 'yellow']
@@ -193,18 +314,75 @@ class UnoDeck():
         self.shuffle()
 
     def return_discard_to_deck(self):
-        self.deck += self.discard_pile
+        self.cards = self.cards[self.top:] + self.discard_pile
+        self.top = 0
         self.discard_pile =  []
         self.shuffle()
 
     def discard(self, card):
+        #a played color change / +4 has the chosen color, it goes back as a black card
+        if card.eff in BLACK_EFFECTS and card.color != '':
+            card = UnoCard(color="black", eff=card.eff)
         self.discard_pile.append(card)
 
+    #number of cards left to draw
+    def __len__(self):
+        return len(self.cards) - self.top
+
     def __str__(self):
-        return str([str(card) for card in self.cards])
+        return str([str(card) for card in self.cards[self.top:]])
+
+#Same as UnoDeck, but the deck and discard pile are arrays of card codes (1B per card instead of a card object)
+#and drawn cards are the shared cards from CARDS, so no card objects are made per game
+class CompactUnoDeck(UnoDeck):
+    def reset_deck(self, nums=10):
+        self.cards = array('B', DECK_CODES)
+        self.top = 0
+        self.discard_pile = array('B')
+        self.shuffle()
+
+    def draw(self, n=1):
+        top = self.top
+        if len(self.cards) - top < n:
+            self.return_discard_to_deck()
+            top = 0
+        codes = self.cards[top:top+n]
+        self.top = top + len(codes)
+        return [CARDS[code] for code in codes]
+
+    def draw_one(self):
+        if self.top >= len(self.cards):
+            self.return_discard_to_deck()
+        self.top += 1
+        return CARDS[self.cards[self.top - 1]]
+
+    #shuffled as a list: random.shuffle swaps items one at a time, which costs more on an array (each item is unboxed/boxed)
+    #same swaps as shuffling the array, so a seed deals the same cards
+    def shuffle(self):
+        cards = self.cards[self.top:].tolist()
+        self.top = 0
+        rng = random.Random(self.seed)
+        rng.shuffle(cards)
+        self.seed = rng.getrandbits(64)
+        self.cards = array('B', cards)
+
+    def return_discard_to_deck(self):
+        self.cards = self.cards[self.top:] + self.discard_pile
+        self.top = 0
+        self.discard_pile = array('B')
+        self.shuffle()
+
+    def discard(self, card):
+        self.discard_pile.append(BASE_CODES[card_to_code(card)])
+
+    def __str__(self):
+        return str([str(CARDS[code]) for code in self.cards[self.top:]])
 
 #encode black cards (any color) as '', and numberless as -1
 class UnoCard():
+    #no __dict__ per card
+    __slots__ = ('color', 'number', 'eff')
+
     def __init__(self, color='unknown', number=-1, eff=no_eff):
         self.set_card(color, number, eff)
 
@@ -230,14 +408,187 @@ class UnoCard():
         else:
             return "black_" + self.eff.__name__
 
+#compact 1B card codes, to send cards without pickling the card objects
+#colored cards: color*13 + kind, where kind is the number (0-9) or 10 + index in COLOR_EFFECTS
+#black cards: 52 + index in BLACK_EFFECTS. Black card after its color was picked: 54 + color*2 + index in BLACK_EFFECTS
+#other players' cards (unknown) are UNKNOWN_CARD_CODE
+CARD_COLORS = ['red', 'yellow', 'green', 'blue']
+COLOR_EFFECTS = [plus_2, turn_reverse, turn_skip]
+BLACK_EFFECTS = [plus_4, change_color]
+UNKNOWN_CARD_CODE = 255
+#code -> (color, number, eff)
+CARD_TABLE = [(color, num, no_eff) if num < 10 else (color, -1, COLOR_EFFECTS[num-10]) for color in CARD_COLORS for num in range(13)]
+CARD_TABLE += [('', -1, eff) for eff in BLACK_EFFECTS]
+CARD_TABLE += [(color, -1, eff) for color in CARD_COLORS for eff in BLACK_EFFECTS]
+#(color, number, eff) -> code
+CARD_CODES = {card: code for code, card in enumerate(CARD_TABLE)}
+
+def card_to_code(card):
+    if card.color == 'unknown':
+        return UNKNOWN_CARD_CODE
+    return CARD_CODES[(card.color, card.number, card.eff)]
+
+#one shared card per code. Cards from code_to_card / CompactUnoDeck are these, so don't change them with set_card
+CARDS = [UnoCard(color, number, eff) for color, number, eff in CARD_TABLE]
+#code -> code of the card as it is in the deck (black cards that got a color go back to black)
+BASE_CODES = [CARD_CODES[('', -1, eff)] if eff in BLACK_EFFECTS else code for code, (color, number, eff) in enumerate(CARD_TABLE)]
+
+def code_to_card(code):
+    if code == UNKNOWN_CARD_CODE:
+        return UnoCard()
+    return CARDS[code]
+
+#codes of a full deck (same cards as UnoDeck.reset_deck), for CompactUnoDeck: numbers once and action cards twice
+#for each color, 4 of each black card. Sorted, decks must start from the same order for a seed to deal the same cards in every process
+#(made from the tables, not from an UnoDeck(): that would shuffle with the global random state on import)
+DECK_CODES = array('B', sorted([code for code, (color, number, eff) in enumerate(CARD_TABLE) if color in CARD_COLORS and eff in COLOR_EFFECTS]*2
+                               + [code for code, (color, number, eff) in enumerate(CARD_TABLE) if color in CARD_COLORS and eff is no_eff]
+                               + [CARD_CODES[('', -1, eff)] for eff in BLACK_EFFECTS]*4))
+
+#a player's hand: a list of cards that also keeps which cards have each color, number and effect
+#so legal_moves only touches the cards it returns
+#HOW IT WORKS:
+# the index is made the first time legal_moves is called on the hand and kept up to date from then on
+#  (hands only checked with valid_move, eg on the server, don't pay for it)
+# each card gets a slot when it comes into the hand, slots only go up along the hand (slots[position] = slot)
+# masks: card color / number / effect (no_eff cards have none) -> bit mask of the slots of the cards with it
+#  (colors are str, numbers int and effects functions, so they can share one dict). The +2 / +4 entries are the plus cards
+# legal_moves ORs the masks valid_move would accept, each bit set is a legal card, its position is where its slot is in slots
+# drawing gives the new cards the next slots, playing one (pop) clears its bits, nothing else moves
+# other ways of changing the hand work too, but drop the index (made again on the next legal_moves)
+#pickles (and copies) as a plain list, UnoGame.legal_moves indexes it again when it needs to
+class UnoHand(list):
+    def __init__(self, cards=()):
+        super().__init__(cards)
+        #None until the hand is indexed
+        self.masks = None
+
+    def reindex(self):
+        self.slots = []
+        self.next_slot = 0
+        self.masks = {}
+        self.add_masks(self)
+
+    #fcn to give cards (just added at the end of the hand) the next slots
+    def add_masks(self, cards):
+        masks = self.masks
+        slots = self.slots
+        slot = self.next_slot
+        for card in cards:
+            bit = 1 << slot
+            masks[card.color] = masks.get(card.color, 0) | bit
+            masks[card.number] = masks.get(card.number, 0) | bit
+            if card.eff is not no_eff:
+                masks[card.eff] = masks.get(card.eff, 0) | bit
+            slots.append(slot)
+            slot += 1
+        self.next_slot = slot
+
+    #fcn to get the positions of the cards valid_move allows on current_card, given the stack (ascending)
+    def legal_moves(self, current_card, stack):
+        if self.masks is None:
+            self.reindex()
+        masks = self.masks
+        if len(stack) > 0:
+            #only +x cards, at least as big as the last one
+            found = masks.get(plus_4, 0)
+            if stack[-1] <= PLUS_VALUES[plus_2]:
+                found |= masks.get(plus_2, 0)
+        else:
+            #color in current color: black ('') is in every color
+            found = masks.get('', 0) | masks.get(current_card.color, 0) | masks.get(current_card.number, 0)
+            if current_card.eff is not no_eff:
+                found |= masks.get(current_card.eff, 0)
+        moves = []
+        slots = self.slots
+        while found:
+            bit = found & -found
+            moves.append(bisect_left(slots, bit.bit_length() - 1))
+            found ^= bit
+        return moves
+
+    def append(self, card):
+        self.extend((card,))
+
+    def extend(self, cards):
+        if self.masks is None:
+            super().extend(cards)
+            return
+        if not isinstance(cards, (list, tuple)):
+            cards = list(cards)
+        super().extend(cards)
+        if self.next_slot >= 2*len(self) + 64:
+            #slots of played cards pile up over a long game, start again from 0
+            self.reindex()
+        else:
+            self.add_masks(cards)
+
+    def __iadd__(self, cards):
+        self.extend(cards)
+        return self
+
+    def pop(self, position=-1):
+        card = super().pop(position)
+        if self.masks is None:
+            return card
+        keep = ~(1 << self.slots.pop(position))
+        masks = self.masks
+        masks[card.color] &= keep
+        masks[card.number] &= keep
+        if card.eff is not no_eff:
+            masks[card.eff] &= keep
+        return card
+
+    def insert(self, position, card):
+        super().insert(position, card)
+        self.drop_index()
+
+    def remove(self, card):
+        super().remove(card)
+        self.drop_index()
+
+    def clear(self):
+        super().clear()
+        self.drop_index()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.drop_index()
+
+    def reverse(self):
+        super().reverse()
+        self.drop_index()
+
+    def __setitem__(self, position, card):
+        super().__setitem__(position, card)
+        self.drop_index()
+
+    def __delitem__(self, position):
+        super().__delitem__(position)
+        self.drop_index()
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self.drop_index()
+        return self
+
+    #fcn to forget the index after a change it doesn't follow, legal_moves makes it again
+    def drop_index(self):
+        self.masks = None
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
 #This is what a single player can see (what is public knowledge + player hand)
 class UnoPlayerView(UnoGame):
     def __init__(self, num_players=1, player_id=1):
-        super().__init__(num_players)
-        #you shouldn't know what's in the deck
-        self.deck = None 
+        super().__init__(num_players, compact=True)
         self.player_id = player_id
 
+    #you shouldn't know what's in the deck, so there is none
+    def new_deck(self, compact):
+        return None
+
     def play_card(self, index, other_info=''):
         print("You can play by sending msg to server!")
 
@@ -248,10 +599,30 @@ class UnoPlayerView(UnoGame):
             print("Not your turn / can't check if someone else's move is valid!")
             return False
 
+    def legal_moves(self, player=None):
+        if (player is None and self.turn == self.player_id) or player == self.player_id:
+            return super().legal_moves(self.player_id)
+        else:
+            print("Not your turn / can't check someone else's moves!")
+            return []
+
     def set_state(self, state_dict):
         for name in state_dict:
             self.__dict__[name] = state_dict[name]
 
+    #set state from a get_sync_state dict
+    def set_sync_state(self, sync_state):
+        self.turn = sync_state['turn']
+        self.current_card = None if sync_state['current_card'] == UNKNOWN_CARD_CODE else code_to_card(sync_state['current_card'])
+        self.stack = list(sync_state['stack'])
+        self.turn_dir = sync_state['turn_dir']
+        self.winner = None if sync_state['winner'] == -1 else sync_state['winner']
+        self.num_players = sync_state['num_players']
+        self.player_id = sync_state['player_id']
+        #other players' hands are placeholder cards, like in get_player_state
+        self.player_hands = [[UnoCard()]*count for count in sync_state['hand_counts']]
+        self.player_hands[self.player_id] = UnoHand(code_to_card(code) for code in sync_state['hand'])
+
     def __str__(self):
         ret = super().__str__()
         ret += '\nYou are player {}'.format(self.player_id)
@@ -0,0 +1,338 @@
+#python UNO/uno_bot.py --games 50
+#python UNO/uno_bot.py --tables 200 --budget 0.05
+#server side uno bots (see UnoServer bots=): a bot only knows what a UnoPlayerView knows (its hand, the other hands' sizes,
+#current card, stack) and picks its move with Monte Carlo rollouts on a process pool
+#HOW IT WORKS:
+# determinize: the cards the bot can't see (deck, discard pile, other hands) are a full deck minus its hand and the current card.
+#  Dealing those at random to the other players (their hand sizes are known) and the rest into the deck gives a game that
+#  could be the real one, made into a compact UnoGame with set_snapshot (one game per pool task, set again for each rollout)
+# rollout: play one of the bot's legal moves in a sampled game, then everyone plays greedy_move until the game is over.
+#  1 if the bot won, 1/num_players if it went on for max_moves, 0 otherwise. The move with the best average is played
+# MonteCarloBots.choose() doesn't block: it sends chunks tasks (rollout_moves) to the pool, each plays rollouts for every
+#  candidate move until the decision's deadline (budget - margin from now). done(move) is called from another thread once
+#  every task is back, or when the budget is up with what came back so far (greedy_move if nothing did)
+#  so a bot answers within budget however many tables there are: with more tables than the pool can keep up with, tasks
+#  start past their deadline and come straight back, and the bots just play greedy
+import os
+import sys
+import time
+import heapq
+import random
+import argparse
+import multiprocessing
+from threading import Thread, Lock, Condition, Event
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append('../')
+from pyserver.UNO.uno import *
+
+#a rollout that goes on for this many moves is a draw
+MAX_ROLLOUT_MOVES = 200
+
+#fcn to count the colored cards of a hand by color
+def color_counts(hand):
+    counts = dict.fromkeys(CARD_COLORS, 0)
+    for card in hand:
+        if card.color in counts:
+            counts[card.color] += 1
+    return counts
+
+#color a bot picks for a black card: the one it has most of
+def favourite_color(hand):
+    counts = color_counts(hand)
+    return max(CARD_COLORS, key=counts.get)
+
+#fcn to pick player's move without looking ahead, returns (index, chosen_color)
+#keeps black cards until nothing else can be played, plays action cards before numbers, and the color it has most of
+def greedy_move(game, player=None):
+    if player is None:
+        player = game.turn
+    hand = game.player_hands[player]
+    counts = color_counts(hand)
+    best = DRAW_MOVE
+    best_score = None
+    for index in game.legal_moves(player)[:-1]:
+        card = hand[index]
+        score = (card.color != '', card.eff is not no_eff, counts.get(card.color, 0))
+        if best_score is None or score > best_score:
+            best = index
+            best_score = score
+    if best != DRAW_MOVE and hand[best].color == '':
+        return best, max(CARD_COLORS, key=counts.get)
+    return best, ''
+
+#fcn to get the moves a bot looks at: every legal card (black ones with its favourite color) and drawing
+def candidate_moves(view):
+    hand = view.player_hands[view.player_id]
+    color = favourite_color(hand)
+    return [(index, color if index != DRAW_MOVE and hand[index].color == '' else '') for index in view.legal_moves()]
+
+#fcn to get the codes of the cards a sync state (get_sync_state) doesn't show: a full deck minus the hand and current card
+def unseen_codes(sync_state):
+    counts = [0]*len(CARD_TABLE)
+    for code in DECK_CODES:
+        counts[code] += 1
+    for code in sync_state['hand']:
+        counts[code] -= 1
+    if sync_state['current_card'] != UNKNOWN_CARD_CODE:
+        counts[BASE_CODES[sync_state['current_card']]] -= 1
+    return [code for code, count in enumerate(counts) for i in range(count)]
+
+#fcn to put game in a random state that matches sync_state, unseen (see unseen_codes) is shuffled in place
+def determinize(game, sync_state, unseen, rng):
+    rng.shuffle(unseen)
+    hands = []
+    dealt = 0
+    for seat, count in enumerate(sync_state['hand_counts']):
+        if seat == sync_state['player_id']:
+            hands.append(sync_state['hand'])
+        else:
+            hands.append(unseen[dealt:dealt + count])
+            dealt += count
+    game.set_snapshot({'num_players': sync_state['num_players'], 'turn': sync_state['turn'], 'turn_dir': sync_state['turn_dir'],
+                       'stack': sync_state['stack'], 'chosen_color': '', 'winner': -1, 'current_card': sync_state['current_card'],
+                       'hands': hands, 'deck': unseen[dealt:], 'discard': [], 'seed': rng.getrandbits(64)})
+
+#fcn to play game out with greedy_move, returns what it is worth to player
+def playout(game, player, max_moves):
+    moves = 0
+    while game.winner is None and moves < max_moves:
+        index, color = greedy_move(game)
+        game.play_card(index, other_info=color)
+        moves += 1
+    if game.winner is None:
+        return 1 / game.num_players
+    return 1.0 if game.winner == player else 0.0
+
+#pool task: rollouts of each move in moves ((index, chosen_color) pairs) in turn from sync_state until deadline (time.time())
+#returns [total score, rollouts] for each move
+def rollout_moves(sync_state, moves, deadline, seed, max_moves=MAX_ROLLOUT_MOVES):
+    stats = [[0.0, 0] for move in moves]
+    if time.time() >= deadline:
+        #waited in the pool's queue past the decision's budget
+        return stats
+    rng = random.Random(seed)
+    unseen = unseen_codes(sync_state)
+    player = sync_state['player_id']
+    game = UnoGame(sync_state['num_players'], compact=True)
+    game.verbose = False
+    i = rng.randrange(len(moves))
+    while time.time() < deadline:
+        determinize(game, sync_state, unseen, rng)
+        index, color = moves[i]
+        game.play_card(index, other_info=color)
+        stats[i][0] += playout(game, player, max_moves)
+        stats[i][1] += 1
+        i = (i + 1) % len(moves)
+    return stats
+
+#pool task that does nothing, so workers have this module imported before the first decision
+def warm_up():
+    return os.getpid()
+
+#one move being picked: adds up the tasks' results, done() is called once with the best move
+class Decision:
+    def __init__(self, bots, moves, fallback, done, pending):
+        self.bots = bots
+        self.moves = moves
+        self.fallback = fallback
+        self.done = done
+        #tasks not back yet
+        self.pending = pending
+        self.futures = []
+        self.scores = [0.0]*len(moves)
+        self.rollouts = [0]*len(moves)
+        self.finished = False
+        self.lock = Lock()
+
+    #future done callback (runs in the pool's thread)
+    def add(self, future):
+        if future.cancelled():
+            return
+        try:
+            stats = future.result()
+        except Exception:
+            #eg the pool broke, the deadline still answers
+            stats = ()
+        with self.lock:
+            if self.finished:
+                return
+            for i, (score, rollouts) in enumerate(stats):
+                self.scores[i] += score
+                self.rollouts[i] += rollouts
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self.finish()
+
+    #fcn to call done with the best move so far, only the first call does anything
+    def finish(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        for future in self.futures:
+            future.cancel()
+        rollouts = sum(self.rollouts)
+        if rollouts == 0:
+            move = self.fallback
+        else:
+            best = max((i for i in range(len(self.moves)) if self.rollouts[i] > 0), key=lambda i: self.scores[i] / self.rollouts[i])
+            move = self.moves[best]
+        self.bots.record(rollouts)
+        self.done({'index': move[0], 'chosen_color': move[1]})
+
+#Monte Carlo move picking for any number of bots, see HOW IT WORKS
+#budget: seconds from choose() to done(). margin: how much of it is left for the tasks' results to come back
+#chunks: tasks per decision (default one per process)
+class MonteCarloBots:
+    def __init__(self, num_procs=None, budget=0.05, margin=None, chunks=None, max_moves=MAX_ROLLOUT_MOVES):
+        self.num_procs = num_procs or os.cpu_count() or 1
+        self.budget = budget
+        self.margin = budget / 5 if margin is None else margin
+        self.chunks = self.num_procs if chunks is None else chunks
+        self.max_moves = max_moves
+        #spawn: a server has threads running, a forked worker could start with one of their locks held
+        self.pool = ProcessPoolExecutor(self.num_procs, mp_context=multiprocessing.get_context('spawn'))
+        #start the workers now, starting one takes much longer than a budget
+        for future in [self.pool.submit(warm_up) for i in range(self.num_procs)]:
+            future.result()
+        #(monotonic deadline, n, Decision) for decisions that haven't hit their budget yet
+        self.deadlines = []
+        self.next_n = 0
+        self.cond = Condition()
+        self.running = True
+        #decisions made, how many that had a choice got no rollouts back in time (played greedy_move), rollouts played
+        self.decisions = 0
+        self.fallbacks = 0
+        self.rollouts = 0
+        self.stats_lock = Lock()
+        self.deadline_thread = Thread(target=self.thread_for_deadlines, daemon=True)
+        self.deadline_thread.start()
+
+    #fcn to pick a move for the player whose view sync_state is (get_sync_state), it has to be their turn
+    #done(move) is called with a MOVE_CODE dict ({'index', 'chosen_color'}) within budget, from another thread
+    #(or right away, when there is only one move)
+    def choose(self, sync_state, done):
+        view = UnoPlayerView()
+        view.set_sync_state(sync_state)
+        moves = candidate_moves(view)
+        if len(moves) == 1:
+            self.record(0, searched=False)
+            done({'index': moves[0][0], 'chosen_color': moves[0][1]})
+            return
+        decision = Decision(self, moves, greedy_move(view, view.player_id), done, self.chunks)
+        deadline = time.time() + self.budget - self.margin
+        with self.cond:
+            #half the margin early, so done() itself is in budget too when lots of decisions finish at once
+            heapq.heappush(self.deadlines, (time.monotonic() + self.budget - self.margin / 2, self.next_n, decision))
+            self.next_n += 1
+            self.cond.notify()
+        for chunk in range(self.chunks):
+            future = self.pool.submit(rollout_moves, sync_state, moves, deadline, random.getrandbits(64), self.max_moves)
+            decision.futures.append(future)
+            future.add_done_callback(decision.add)
+
+    #finishes decisions whose budget is up
+    def thread_for_deadlines(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    break
+                if not self.deadlines:
+                    self.cond.wait()
+                    continue
+                wait = self.deadlines[0][0] - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                decision = heapq.heappop(self.deadlines)[2]
+            decision.finish()
+
+    def record(self, rollouts, searched=True):
+        with self.stats_lock:
+            self.decisions += 1
+            self.rollouts += rollouts
+            if searched and rollouts == 0:
+                self.fallbacks += 1
+
+    def stats(self):
+        with self.stats_lock:
+            return {'decisions': self.decisions, 'fallbacks': self.fallbacks, 'rollouts': self.rollouts}
+
+    #decisions still waiting never get their done call
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+#fcn to play games of one Monte Carlo bot (seat 0) against greedy_move players, returns the bot's wins and decision times
+def play_games(bots, num_games, num_players):
+    wins = 0
+    latencies = []
+    for i in range(num_games):
+        game = UnoGame(num_players, compact=True)
+        game.verbose = False
+        game.start()
+        while game.winner is None:
+            if game.turn == 0:
+                answer = []
+                answered = Event()
+                start = time.perf_counter()
+                bots.choose(game.get_sync_state(0), lambda move: (answer.append(move), answered.set()))
+                answered.wait()
+                latencies.append(time.perf_counter() - start)
+                move = answer[0]
+                game.play_card(move['index'], other_info=move['chosen_color'])
+            else:
+                index, color = greedy_move(game)
+                game.play_card(index, other_info=color)
+        wins += game.winner == 0
+    return wins, latencies
+
+#fcn to ask for a move at num_tables tables at once, returns the decision times
+def play_tables(bots, num_tables, num_players):
+    latencies = []
+    lock = Lock()
+    all_done = Event()
+    games = []
+    for i in range(num_tables):
+        game = UnoGame(num_players, compact=True)
+        game.verbose = False
+        game.start()
+        games.append(game)
+    def answered(start, move):
+        with lock:
+            latencies.append(time.perf_counter() - start)
+            if len(latencies) == num_tables:
+                all_done.set()
+    for game in games:
+        start = time.perf_counter()
+        bots.choose(game.get_sync_state(game.turn), lambda move, start=start: answered(start, move))
+    all_done.wait()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo uno bots: win rate against greedy players, and decision times")
+    parser.add_argument('--games', type=int, default=20, help="games of one bot against greedy players")
+    parser.add_argument('--tables', type=int, default=0, help="instead of games, ask for a move at this many tables at once")
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--budget', type=float, default=0.05, help="seconds per move")
+    parser.add_argument('--procs', type=int, default=None, help="pool processes (default: cpu count)")
+    args = parser.parse_args()
+
+    bots = MonteCarloBots(num_procs=args.procs, budget=args.budget)
+    if args.tables > 0:
+        latencies = play_tables(bots, args.tables, args.players)
+    else:
+        wins, latencies = play_games(bots, args.games, args.players)
+        print("bot won {}/{} games against {} greedy players ({:.0f}% at random)".format(wins, args.games, args.players - 1, 100 / args.players))
+    latencies.sort()
+    stats = bots.stats()
+    print("{} decisions: p50 {:.1f} ms  p99 {:.1f} ms  max {:.1f} ms (budget {:.0f} ms)".format(len(latencies),
+        latencies[len(latencies)//2]*1e3, latencies[min(len(latencies) - 1, int(len(latencies)*0.99))]*1e3, latencies[-1]*1e3, args.budget*1e3))
+    print("{} rollouts, {} decisions played greedy (no rollouts back in time)".format(stats['rollouts'], stats['fallbacks']))
+    bots.close()
+
+if __name__ == "__main__":
+    main()
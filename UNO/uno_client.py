@@ -5,44 +5,110 @@ import sys
 sys.path.append('../')
 from pyserver.GenericServer import *
 from pyserver.GenericClient import *
+from pyserver.GenericAsyncClient import *
 from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
 
 
-class UnoClient(GenericHeader, GenericClient):
+#uno side of a client: game state, handlers and requests. The connection comes from the client class it's mixed with:
+#UnoClient (GenericClient, a receiver thread) or AsyncUnoClient (GenericAsyncClient, a task on an asyncio loop)
+class UnoPlayer(GenericHeader):
     def __init__(self, host, port, debug=False):
         super().__init__(host, port, debug=debug)
         self.uno_game = uno.UnoPlayerView()
-        #init_player_code = 1 #when player first connects to server, they use header=init_player_code
-        recv_state_update_code = 2 #client receives msg with uno state
-        #player_move_code = 3 #when player makes a move, use header=player_move_code
-        codes = [recv_state_update_code]
-        fcns = [self.update_client_state]
-        self.set_header(codes=codes, fcns=fcns)
+        self.set_header()
+        set_uno_serializers(self)
+        #state versions the server may send deltas against
+        self.sync = ClientSync()
+        #room + seat the server gave us (seat is our player_id), -1 if not in one yet
+        self.room_id = -1
+        self.seat = -1
+        #last room list from list_rooms
+        self.rooms = []
+        #room_id -> last public state of rooms we spectate (see spectate)
+        self.watched = {}
         self.last_uno_update = 0 #only for uno updates
         self.last_receive = 0 #for any msgs received
 
-        
+    @header_code(STATE_CODE)
     def update_client_state(self, data):
         #Server sends us the new state
-        new_state = self.bytestring_to_obj(data)
+        new_state = self.bytestring_to_obj(data, STATE_CODE)
         self.uno_game.set_state(new_state)
         self.last_uno_update = time.time()
         #self.dprint("received state update from server:", new_state)
 
+    @header_code(DELTA_CODE)
+    def update_client_delta(self, data):
+        #Server sends us what changed since a version we acked
+        delta = self.bytestring_to_obj(data, DELTA_CODE)
+        sync_state = self.sync.apply(delta)
+        if sync_state is None:
+            self.dprint("missing base state version", delta['base'], "asking for a resync")
+            self.init_uno()
+            return
+        self.uno_game.set_sync_state(sync_state)
+        self.send_message({'version': delta['version']}, header=ACK_CODE, pickle=True)
+        self.last_uno_update = time.time()
+
+    #server seated us (or seat=-1 if the join failed)
+    @header_code(JOIN_ROOM_CODE)
+    def update_room(self, data):
+        room = self.bytestring_to_obj(data, JOIN_ROOM_CODE)
+        if room['seat'] == -1:
+            self.dprint("could not join room", room['room_id'])
+            return
+        self.room_id = room['room_id']
+        self.seat = room['seat']
+
+    @header_code(LIST_ROOMS_CODE)
+    def update_rooms(self, data):
+        self.rooms = self.bytestring_to_obj(data, LIST_ROOMS_CODE)['rooms']
+
+    #a room we spectate changed
+    @header_code(PUBLIC_STATE_CODE)
+    def update_public_state(self, data):
+        public_state = self.bytestring_to_obj(data, PUBLIC_STATE_CODE)
+        self.watched[public_state['room_id']] = public_state
+
     #current player will send move, we play it on server, and send everyone an update
     def parse_message(self, data):
         decoded, header, msg = self.decode(data)
         if not decoded:
-            self.dprint("Unable to decode msg: {}|{}".format(header, msg))
+            self.dprint("Unable to decode msg:", header, msg)
         self.last_receive = time.time()
 
+    #these send requests: each returns a Future that completes once the server's reply was handled (see GenericClient.send_message)
     #send init_player_code
     def init_uno(self):
-        self.send_message("Init message", header=1, pickle=False)
+        return self.send_message("Init message", header=INIT_PLAYER_CODE, pickle=False, request=True)
+
+    #new room for num_players, we get seated in it
+    def create_room(self, num_players):
+        return self.send_message({'num_players': num_players}, header=CREATE_ROOM_CODE, pickle=True, request=True)
+
+    #room_id=-1 to join any open room
+    def join_room(self, room_id=-1):
+        return self.send_message({'room_id': room_id, 'seat': -1}, header=JOIN_ROOM_CODE, pickle=True, request=True)
 
+    def list_rooms(self):
+        return self.send_message("", header=LIST_ROOMS_CODE, pickle=False, request=True)
+
+    #watch room_id's game without playing in it, its public state ends up in self.watched[room_id]
+    def spectate(self, room_id):
+        return self.subscribe(room_topic(room_id))
+
+    def stop_spectating(self, room_id):
+        self.watched.pop(room_id, None)
+        return self.unsubscribe(room_topic(room_id))
+
+    #reply is our state after the move, or the reason it was refused (+ a resync)
+    #chosen_color is checked here, MOVE_SERIALIZER can only send MOVE_COLORS
     def send_move(self, index, chosen_color=''):
+        if chosen_color not in MOVE_COLORS:
+            raise ValueError("chosen_color must be one of {}, not {!r}".format(MOVE_COLORS, chosen_color))
         move_dict = {'index': index, 'chosen_color': chosen_color}
-        self.send_message(move_dict, header=3, pickle=True)        
+        return self.send_message(move_dict, header=MOVE_CODE, pickle=True, request=True)
 
     def my_turn(self):
         return self.uno_game.turn == self.uno_game.player_id
@@ -53,44 +119,61 @@ class UnoClient(GenericHeader, GenericClient):
     def client_updated(self):
         return self.last_receive >= self.last_send
 
+    #fcn to block until the game state changed after our last message (or timeout), returns uno_updated()
+    #(AsyncUnoClient: await it)
+    def wait_for_update(self, timeout=None):
+        return self.wait_for(self.uno_updated, timeout)
+
+    #fcn to block until it's our turn or the game is over (or timeout)
+    def wait_for_turn(self, timeout=None):
+        return self.wait_for(lambda: self.uno_game.winner is not None or self.my_turn(), timeout)
+
+class UnoClient(UnoPlayer, GenericClient):
+    pass
+
+#for running lots of players from one thread, eg bots:
+#   client = AsyncUnoClient(host, port); await client.connect(); await client.init_uno(); await client.wait_for_turn()
+class AsyncUnoClient(UnoPlayer, GenericAsyncClient):
+    pass
+
 def main():
     host = '127.0.0.1'
     port = 1019
     client = UnoClient(host, port, debug=True)    
     client.run()    
     print("Client initiated!")
-    #initialise state
+    #initialise state, game starts once the room is full
     client.init_uno()
-    while client.last_uno_update is None:
-        time.sleep(0.1)
+    client.wait_for(lambda: client.last_uno_update > 0)
     print("Uno game init!")
     
     #play until winner
     color = ''
-    while client.uno_game.winner is None:
-        if client.client_updated():
-            #print("client_updated!") #could be 1. your move was invalid or 2. your next move
-            if client.my_turn():
-                invalid_move = True
-                while invalid_move:
-                    #prompt user for move + send when applicable.
-                    print(client.uno_game)
-                    ind = int(input("index?"))
-                    if client.uno_game.requires_color(ind):
-                        color = input("color ('red', 'blue', 'green', 'yellow')?")
-                    if client.uno_game.valid_move(ind, other_info=color):
-                        #client.uno_game.play_card(ind)
-                        print("Sending move: ", ind, color)
-                        client.send_move(ind, color)
-                        ind = 0
-                        color = ''
-                        invalid_move = False
-                    else:
-                        print("invalid move. try again")
+    while client.running and client.uno_game.winner is None:
+        #blocks until the server's update says it's our turn
+        if not client.wait_for_turn():
+            continue
+        if client.uno_game.winner is not None:
+            break
+        invalid_move = True
+        while invalid_move:
+            #prompt user for move + send when applicable.
+            print(client.uno_game)
+            ind = int(input("index?"))
+            if client.uno_game.requires_color(ind):
+                color = input("color ('red', 'blue', 'green', 'yellow')?")
+                while color not in uno.CARD_COLORS:
+                    color = input("not a color. color ('red', 'blue', 'green', 'yellow')?")
+            if client.uno_game.valid_move(ind, other_info=color):
+                #client.uno_game.play_card(ind)
+                print("Sending move: ", ind, color)
+                #wait for the server's answer, our state is up to date after it
+                client.send_move(ind, color).result()
+                ind = 0
+                color = ''
+                invalid_move = False
             else:
-                print(".",end="")    
-            
-        time.sleep(0.1)
+                print("invalid move. try again")
 
     print("{} has won!".format(client.uno_game.winner))
     client.end()
@@ -0,0 +1,234 @@
+#move log for UnoServer: games in progress survive a restart
+import os
+import sys
+import mmap
+import zlib
+import time
+from threading import Thread, Condition
+sys.path.append('../')
+from pyserver.GenericServer import *
+from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
+from pyserver.UNO.uno_rooms import *
+
+#MoveLog: append only log of what happened to each room's game, replayed when the server starts again
+#HOW IT WORKS:
+# records are: a snapshot of a room's game (UnoGame.get_snapshot, deck order + seed included), a move that was accepted
+#  (the MOVE_CODE dict update_state got) or the room closing. They are numbered per room by room.moves
+# the room's worker adds them (so they are in game order), a writer thread writes whatever came in since the last write
+#  and fsyncs once for all of it (every sync_interval seconds at most), so moves don't wait on the disk
+#  NOTE: a crash can lose the moves of the last sync_interval seconds, the games go back to just before them
+# a room is snapshotted when its game starts and every snapshot_every moves, so replaying a game never takes more moves than that
+# once the log is bigger than checkpoint_size, the writer writes path.snap: the last snapshot of each room + the moves since,
+#  and empties the log. Recovery memory maps path.snap, then reads path.log (the tail) on top of it
+# each record is [4B size][4B crc32][1B kind][4B room_id][4B seq][data], a record cut short by a crash ends the log there
+SNAPSHOT_RECORD = 0
+MOVE_RECORD = 1
+CLOSE_RECORD = 2
+
+#UnoGame.get_snapshot + the room it's in
+SNAPSHOT_SERIALIZER = StructSerializer([
+    ('num_players', 'B'),
+    ('turn', 'B'),
+    ('turn_dir', 'b'),
+    ('stack', ListField('B', 'B')),
+    ('chosen_color', EnumField([''] + uno.CARD_COLORS)),
+    ('winner', 'b'),
+    ('current_card', 'B'),
+    ('hands', ListField(ListField('B'), 'B')),
+    ('deck', ListField('B')),
+    ('discard', ListField('B')),
+    ('seed', 'Q'),
+])
+
+class MoveLog:
+    record_head = struct.Struct("!IIBII")
+    #kind, room_id, seq: the part of the head the crc covers
+    record_key = struct.Struct("!BII")
+
+    def __init__(self, path, sync_interval=0.05, snapshot_every=64, checkpoint_size=1 << 20):
+        self.log_path = path + '.log'
+        self.snap_path = path + '.snap'
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.checkpoint_size = checkpoint_size
+        #biggest room_id in the files, new rooms get ids after it
+        self.last_room_id = -1
+        #room_id -> records since (and including) its last snapshot, what the next checkpoint writes. Writer thread only
+        #starts out with what is in the files, see recover
+        self.rooms = self.recover()
+        #records not written yet
+        self.records = []
+        self.cond = Condition()
+        self.running = True
+        self.file = open(self.log_path, 'ab')
+        self.thread = Thread(target=self.thread_for_writer, daemon=True)
+        self.thread.start()
+
+    #fcn to log a snapshot of room's game. Call from the room's worker (or before the room is shared)
+    def log_snapshot(self, room):
+        data = SNAPSHOT_SERIALIZER.dumps(room.uno_game.get_snapshot())
+        self.add(SNAPSHOT_RECORD, room.room_id, room.moves, data)
+
+    #fcn to log a move just played in room (room.moves already counts it), snapshots the room every snapshot_every moves
+    def log_move(self, room, move):
+        self.add(MOVE_RECORD, room.room_id, room.moves, MOVE_SERIALIZER.dumps(move))
+        if room.moves % self.snapshot_every == 0:
+            self.log_snapshot(room)
+
+    #fcn to log that room is gone, recovery won't bring it back
+    def log_close(self, room_id):
+        self.add(CLOSE_RECORD, room_id, 0, b'')
+
+    def add(self, kind, room_id, seq, data):
+        key = self.record_key.pack(kind, room_id, seq)
+        head = self.record_head.pack(len(data) + self.record_key.size, zlib.crc32(data, zlib.crc32(key)), kind, room_id, seq)
+        with self.cond:
+            if not self.running:
+                return
+            self.records.append((kind, room_id, head + data))
+            if len(self.records) == 1:
+                self.cond.notify()
+
+    def thread_for_writer(self):
+        last_sync = 0
+        while True:
+            with self.cond:
+                while self.running and len(self.records) == 0:
+                    self.cond.wait()
+                if not self.running and len(self.records) == 0:
+                    break
+            #let a few more records come in, so one fsync covers them all
+            wait = last_sync + self.sync_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            with self.cond:
+                records = self.records
+                self.records = []
+            self.file.write(b''.join(record for kind, room_id, record in records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            last_sync = time.monotonic()
+            for kind, room_id, record in records:
+                if kind == SNAPSHOT_RECORD:
+                    self.rooms[room_id] = [record]
+                elif kind == MOVE_RECORD and room_id in self.rooms:
+                    self.rooms[room_id].append(record)
+                elif kind == CLOSE_RECORD:
+                    self.rooms.pop(room_id, None)
+            if self.file.tell() >= self.checkpoint_size:
+                self.checkpoint()
+        self.checkpoint()
+        self.file.close()
+
+    #fcn to write path.snap from the rooms' records and empty the log, writer thread only
+    #the new snap file replaces the old one in one rename, so a crash leaves one or the other
+    def checkpoint(self):
+        tmp_path = self.snap_path + '.tmp'
+        with open(tmp_path, 'wb') as snap_file:
+            snap_file.write(b''.join(record for records in self.rooms.values() for record in records))
+            snap_file.flush()
+            os.fsync(snap_file.fileno())
+        os.replace(tmp_path, self.snap_path)
+        sync_dir(self.snap_path)
+        #a crash before this leaves records in the log that are in the snap file too, recovery skips those
+        self.file.truncate(0)
+        self.file.seek(0)
+        os.fsync(self.file.fileno())
+
+    #fcn to read the files back, returns room_id -> [snapshot record, move records after it] of the rooms still open
+    #the log is cut after its last whole record
+    def recover(self):
+        rooms = {}
+        closed = set()
+        self.read_records(self.snap_path, rooms, closed)
+        end = self.read_records(self.log_path, rooms, closed)
+        if end is not None and end < os.path.getsize(self.log_path):
+            #record cut short by a crash, new records go after the last whole one
+            with open(self.log_path, 'r+b') as log_file:
+                log_file.truncate(end)
+        return rooms
+
+    #fcn to add the records of one file to rooms, returns where the last whole record ends (None if there is no file)
+    def read_records(self, path, rooms, closed):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return self.read_buffer(mm, size, rooms, closed)
+
+    def read_buffer(self, buffer, size, rooms, closed):
+        head_size = self.record_head.size
+        key_size = self.record_key.size
+        offset = 0
+        with memoryview(buffer) as view:
+            while offset + head_size <= size:
+                length, crc, kind, room_id, seq = self.record_head.unpack_from(buffer, offset)
+                end = offset + 8 + length
+                if length < key_size or end > size or zlib.crc32(view[offset + 8:end]) != crc:
+                    break
+                self.last_room_id = max(self.last_room_id, room_id)
+                records = rooms.get(room_id)
+                if kind == CLOSE_RECORD:
+                    rooms.pop(room_id, None)
+                    closed.add(room_id)
+                elif room_id in closed:
+                    pass
+                elif kind == SNAPSHOT_RECORD:
+                    #snapshots only move forwards (the log can repeat what the snap file has)
+                    if records is None or seq > self.record_seq(records[0]):
+                        rooms[room_id] = [bytes(view[offset:end])]
+                elif kind == MOVE_RECORD and records is not None and seq == self.record_seq(records[0]) + len(records):
+                    records.append(bytes(view[offset:end]))
+                offset = end
+        return offset
+
+    def record_seq(self, record):
+        return self.record_head.unpack_from(record)[4]
+
+    #fcn to rebuild the rooms that were open: their games are where they were, nobody is seated yet
+    #only call it before logging anything, it reads what recover found
+    def restore_rooms(self, verbose=False):
+        return [self.restore_room(records, verbose) for room_id, records in sorted(self.rooms.items())]
+
+    #fcn to build a room from its last snapshot record + the move records after it
+    def restore_room(self, records, verbose=False):
+        head_size = self.record_head.size
+        length, crc, kind, room_id, seq = self.record_head.unpack_from(records[0])
+        snapshot = SNAPSHOT_SERIALIZER.loads(records[0][head_size:])
+        room = UnoRoom(room_id, snapshot['num_players'], verbose=verbose)
+        uno_game = room.uno_game
+        uno_game.set_snapshot(snapshot)
+        room.started = True
+        room.moves = seq
+        for record in records[1:]:
+            move = MOVE_SERIALIZER.loads(record[head_size:])
+            #moves were checked with valid_move when they were played, and the game plays them the same way again
+            uno_game.play_card(move['index'], other_info=move['chosen_color'])
+            room.moves += 1
+        return room
+
+    #fcn to write everything logged so far and stop, can be called multiple times without error
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+#fcn to make a rename in path's directory stick after a crash (not possible on every OS)
+def sync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,224 @@
+#header codes and serializers shared by UnoServer and UnoClient
+import sys
+sys.path.append('../')
+from pyserver.GenericServer import *
+from pyserver.UNO import uno
+
+INIT_PLAYER_CODE = 1 #when player first connects to server, they use header=INIT_PLAYER_CODE
+STATE_CODE = 2 #client receives msg with uno state
+MOVE_CODE = 3 #when player makes a move, use header=MOVE_CODE
+DELTA_CODE = 4 #client receives the state changes since the version it acked (or a full snapshot)
+ACK_CODE = 5 #client tells server which state version it has
+CREATE_ROOM_CODE = 6 #client asks for a new room (table), server replies with JOIN_ROOM_CODE once it is seated
+JOIN_ROOM_CODE = 7 #client asks to sit in a room (room_id=-1 for any open room), server replies with room_id + seat (seat=-1 if it failed)
+LIST_ROOMS_CODE = 8 #client asks for the rooms, server replies with a list of room infos
+PUBLIC_STATE_CODE = 9 #server publishes a room's public state to the clients spectating it (subscribed to room_topic)
+
+#topic (see GenericServer TOPICS) a room's public state is published on: ROOM_TOPIC + room_id
+ROOM_TOPIC = "room/"
+
+def room_topic(room_id):
+    return ROOM_TOPIC + str(room_id)
+
+#UnoCard as its 1B card code
+class CardField:
+    def pack(self, card, out):
+        out.append(uno.card_to_code(card))
+
+    def unpack(self, buffer, offset):
+        return uno.code_to_card(buffer[offset]), offset + 1
+
+    #hands are sent as a run of card codes
+    def pack_many(self, cards, out):
+        out += bytes([uno.card_to_code(card) for card in cards])
+
+    def unpack_many(self, buffer, offset, n):
+        codes = buffer[offset:offset + n]
+        if len(codes) != n:
+            raise ValueError("CardField: hand cut short")
+        if n > 0 and codes[0] == uno.UNKNOWN_CARD_CODE and codes.count(uno.UNKNOWN_CARD_CODE) == n:
+            #someone else's hand, one placeholder card for all of it (same as get_player_state does)
+            return [uno.UnoCard()]*n, offset + n
+        return [uno.code_to_card(code) for code in codes], offset + n
+
+#chosen_color values a move can carry
+MOVE_COLORS = ['', 'draw'] + uno.CARD_COLORS
+
+#{'index', 'chosen_color'} from UnoClient.send_move
+MOVE_SERIALIZER = StructSerializer([
+    ('index', 'h'),
+    ('chosen_color', EnumField(MOVE_COLORS)),
+])
+
+#UnoGame.get_player_state
+STATE_SERIALIZER = StructSerializer([
+    ('turn', 'B'),
+    ('current_card', OptionalField(CardField())),
+    ('stack', ListField('B')),
+    ('turn_dir', 'b'),
+    ('winner', OptionalField('B')),
+    ('num_players', 'B'),
+    ('player_hands', ListField(ListField(CardField()))),
+    ('player_id', 'B'),
+])
+
+#DELTA STATE UPDATES:
+# server keeps the states (UnoGame.get_sync_state) it sent to each client by version, client acks each version it gets
+# the next update only has what changed since the last acked version: changed fields (None = same), changed hand counts,
+# and the client's own hand as removed indexes + added cards. base=-1 means a full snapshot (on join / resync)
+# client keeps its states by version too, so it can apply a delta to whichever version it was made against
+SYNC_FIELDS = ['turn', 'current_card', 'stack', 'turn_dir', 'winner', 'num_players', 'player_id']
+
+DELTA_SERIALIZER = StructSerializer([
+    ('version', 'I'),
+    ('base', 'i'),
+    ('turn', OptionalField('B')),
+    ('current_card', OptionalField('B')),
+    ('stack', OptionalField(ListField('B', 'B'))),
+    ('turn_dir', OptionalField('b')),
+    ('winner', OptionalField('b')),
+    ('num_players', OptionalField('B')),
+    ('player_id', OptionalField('B')),
+    ('count_players', ListField('B', 'B')),
+    ('count_values', ListField('H', 'B')),
+    ('removed', ListField('H', 'B')),
+    ('added', ListField('B', 'H')),
+])
+
+ACK_SERIALIZER = StructSerializer([('version', 'I')])
+
+#ROOMS (see uno_rooms): {'num_players'} to create, {'room_id', 'seat'} both ways to join
+CREATE_ROOM_SERIALIZER = StructSerializer([('num_players', 'B')])
+ROOM_SERIALIZER = StructSerializer([('room_id', 'i'), ('seat', 'b')])
+#UnoRoom.info for each room. Request is an empty dict
+ROOM_LIST_SERIALIZER = StructSerializer([
+    ('rooms', ListField(StructSerializer([
+        ('room_id', 'i'),
+        ('num_players', 'B'),
+        ('seated', 'B'),
+        ('started', '?'),
+        ('bots', 'B'),
+    ]), 'I')),
+])
+
+#UnoGame.get_public_state + the room it is and moves played so far. A whole state every time (no deltas),
+#so one encoded message does for every spectator
+PUBLIC_STATE_SERIALIZER = StructSerializer([
+    ('room_id', 'i'),
+    ('moves', 'I'),
+    ('turn', 'B'),
+    ('current_card', 'B'),
+    ('stack', ListField('B', 'B')),
+    ('turn_dir', 'b'),
+    ('winner', 'b'),
+    ('num_players', 'B'),
+    ('hand_counts', ListField('B', 'B')),
+])
+
+#fcn to make a delta from base to state (base None for a full snapshot)
+def make_delta(base, state, version, base_version=-1):
+    if base is None:
+        base_version = -1
+    delta = {'version': version, 'base': base_version}
+    for key in SYNC_FIELDS:
+        delta[key] = state[key] if base is None or state[key] != base[key] else None
+    counts = state['hand_counts']
+    base_counts = [] if base is None else base['hand_counts']
+    changed = [i for i in range(len(counts)) if i >= len(base_counts) or counts[i] != base_counts[i]]
+    delta['count_players'] = changed
+    delta['count_values'] = [counts[i] for i in changed]
+    delta['removed'], delta['added'] = diff_hand([] if base is None else base['hand'], state['hand'])
+    return delta
+
+#fcn to get (removed indexes, added cards) that turn hand base into hand. Cards are only ever popped or appended,
+#so keep the longest run of base that lines up with the start of hand, and append the rest
+def diff_hand(base, hand):
+    removed = []
+    j = 0
+    for i, card in enumerate(base):
+        if j < len(hand) and hand[j] == card:
+            j += 1
+        else:
+            removed.append(i)
+    return removed, hand[j:]
+
+#fcn to apply a delta to base (None for a snapshot), returns the new state
+def apply_delta(base, delta):
+    state = {} if base is None else dict(base)
+    for key in SYNC_FIELDS:
+        if delta[key] is not None:
+            state[key] = delta[key]
+    counts = [] if base is None else list(base['hand_counts'])
+    counts = counts[:state['num_players']] + [0]*(state['num_players'] - len(counts))
+    for player, count in zip(delta['count_players'], delta['count_values']):
+        counts[player] = count
+    state['hand_counts'] = counts
+    hand = [] if base is None else base['hand']
+    if len(delta['removed']) > 0:
+        removed = set(delta['removed'])
+        hand = [card for i, card in enumerate(hand) if i not in removed]
+    state['hand'] = hand + delta['added']
+    return state
+
+#server side: versions sent to one client, and the last one it acked
+class StateSync:
+    #if a client stops acking, give up on deltas after this many versions and send a snapshot
+    max_unacked = 64
+
+    def __init__(self):
+        self.version = 0
+        self.acked = None
+        #version -> sync state, for versions >= acked
+        self.sent = {}
+
+    #fcn to get the delta to send for state, snapshot=True to force a full snapshot
+    def next_delta(self, state, snapshot=False):
+        base = None
+        if not snapshot and self.acked is not None and len(self.sent) <= self.max_unacked:
+            base = self.sent.get(self.acked)
+        if base is None:
+            #client starts over from this snapshot
+            self.sent.clear()
+            self.acked = None
+        self.version += 1
+        self.sent[self.version] = state
+        return make_delta(base, state, self.version, self.acked)
+
+    def ack(self, version):
+        if version not in self.sent or (self.acked is not None and version <= self.acked):
+            return
+        self.acked = version
+        for old_version in [v for v in self.sent if v < version]:
+            del self.sent[old_version]
+
+#client side: states by version, for the versions the server may still send deltas against
+class ClientSync:
+    def __init__(self):
+        self.states = {}
+
+    #returns new state, or None if the delta's base is missing (client should ask for a resync)
+    def apply(self, delta):
+        if delta['base'] == -1:
+            self.states.clear()
+            base = None
+        else:
+            base = self.states.get(delta['base'])
+            if base is None:
+                return None
+            #server only moves its base forwards, older versions won't be used again
+            for old_version in [v for v in self.states if v < delta['base']]:
+                del self.states[old_version]
+        state = apply_delta(base, delta)
+        self.states[delta['version']] = state
+        return state
+
+#fcn to set the uno serializers on a GenericHeader (server or client)
+def set_uno_serializers(header):
+    header.set_serializer(MOVE_CODE, MOVE_SERIALIZER)
+    header.set_serializer(STATE_CODE, STATE_SERIALIZER)
+    header.set_serializer(DELTA_CODE, DELTA_SERIALIZER)
+    header.set_serializer(ACK_CODE, ACK_SERIALIZER)
+    header.set_serializer(CREATE_ROOM_CODE, CREATE_ROOM_SERIALIZER)
+    header.set_serializer(JOIN_ROOM_CODE, ROOM_SERIALIZER)
+    header.set_serializer(LIST_ROOMS_CODE, ROOM_LIST_SERIALIZER)
+    header.set_serializer(PUBLIC_STATE_CODE, PUBLIC_STATE_SERIALIZER)
@@ -0,0 +1,164 @@
+#rooms for UnoServer: lots of uno games (tables) in one server process
+import sys
+import queue
+import traceback
+from threading import Thread, Lock
+sys.path.append('../')
+from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
+
+#the cards dealt to each player + the first current card have to fit in the deck
+MAX_ROOM_PLAYERS = (len(uno.DECK_CODES) - 1) // uno.HAND_SIZE
+#tid in a seat a server side bot plays (see UnoServer bots=)
+BOT_TID = -1
+
+#one table: the game, which client (tid) sits in each seat, and what each seat has been sent (delta updates)
+#seat is the player index in uno_game. Only touched from the room's worker thread (see RoomWorkers)
+class UnoRoom:
+    def __init__(self, room_id, num_players, verbose=False):
+        self.room_id = room_id
+        self.uno_game = uno.UnoGame(num_players, compact=True)
+        self.uno_game.verbose = verbose
+        #seat -> tid, None if empty, BOT_TID if a bot plays it
+        self.seats = [None]*num_players
+        self.syncs = [StateSync() for i in range(num_players)]
+        self.started = False
+        #moves played so far, numbers the room's move log records (see uno_log)
+        self.moves = 0
+        #a bot is picking the move for the seat whose turn it is
+        self.bot_thinking = False
+
+    #returns seat given to tid, -1 if the room is full
+    def seat_player(self, tid):
+        for seat in range(len(self.seats)):
+            if self.seats[seat] is None:
+                self.seats[seat] = tid
+                #new player in this seat starts from a snapshot
+                self.syncs[seat] = StateSync()
+                return seat
+        return -1
+
+    def leave(self, seat):
+        self.seats[seat] = None
+
+    #fcn to give every empty seat to a bot, returns how many it took
+    def seat_bots(self):
+        seats = [seat for seat in range(len(self.seats)) if self.seats[seat] is None]
+        for seat in seats:
+            self.seats[seat] = BOT_TID
+        return len(seats)
+
+    def full(self):
+        return None not in self.seats
+
+    #deal once every seat is taken
+    def start_if_full(self):
+        if not self.started and self.full():
+            self.uno_game.start()
+            self.started = True
+            return True
+        return False
+
+    #list of (seat, tid) for seated players (not bots)
+    def players(self):
+        return [(seat, tid) for seat, tid in enumerate(self.seats) if tid is not None and tid != BOT_TID]
+
+    def info(self):
+        return {'room_id': self.room_id, 'num_players': len(self.seats), 'seated': len(self.players()), 'started': self.started,
+                'bots': self.seats.count(BOT_TID)}
+
+#all rooms by id. Rooms with an empty seat are also kept in open_rooms (in creation order) for quick joins
+class RoomRegistry:
+    def __init__(self, verbose=False):
+        self.rooms = {}
+        self.open_rooms = {}
+        self.next_room_id = 0
+        self.verbose = verbose
+        self.lock = Lock()
+
+    def create(self, num_players):
+        with self.lock:
+            room = UnoRoom(self.next_room_id, num_players, verbose=self.verbose)
+            self.rooms[room.room_id] = room
+            self.open_rooms[room.room_id] = room
+            self.next_room_id += 1
+        return room
+
+    #fcn to put back a room made elsewhere (eg restored by uno_log), new rooms get ids after it
+    def add(self, room):
+        with self.lock:
+            self.rooms[room.room_id] = room
+            if not room.full():
+                self.open_rooms[room.room_id] = room
+            self.next_room_id = max(self.next_room_id, room.room_id + 1)
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    #oldest room with a free seat, None if there is none
+    def open_room(self):
+        with self.lock:
+            for room in self.open_rooms.values():
+                return room
+        return None
+
+    #fcn to call after seats in room change, keeps open_rooms up to date
+    def update(self, room):
+        with self.lock:
+            if room.full():
+                self.open_rooms.pop(room.room_id, None)
+            elif room.room_id in self.rooms:
+                self.open_rooms[room.room_id] = room
+
+    def remove(self, room_id):
+        with self.lock:
+            self.rooms.pop(room_id, None)
+            self.open_rooms.pop(room_id, None)
+
+    def list(self):
+        with self.lock:
+            return [room.info() for room in self.rooms.values()]
+
+    def __len__(self):
+        return len(self.rooms)
+
+#fixed pool of worker threads. A room is always handled by the same worker (room_id % num_workers),
+#so its messages are handled in order without locks, and busy rooms on other workers don't wait on it
+class RoomWorkers:
+    def __init__(self, num_workers=4):
+        self.jobs = [queue.Queue() for i in range(num_workers)]
+        self.threads = [Thread(target=self.thread_for_worker, args=(jobs,), daemon=True) for jobs in self.jobs]
+        for thread in self.threads:
+            thread.start()
+
+    #fcn to run fcn(*args) on room_id's worker
+    def submit(self, room_id, fcn, *args):
+        self.jobs[room_id % len(self.jobs)].put((fcn, args))
+
+    #fcn to run fcn() once every worker got through the jobs queued before this call (on the worker that gets there last)
+    def after_queued(self, fcn):
+        left = [len(self.jobs)]
+        lock = Lock()
+        def arrive():
+            with lock:
+                left[0] -= 1
+                last = left[0] == 0
+            if last:
+                fcn()
+        for jobs in self.jobs:
+            jobs.put((arrive, ()))
+
+    def thread_for_worker(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            fcn, args = job
+            try:
+                fcn(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def end(self):
+        for jobs in self.jobs:
+            jobs.put(None)
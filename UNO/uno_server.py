@@ -5,6 +5,10 @@ sys.path.append('../')
 #print(sys.path)
 from pyserver.GenericServer import *
 from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
+from pyserver.UNO.uno_rooms import *
+from pyserver.UNO.uno_log import *
+from pyserver.UNO.uno_bot import *
 
 #UnoServer:
 #   Clients will have the client version of unogame class- 
@@ -13,71 +17,394 @@ from pyserver.UNO import uno
 #       So when a client makes a move, they 1. play it on their copy of the game and 2. send it to server
 #       server will then broadcast an update + play the move on its copy of the game
 #       Necesarily, when a client receives a broadcasted message they must update their copy of the game
+#   Server hosts many games at once in rooms (see uno_rooms), each client plays in one room as one seat
+#   Updates are deltas (see uno_protocol): only what changed since the state version the client acked,
+#       full snapshots only when a client joins or needs a resync
+#   move_log=path (or a MoveLog) logs every accepted move (see uno_log). A server started again with the same path has the games
+#       that were in progress back, in rooms with all seats open: players take them back by joining
+#   bots=True (or a MonteCarloBots, see uno_bot): seats still empty bot_wait seconds after someone last joined or left a room
+#       are given to bots, which play them until the game ends. A room only bots are left in is closed
+#   SPECTATORS: a client subscribed to a room's topic (room_topic, see GenericServer TOPICS) gets the room's public state
+#       (UnoGame.get_public_state, no hands) when it subscribes and after every move. Each state is published once for all
+#       of the room's spectators, they don't have to be players anywhere
 class UnoServer(GenericHeader, GenericServer):
-    def __init__(self, max_connections, host, port, debug=False):
-        super().__init__(max_connections, host, port, debug=debug)
-        self.uno_game = uno.UnoGame(max_connections)
-        init_player_code = 1 #when player first connects to server, they use header=init_player_code
-        #code 2 used in client
-        player_move_code = 3 #when player makes a move, use header=player_move_code
-        codes = [init_player_code, player_move_code]
-        fcns = [self.send_state, self.update_state]
-        self.set_header(codes=codes, fcns=fcns)
+    def __init__(self, max_connections, host, port, debug=False, num_players=None, num_workers=4, move_log=None, bots=None, bot_wait=5,
+                 **kwargs):
+        super().__init__(max_connections, host, port, debug=debug, **kwargs)
+        #STATE_CODE used in client. Clients never send us pickled objects (code 0), only uno_protocol structs
+        self.set_header(object_send=False)
+        set_uno_serializers(self)
+        #ROOMS: each room is its own game, a client (tid) plays in at most one room at a time as one seat (player index)
+        #   everything that touches a room's game runs on the room's worker thread (RoomWorkers), so rooms don't wait on each other
+        #default room size, for rooms made by quick joins (INIT_PLAYER_CODE / JOIN_ROOM_CODE with room_id=-1)
+        self.num_players = max_connections if num_players is None else num_players
+        self.rooms = RoomRegistry(verbose=debug)
+        self.workers = RoomWorkers(num_workers)
+        #tid -> (room, seat)
+        self.players = {}
+        self.players_lock = Lock()
+        self.move_log = None
+        if move_log is not None:
+            self.move_log = MoveLog(move_log) if isinstance(move_log, str) else move_log
+            self.rooms.next_room_id = self.move_log.last_room_id + 1
+            for room in self.move_log.restore_rooms(verbose=debug):
+                self.rooms.add(room)
+            self.dprint("restored", len(self.rooms), "games from", self.move_log.log_path)
+        #BOTS: room_id -> when its empty seats go to bots, the bot thread looks at it every bot_wait/4s
+        self.bots = None
+        if bots:
+            self.bots = MonteCarloBots() if bots is True else bots
+            self.bot_wait = bot_wait
+            self.bot_wheel = TimerWheel(bot_wait / 4, 8)
+            self.bot_thread = Thread(target=self.thread_for_bots, daemon=True)
+        #first room, clients that only send INIT_PLAYER_CODE play here until it fills up (like before rooms)
+        self.uno_game = self.rooms.create(self.num_players).uno_game
+
+    def run(self):
+        super().run()
+        if self.bots is not None:
+            self.bot_thread.start()
         
     #works with header code and can be called in other functions too
+    #seats the client in an open room if it isn't in one, otherwise sends a full snapshot (resync)
+    @header_code(INIT_PLAYER_CODE)
     def send_state(self, data=None, tid=None):
         if tid is None:
             self.dprint("Note: got tid=None in send_state")
             return
         #if data is None, that means we call to send a state update to clients
         if data is not None:
-            self.dprint("received message from user", data.decode('utf-8'), "With tid=", tid, "Sending state.")
-        state = self.uno_game.get_player_state(tid)
-        #0 is for self. vars, this is self.uno_game var so use header=2, handled in client
-        self.send_message(state, tid, header=2, pickle=True) 
+            self.dprint("received message from user", data, "With tid=", tid, "Sending state.")
+        player = self.players.get(tid)
+        if player is None:
+            self.quick_join(tid)
+            return
+        room, seat = player
+        self.submit(room, self.send_delta, room, seat, True)
 
-    #Note this is diff from send_state; which occurs when client connects w server + sends only to that client
-    # This is for client playing a move + updating and sending to all clients
-    def update_state(self, data, tid=None):
-        #check if all players connected. If not, alert client
-        if len(self.thread_status) != self.max_connections:
-            self.send_message("Not all clients connected yet, please wait", tid, header=123) #any invalid header
+    #fcn to run fcn(*args) on room's worker. defer: messages it sends can still be the reply to the request being handled
+    def submit(self, room, fcn, *args):
+        self.workers.submit(room.room_id, self.defer(fcn), *args)
+
+    #fcn to send the client in seat what changed since the last state it acked. Runs on the room's worker
+    def send_delta(self, room, seat, snapshot=False):
+        tid = room.seats[seat]
+        if tid is None or not room.started:
+            return
+        delta = room.syncs[seat].next_delta(room.uno_game.get_sync_state(seat), snapshot=snapshot)
+        self.send_message(delta, tid, header=DELTA_CODE, pickle=True)
+
+    #client got state version, future deltas can be made against it
+    @header_code(ACK_CODE)
+    def ack_state(self, data, tid=None):
+        player = self.players.get(tid)
+        if player is not None:
+            room, seat = player
+            self.submit(room, room.syncs[seat].ack, self.bytestring_to_obj(data, ACK_CODE)['version'])
+
+    #fcn to seat tid in the oldest open room, makes a new room if they are all full
+    def quick_join(self, tid):
+        room = self.rooms.open_room()
+        if room is None:
+            room = self.rooms.create(self.num_players)
+        self.submit(room, self.seat_player, room, tid, True)
+
+    #fcn to seat tid in room and tell it which seat it got. Runs on the room's worker
+    #quick=True: if room filled up in the meantime, try another room instead of failing
+    #created: room was made for tid by create_room, it is removed again if tid doesn't end up in it and nobody else did
+    def seat_player(self, room, tid, quick=False, created=False):
+        if not self.thread_status[tid]:
+            #left before we got to it
+            if created:
+                self.discard_room(room)
+            return
+        if self.rooms.get(room.room_id) is not room:
+            #room was closed in the meantime
+            if quick:
+                self.quick_join(tid)
+            else:
+                self.send_message({'room_id': room.room_id, 'seat': -1}, tid, header=JOIN_ROOM_CODE, pickle=True)
+            return
+        with self.players_lock:
+            playing = self.players.get(tid)
+            if playing is None:
+                seat = room.seat_player(tid)
+                if seat != -1:
+                    self.players[tid] = (room, seat)
+        if playing is not None:
+            #already playing somewhere, tell it where
+            if created:
+                self.discard_room(room)
+            self.send_message({'room_id': playing[0].room_id, 'seat': playing[1]}, tid, header=JOIN_ROOM_CODE, pickle=True)
+            return
+        self.rooms.update(room)
+        if seat == -1 and quick:
+            self.quick_join(tid)
+            return
+        if seat == -1 and created:
+            self.discard_room(room)
+        self.send_message({'room_id': room.room_id, 'seat': seat}, tid, header=JOIN_ROOM_CODE, pickle=True)
+        if self.start_game(room):
+            return
+        if seat != -1 and room.started:
+            #joined a game that already started
+            self.send_delta(room, seat, snapshot=True)
+        self.wait_for_bots(room)
+
+    #fcn to deal room's game once every seat is taken, returns True if it did. Runs on the room's worker
+    def start_game(self, room):
+        if not room.start_if_full():
+            return False
+        self.dprint("room", room.room_id, "is full, starting game")
+        if self.move_log is not None:
+            self.move_log.log_snapshot(room)
+        for seat, tid in room.players():
+            self.send_delta(room, seat, snapshot=True)
+        self.publish_state(room)
+        self.bot_turn(room)
+        return True
+
+    #fcn to (re)start the wait before bots take room's empty seats
+    def wait_for_bots(self, room):
+        if self.bots is not None and not room.full():
+            self.bot_wheel.schedule(room.room_id, time.monotonic() + self.bot_wait)
+
+    #gives empty seats to bots once rooms waited bot_wait for players
+    def thread_for_bots(self):
+        while self.running:
+            time.sleep(self.bot_wheel.tick)
+            for room_id in self.bot_wheel.expire(time.monotonic()):
+                room = self.rooms.get(room_id)
+                if room is not None:
+                    self.workers.submit(room_id, self.seat_bots, room)
+
+    #fcn to give room's empty seats to bots. Runs on the room's worker
+    def seat_bots(self, room):
+        if self.rooms.get(room.room_id) is not room or len(room.players()) == 0:
+            return
+        if room.seat_bots() == 0:
+            return
+        self.dprint("room", room.room_id, "waited", self.bot_wait, "s for players, bots took the empty seats")
+        self.rooms.update(room)
+        if not self.start_game(room):
+            #game that had already started, it may be a new bot's turn
+            self.bot_turn(room)
+
+    #fcn to have a bot pick a move if it is a bot's turn in room. Runs on the room's worker
+    #the bots answer from their own thread, the move is played on the room's worker (play_bot_move)
+    def bot_turn(self, room):
+        uno_game = room.uno_game
+        if self.bots is None or room.bot_thinking or uno_game.winner is not None or room.seats[uno_game.turn] != BOT_TID:
+            return
+        room.bot_thinking = True
+        seat = uno_game.turn
+        moves = room.moves
+        self.bots.choose(uno_game.get_sync_state(seat), lambda move: self.workers.submit(room.room_id, self.play_bot_move, room, seat, moves, move))
+
+    #fcn to play the move a bot picked in seat when room was at moves. Runs on the room's worker
+    def play_bot_move(self, room, seat, moves, move):
+        room.bot_thinking = False
+        if self.rooms.get(room.room_id) is not room:
+            return
+        if room.moves != moves:
+            #game went on without us, maybe to another bot's turn
+            self.bot_turn(room)
+            return
+        if not room.uno_game.valid_move(move['index'], player=seat, other_info=move['chosen_color']):
+            move = {'index': DRAW_MOVE, 'chosen_color': ''}
+        self.play_move(room, seat, move)
+
+    @header_code(CREATE_ROOM_CODE)
+    def create_room(self, data, tid=None):
+        if tid in self.players:
+            self.send_message("Already in a room", tid, header=123) #any invalid header
+            return
+        num_players = self.bytestring_to_obj(data, CREATE_ROOM_CODE)['num_players']
+        if not 1 <= num_players <= MAX_ROOM_PLAYERS:
+            self.send_message("Rooms have 1 to {} players".format(MAX_ROOM_PLAYERS), tid, header=123) #any invalid header
             return
+        room = self.rooms.create(num_players)
+        self.submit(room, self.seat_player, room, tid, False, True)
 
+    @header_code(JOIN_ROOM_CODE)
+    def join_room(self, data, tid=None):
+        room_id = self.bytestring_to_obj(data, JOIN_ROOM_CODE)['room_id']
+        if room_id == -1:
+            self.quick_join(tid)
+            return
+        room = self.rooms.get(room_id)
+        if room is None:
+            self.send_message({'room_id': room_id, 'seat': -1}, tid, header=JOIN_ROOM_CODE, pickle=True)
+            return
+        self.submit(room, self.seat_player, room, tid)
+
+    @header_code(LIST_ROOMS_CODE)
+    def list_rooms(self, data, tid=None):
+        self.send_message({'rooms': self.rooms.list()}, tid, header=LIST_ROOMS_CODE, pickle=True)
+
+    #Note this is diff from send_state; which occurs when client connects w server + sends only to that client
+    # This is for client playing a move + updating and sending to all clients in its room
+    @header_code(MOVE_CODE)
+    def update_state(self, data, tid=None):
         if tid is None:
             self.dprint("Note: got tid=None in update_state")
             return
-        elif tid != self.uno_game.turn:
-            self.dprint("Note: user {} tried to move on turn {}".format(tid, self.uno_game.turn))
+        player = self.players.get(tid)
+        if player is None:
+            self.send_message("Not in a room, join one first", tid, header=123) #any invalid header
+            return
+        room, seat = player
+        #player made this move (color + index), play it on the room's worker
+        update = self.bytestring_to_obj(data, MOVE_CODE)
+        self.submit(room, self.play_move, room, seat, update)
+
+    #fcn to check + play a move in room and send the room's players an update. Runs on the room's worker
+    def play_move(self, room, seat, update):
+        tid = room.seats[seat]
+        #check if all players in the room are seated. If not, alert client
+        if not room.started:
+            self.send_message("Not all clients connected yet, please wait", tid, header=123) #any invalid header
+            return
+        uno_game = room.uno_game
+        if seat != uno_game.turn:
+            self.dprint("Note: user", seat, "tried to move on turn", uno_game.turn)
             #in this case, sync up state in case client has bad version
-            self.send_state(tid=tid)
+            self.send_delta(room, seat, snapshot=True)
             return
 
-        #player made this move (color + index) so check if valid and play game.
-        update = self.bytestring_to_obj(data)
         index = update['index']
         if 'chosen_color' in update:
             chosen_color = update['chosen_color']
         else:
             chosen_color = ''
 
-        if self.uno_game.valid_move(index, player=tid, other_info=chosen_color):
-            self.uno_game.play_card(index, other_info=chosen_color)
+        if uno_game.valid_move(index, player=seat, other_info=chosen_color):
+            uno_game.play_card(index, other_info=chosen_color)
+            room.moves += 1
+            if self.move_log is not None:
+                self.move_log.log_move(room, update)
         else:
             self.send_message("Your move {} is invalid".format(index), tid, header=123) #any invalid header
             #in this case, sync up state in case client has bad version
-            self.send_state(tid=tid)
+            self.send_delta(room, seat, snapshot=True)
+            return
+
+        #Now to send the update to everyone in the room
+        for seat, tid in room.players():
+            self.send_delta(room, seat)
+        self.publish_state(room)
+        if uno_game.winner is not None:
+            self.close_room(room)
+        else:
+            self.bot_turn(room)
+
+    #room's public state, for spectators
+    def public_state(self, room):
+        public_state = room.uno_game.get_public_state()
+        public_state['room_id'] = room.room_id
+        public_state['moves'] = room.moves
+        return public_state
+
+    #fcn to send room's public state to its spectators. Runs on the room's worker
+    def publish_state(self, room):
+        self.publish(room_topic(room.room_id), self.public_state(room), header=PUBLIC_STATE_CODE, pickle=True)
+
+    #client wants to spectate: only room topics of rooms that are open. It gets the room's state right away
+    def subscribe(self, tid, topic):
+        room_id = topic[len(ROOM_TOPIC):]
+        room = self.rooms.get(int(room_id)) if topic.startswith(ROOM_TOPIC) and room_id.isdigit() else None
+        if room is None:
+            self.send_message("No room to spectate at {}".format(topic), tid, header=123) #any invalid header
+            return False
+        if not super().subscribe(tid, topic):
+            return False
+        self.submit(room, self.send_public_state, room, tid)
+        return True
+
+    #fcn to send room's public state to a new spectator. Runs on the room's worker, so it's never older than a published one
+    def send_public_state(self, room, tid):
+        self.send_message(self.public_state(room), tid, header=PUBLIC_STATE_CODE, pickle=True)
+
+    #client is gone: free its seat (see GenericServer CLIENT SLOTS). Its tid may be given to a new client right after this
+    def on_disconnect(self, tid):
+        super().on_disconnect(tid)
+        with self.players_lock:
+            player = self.players.pop(tid, None)
+        if player is not None:
+            room, seat = player
+            self.submit(room, self.leave_room, room, seat, tid)
+
+    #jobs for tid (joins, moves, its leave_room) can still be queued on the room workers, and they'd run for whoever got tid next
+    #(seated in a room it never joined, sent the old client's hand). So the slot is only given back once the workers are past them
+    def release_tid(self, tid):
+        self.workers.after_queued(functools.partial(super().release_tid, tid))
+
+    #fcn to empty seat, a quick join can take it (game waits on that seat until then). Runs on the room's worker
+    #a room nobody is left in is closed
+    def leave_room(self, room, seat, tid):
+        if room.seats[seat] != tid:
             return
+        room.leave(seat)
+        if len(room.players()) == 0:
+            self.dprint("room", room.room_id, "is empty, closing it")
+            self.rooms.remove(room.room_id)
+            self.close_topic(room_topic(room.room_id))
+            if self.bots is not None:
+                self.bot_wheel.cancel(room.room_id)
+            #not when the server is ending, so the log still has the game for the next start
+            if self.move_log is not None and room.started and self.running:
+                self.move_log.log_close(room.room_id)
+        else:
+            self.rooms.update(room)
+            self.wait_for_bots(room)
 
-        #Now to broadcast the update to everyone
-        for tid in range(len(self.connections)):
-            self.send_state(tid=tid)
+    #fcn to remove a room nobody was seated in (see seat_player). Runs on the room's worker
+    def discard_room(self, room):
+        if len(room.players()) == 0 and not room.started:
+            self.dprint("room", room.room_id, "has nobody in it, removing it")
+            self.rooms.remove(room.room_id)
+            self.close_topic(room_topic(room.room_id))
+
+    #fcn to drop a finished room, its players can join other rooms
+    def close_room(self, room):
+        self.dprint("room", room.room_id, "finished, winner", room.uno_game.winner)
+        with self.players_lock:
+            for seat, tid in room.players():
+                self.players.pop(tid, None)
+        self.rooms.remove(room.room_id)
+        #spectators got the last state (with the winner) from play_move
+        self.close_topic(room_topic(room.room_id))
+        if self.bots is not None:
+            self.bot_wheel.cancel(room.room_id)
+        if self.move_log is not None:
+            self.move_log.log_close(room.room_id)
 
     #current player will send move, we play it on server, and send everyone an update
     def parse_message(self, data, tid):
         decoded, header, msg = self.decode(data, tid=tid)
         if not decoded:
-            self.dprint("Unable to decode msg: {}|{}".format(header, msg))
+            self.dprint("Unable to decode msg:", header, msg)
+
+    #server metrics + rooms, and how many jobs are waiting on each room worker
+    def metrics_snapshot(self):
+        snapshot = super().metrics_snapshot()
+        snapshot['rooms'] = len(self.rooms)
+        snapshot['players'] = len(self.players)
+        snapshot['worker_queues'] = [jobs.qsize() for jobs in self.workers.jobs]
+        if self.bots is not None:
+            snapshot['bots'] = self.bots.stats()
+        return snapshot
+
+    def end(self):
+        super().end()
+        self.workers.end()
+        if self.bots is not None:
+            self.bots.close()
+        if self.move_log is not None:
+            #let the workers log what they were still doing
+            for thread in self.workers.threads:
+                thread.join(1)
+            self.move_log.close()
         
 
 def main():
@@ -90,7 +417,7 @@ def main():
     i = 0
     period = 3
     timeout = 20
-    serv.uno_game.start()
+    #game in the first room starts once num_players clients have joined
     serv.last_send = time.time() #hacky way to get timeout to work rn
     while serv.uno_game.winner is None:
         print("Sleep... ({})".format(i))
@@ -0,0 +1,235 @@
+#python UNO/uno_sim.py
+#headless uno for playing lots of games (rules testing, balance, bots): UnoSim plays a batch of games at once with numpy,
+#same rules as UnoGame in uno.py. Needs numpy (the rest of the package doesn't)
+import sys
+import argparse
+import time
+import numpy as np
+sys.path.append('../')
+from pyserver.UNO import uno
+
+#card tables by card code (see uno.CARD_TABLE). Hands and the deck only ever have codes < HAND_CODES (colored wilds are only the current card)
+FIRST_BLACK_CODE = len(uno.CARD_COLORS)*13
+HAND_CODES = FIRST_BLACK_CODE + len(uno.BLACK_EFFECTS)
+BLACK = len(uno.CARD_COLORS) #color index of black cards
+CODE_COLOR = np.array([uno.CARD_COLORS.index(color) if color in uno.CARD_COLORS else BLACK for color, number, eff in uno.CARD_TABLE], dtype=np.int8)
+#what a card does when played
+NO_EFF, PLUS_2, REVERSE, SKIP, PLUS_4, CHANGE_COLOR = range(6)
+EFFECTS = [uno.no_eff, uno.plus_2, uno.turn_reverse, uno.turn_skip, uno.plus_4, uno.change_color]
+CODE_EFFECT = np.array([EFFECTS.index(eff) for color, number, eff in uno.CARD_TABLE], dtype=np.int8)
+CODE_PLUS = np.array([uno.PLUS_VALUES.get(eff, 0) for color, number, eff in uno.CARD_TABLE], dtype=np.int16)
+BASE_CODES = np.array(uno.BASE_CODES, dtype=np.uint8)
+#[color, black card code - FIRST_BLACK_CODE] -> the black card with that color picked
+WILD_CODES = np.array([[uno.CARD_CODES[(color, -1, eff)] for eff in uno.BLACK_EFFECTS] for color in uno.CARD_COLORS], dtype=np.uint8)
+#[current card, card] -> can card be played with nothing on the stack. Same checks as UnoGame.valid_move
+LEGAL_EMPTY = np.array([[(card.color in current.color) or (card.number == current.number) or (card.eff is not uno.no_eff and card.eff is current.eff)
+                         for card in uno.CARDS[:HAND_CODES]] for current in uno.CARDS], dtype=bool)
+#[stack top, card] -> can card be played on a +2 / +4
+LEGAL_STACK = np.zeros((max(uno.PLUS_VALUES.values()) + 1, HAND_CODES), dtype=bool)
+for top in uno.PLUS_VALUES.values():
+    LEGAL_STACK[top] = (CODE_PLUS[:HAND_CODES] >= top)
+#both in one table, [stack top*len(CARD_TABLE) + current card, card], so legal_mask is a single lookup
+LEGAL = np.concatenate([LEGAL_EMPTY if top == 0 else np.repeat(LEGAL_STACK[top][None], len(uno.CARD_TABLE), axis=0) for top in range(len(LEGAL_STACK))])
+#[card, color] -> 1 if card has that color, to count a hand's cards by color
+COLOR_ONEHOT = np.zeros((HAND_CODES, BLACK + 1), dtype=np.int16)
+COLOR_ONEHOT[np.arange(HAND_CODES), CODE_COLOR[:HAND_CODES]] = 1
+DECK_CODES = np.array(uno.DECK_CODES, dtype=np.uint8)
+HAND_SIZE = uno.HAND_SIZE
+
+#Batch of num_games games with num_players each. Each game's state is a row in these arrays:
+# counts[game, player, code]: how many of each card a player has (hand order doesn't matter, same cards play the same)
+# deck[game] + top: cards left to draw are deck[game, top:deck_size], discard[game, :discard_size] is the discard pile
+# current, stack_sum + stack_top (UnoGame.stack is only ever summed or looked at the end), turn, turn_dir, winner (-1 = none yet)
+#a move is a card code to play (-1 = draw) + a color index for black cards
+#policies pick moves for many games at once, see random_policy / greedy_policy
+class UnoSim:
+    def __init__(self, num_games, num_players, seed=None):
+        self.num_games = num_games
+        self.num_players = num_players
+        self.rng = np.random.default_rng(seed)
+        self.reset()
+
+    #fcn to shuffle + deal new games, like UnoGame.__init__ + UnoGame.start
+    def reset(self):
+        games = np.arange(self.num_games)
+        self.deck = DECK_CODES[self.rng.random((self.num_games, len(DECK_CODES))).argsort(axis=1)]
+        self.deck_size = np.full(self.num_games, len(DECK_CODES), dtype=np.int16)
+        self.discard = np.zeros((self.num_games, len(DECK_CODES)), dtype=np.uint8)
+        self.discard_size = np.zeros(self.num_games, dtype=np.int16)
+        self.counts = np.zeros((self.num_games, self.num_players, HAND_CODES), dtype=np.int8)
+        for player in range(self.num_players):
+            cards = self.deck[:, player*HAND_SIZE:(player + 1)*HAND_SIZE].astype(np.intp)
+            self.counts[:, player] = np.bincount((games[:, None]*HAND_CODES + cards).ravel(), minlength=self.num_games*HAND_CODES).reshape(self.num_games, HAND_CODES)
+        self.hand_size = np.full((self.num_games, self.num_players), HAND_SIZE, dtype=np.int16)
+        self.top = np.full(self.num_games, self.num_players*HAND_SIZE, dtype=np.int16)
+        self.current = self.deck[games, self.top]
+        self.top += 1
+        #black first card: discard it and draw another
+        black = np.flatnonzero(CODE_COLOR[self.current] == BLACK)
+        while len(black) > 0:
+            self.put_discard(black, self.current[black])
+            self.current[black] = self.deck[black, self.top[black]]
+            self.top[black] += 1
+            black = black[CODE_COLOR[self.current[black]] == BLACK]
+        self.stack_sum = np.zeros(self.num_games, dtype=np.int16)
+        self.stack_top = np.zeros(self.num_games, dtype=np.int16)
+        self.turn = np.zeros(self.num_games, dtype=np.intp)
+        self.turn_dir = np.ones(self.num_games, dtype=np.intp)
+        self.winner = np.full(self.num_games, -1, dtype=np.intp)
+        self.turns = np.zeros(self.num_games, dtype=np.int32)
+
+    #fcn to get the current players' hands (len(games), HAND_CODES)
+    def hands(self, games):
+        return self.counts[games, self.turn[games]]
+
+    #fcn to get which cards the current player of each game can play, (len(games), HAND_CODES). Drawing is always legal
+    def legal_mask(self, games, hands=None):
+        if hands is None:
+            hands = self.hands(games)
+        return LEGAL[self.stack_top[games]*len(uno.CARD_TABLE) + self.current[games]] & (hands > 0)
+
+    #fcn to play one move in each of games (no game twice), like UnoGame.play_card. Moves aren't checked, use legal_mask
+    def step(self, games, codes, colors):
+        players = self.turn[games]
+        self.turns[games] += 1
+        draw = codes < 0
+        if draw.any():
+            draw_games = games[draw]
+            n = np.where(self.stack_sum[draw_games] > 0, self.stack_sum[draw_games], 1)
+            self.draw(draw_games, players[draw], n)
+            #reset stack once someone draws
+            self.stack_sum[draw_games] = 0
+            self.stack_top[draw_games] = 0
+
+        play = ~draw
+        games, players, codes, colors = games[play], players[play], codes[play], colors[play]
+        self.counts[games, players, codes] -= 1
+        self.hand_size[games, players] -= 1
+        self.put_discard(games, BASE_CODES[self.current[games]])
+        self.current[games] = codes
+        #winner is checked before the card's effect, and their turn doesn't end
+        won = self.hand_size[games, players] == 0
+        self.winner[games[won]] = players[won]
+        games, codes, colors = games[~won], codes[~won], colors[~won]
+
+        effects = CODE_EFFECT[codes]
+        plus = CODE_PLUS[codes]
+        has_plus = plus > 0
+        self.stack_sum[games] += plus
+        self.stack_top[games[has_plus]] = plus[has_plus]
+        black = CODE_COLOR[codes] == BLACK
+        self.current[games[black]] = WILD_CODES[colors[black], codes[black] - FIRST_BLACK_CODE]
+        reverse = games[effects == REVERSE]
+        self.turn_dir[reverse] *= -1
+        skip = games[effects == SKIP]
+        self.turn[skip] = (self.turn[skip] + self.turn_dir[skip]) % self.num_players
+
+        moved = np.concatenate((games, draw_games)) if draw.any() else games
+        self.turn[moved] = (self.turn[moved] + self.turn_dir[moved]) % self.num_players
+
+    #fcn to give each player n[i] cards from games[i]'s deck, like UnoDeck.draw
+    def draw(self, games, players, n):
+        short = np.flatnonzero(self.deck_size[games] - self.top[games] < n)
+        for game in games[short]:
+            self.return_discard_to_deck(game)
+        #deck + discard pile can run out, then you get what is left
+        n = np.minimum(n, self.deck_size[games] - self.top[games])
+        for k in range(n.max(initial=0)):
+            now = k < n
+            g = games[now]
+            self.counts[g, players[now], self.deck[g, self.top[g] + k]] += 1
+        self.top[games] += n
+        self.hand_size[games, players] += n
+
+    def put_discard(self, games, codes):
+        self.discard[games, self.discard_size[games]] = codes
+        self.discard_size[games] += 1
+
+    #fcn to shuffle the discard pile back in, like UnoDeck.return_discard_to_deck. Rare, so one game at a time
+    def return_discard_to_deck(self, game):
+        cards = np.concatenate((self.deck[game, self.top[game]:self.deck_size[game]], self.discard[game, :self.discard_size[game]]))
+        self.rng.shuffle(cards)
+        self.deck[game, :len(cards)] = cards
+        self.deck_size[game] = len(cards)
+        self.top[game] = 0
+        self.discard_size[game] = 0
+
+    #fcn to play every game until it has a winner (or max_turns), policies is one policy for everyone or one per player
+    #returns winner of each game (-1 if it hit max_turns)
+    def play(self, policies, max_turns=1000):
+        if callable(policies):
+            policies = [policies]*self.num_players
+        #seats that share a policy are asked together
+        unique = list(dict.fromkeys(policies))
+        seat_policy = np.array([unique.index(policy) for policy in policies])
+        games = np.flatnonzero(self.winner == -1)
+        while len(games) > 0:
+            hands = self.hands(games)
+            mask = self.legal_mask(games, hands)
+            codes = np.full(len(games), -1, dtype=np.intp)
+            colors = np.zeros(len(games), dtype=np.intp)
+            turn_policy = seat_policy[self.turn[games]]
+            for i, policy in enumerate(unique):
+                now = np.arange(len(games)) if len(unique) == 1 else np.flatnonzero(turn_policy == i)
+                if len(now) > 0:
+                    codes[now], colors[now] = policy(self, games[now], mask[now], hands[now])
+            self.step(games, codes, colors)
+            games = games[(self.winner[games] == -1) & (self.turns[games] < max_turns)]
+        return self.winner
+
+#POLICIES: policy(sim, games, mask, hands) -> (card codes, color indexes), code -1 to draw
+#mask is legal_mask(games) and hands the current players' counts
+
+#play a random legal card (each card in hand as likely, like picking a random index), draw only if nothing can be played
+def random_policy(sim, games, mask, hands):
+    #int16: a hand can hold more than 127 cards after long +2/+4 chains
+    weights = (hands*mask).cumsum(axis=1, dtype=np.int16)
+    total = weights[:, -1]
+    pick = (sim.rng.random(len(games))*total).astype(np.int16)
+    codes = np.where(total > 0, (weights <= pick[:, None]).sum(axis=1), -1)
+    colors = sim.rng.integers(0, len(uno.CARD_COLORS), len(games))
+    return codes, colors
+
+#GREEDY: keep black cards for when nothing else can be played, play the color you have the most of,
+#action cards before numbers, and pick the color you have the most of for black cards
+GREEDY_KIND_SCORE = np.array([0 if effect == NO_EFF else (-100 if CODE_COLOR[code] == BLACK else 10) for code, effect in enumerate(CODE_EFFECT[:HAND_CODES])], dtype=np.int16)
+
+def greedy_policy(sim, games, mask, hands):
+    by_color = hands.astype(np.int16) @ COLOR_ONEHOT
+    score = GREEDY_KIND_SCORE + by_color[:, CODE_COLOR[:HAND_CODES]]
+    score = np.where(mask, score, np.iinfo(np.int16).min)
+    codes = np.where(mask.any(axis=1), score.argmax(axis=1), -1)
+    colors = by_color[:, :BLACK].argmax(axis=1)
+    return codes, colors
+
+POLICIES = {'random': random_policy, 'greedy': greedy_policy}
+
+
+#main, plays a batch of games and prints games/sec + win rate per seat
+def main():
+    parser = argparse.ArgumentParser(description="batched uno simulator: games/sec and win rate per seat")
+    parser.add_argument('--games', type=int, default=100000, help="games played at once")
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--policies', help="comma separated policy per seat, from {} (default: greedy, then random)".format(sorted(POLICIES)))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.policies is None:
+        policies = ['greedy'] + ['random']*(args.players - 1)
+    else:
+        policies = args.policies.split(',')
+    if len(policies) != args.players or any(name not in POLICIES for name in policies):
+        parser.error("--policies needs one of {} for each of the {} players".format(sorted(POLICIES), args.players))
+
+    num_games = args.games
+    num_players = args.players
+    sim = UnoSim(num_games, num_players, seed=args.seed)
+    t = time.time()
+    winners = sim.play([POLICIES[name] for name in policies])
+    dt = time.time() - t
+    print("{} games of {} players in {:.2f}s ({:.0f} games/sec, {:.0f} turns/sec)".format(num_games, num_players, dt, num_games/dt, sim.turns.sum()/dt))
+    print("unfinished: {}, avg turns: {:.1f}".format((winners == -1).sum(), sim.turns.mean()))
+    for seat, name in enumerate(policies):
+        print("  seat {} ({}): {:.1%} wins".format(seat, name, (winners == seat).mean()))
+
+if __name__ == "__main__":
+    main()
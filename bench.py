@@ -0,0 +1,360 @@
+#python bench.py [--out results.json] [--baseline bench_baseline.json] [--save-baseline] [--filter name]
+#microbenchmarks for the hot paths: header encode/decode + dispatch, serializers on real uno states,
+#uno game ops, deck ops, and broadcast_message to clients over loopback
+#results are us per op (best of --repeat runs), written as json. With a baseline, any bench more than
+#--threshold times slower than the baseline is reported and the exit code is 1, so it can gate a deploy
+#timings depend on the machine, so save the baseline (--save-baseline) on the machine you compare on
+import sys
+import os
+import io
+import json
+import time
+import random
+import socket
+import timeit
+import argparse
+import platform
+import contextlib
+from threading import Thread
+sys.path.append('../')
+from pyserver.GenericServer import *
+from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
+
+#benches by name, each one is a fcn that sets up and returns (fcn to time, ops per call of it)
+BENCHES = {}
+
+def bench(name):
+    def register(fcn):
+        BENCHES[name] = fcn
+        return fcn
+    return register
+
+#GenericHeader without a connection (GenericServer.__init__ isn't called), to encode/decode like UnoServer does
+class BenchHeader(GenericHeader, GenericServer):
+    def __init__(self):
+        self.debug = False
+        self.max_data_size = 2048
+        self.metrics = Metrics()
+        self.set_header(object_send=False)
+        set_uno_serializers(self)
+        self.received = 0
+
+    @header_code(MOVE_CODE)
+    def on_move(self, data, tid=None):
+        self.received += 1
+
+#fcn to play random games, returns (get_player_state, get_sync_state) of the player to move after every turn + the moves played
+def random_games(num_games=10, num_players=4, max_moves=300, compact=False, seed=0):
+    random.seed(seed)
+    games = []
+    moves = []
+    for i in range(num_games):
+        game = uno.UnoGame(num_players, compact=compact)
+        game.start()
+        for n in range(max_moves):
+            if game.winner is not None:
+                break
+            color = random.choice(uno.CARD_COLORS)
+            hand = game.player_hands[game.turn]
+            options = [ind for ind in range(len(hand)) if game.valid_move(ind, other_info=color)]
+            index = random.choice(options) if options else len(hand)
+            moves.append({'index': index, 'chosen_color': color if game.requires_color(index) else ''})
+            game.play_card(index, other_info=color)
+            games.append((game.get_player_state(game.turn), game.get_sync_state(game.turn)))
+    return games, moves
+
+#realistic payloads, made once
+PAYLOADS = {}
+
+def payloads():
+    if not PAYLOADS:
+        with contextlib.redirect_stdout(io.StringIO()):
+            states, moves = random_games()
+        PAYLOADS['states'] = [state for state, sync_state in states]
+        PAYLOADS['moves'] = moves
+        syncs = [StateSync() for i in range(4)]
+        deltas = []
+        for state, sync_state in states:
+            sync = syncs[sync_state['player_id']]
+            deltas.append(sync.next_delta(sync_state))
+            sync.ack(sync.version)
+        PAYLOADS['deltas'] = deltas
+    return PAYLOADS
+
+#ENCODE / DECODE (encode_parts is what send_message/broadcast_message use)
+
+@bench("encode_state_struct")
+def bench_encode_state():
+    header = BenchHeader()
+    states = payloads()['states']
+    return lambda: [header.encode_parts(state, header=STATE_CODE, pickle=True) for state in states], len(states)
+
+@bench("encode_str")
+def bench_encode_str():
+    header = BenchHeader()
+    msgs = ["C{} sends bc message `hello`".format(i) for i in range(1000)]
+    return lambda: [header.encode_parts(msg, header=MOVE_CODE) for msg in msgs], len(msgs)
+
+#decode + dispatch to the handler, what every received message goes through
+@bench("decode_dispatch_move")
+def bench_decode():
+    header = BenchHeader()
+    frames = [header.encode(move, header=MOVE_CODE, pickle=True)[FrameReader.prefix.size:] for move in payloads()['moves']]
+    return lambda: [header.decode(frame, tid=0) for frame in frames], len(frames)
+
+@bench("decode_unknown_code")
+def bench_decode_unknown():
+    header = BenchHeader()
+    frames = [header.encode("msg {}".format(i), header=123)[FrameReader.prefix.size:] for i in range(1000)]
+    return lambda: [header.decode(frame, tid=0) for frame in frames], len(frames)
+
+#length prefixed frames out of one big recv
+@bench("frame_reader_split")
+def bench_frame_reader():
+    header = BenchHeader()
+    data = b''.join(header.encode(move, header=MOVE_CODE, pickle=True) for move in payloads()['moves'])
+    n = len(payloads()['moves'])
+    def split():
+        reader = FrameReader(len(data))
+        reader.view[:len(data)] = data
+        reader.end = len(data)
+        return list(reader.frames())
+    return split, n
+
+#SERIALIZERS on get_player_state / delta payloads
+
+@bench("obj_to_bytestring_state_pickle")
+def bench_dumps_pickle():
+    header = BenchHeader()
+    states = payloads()['states']
+    return lambda: [header.obj_to_bytestring(state) for state in states], len(states)
+
+@bench("bytestring_to_obj_state_pickle")
+def bench_loads_pickle():
+    header = BenchHeader()
+    data = [header.obj_to_bytestring(state) for state in payloads()['states']]
+    return lambda: [header.bytestring_to_obj(d) for d in data], len(data)
+
+@bench("obj_to_bytestring_state_struct")
+def bench_dumps_struct():
+    header = BenchHeader()
+    states = payloads()['states']
+    return lambda: [header.obj_to_bytestring(state, STATE_CODE) for state in states], len(states)
+
+@bench("bytestring_to_obj_state_struct")
+def bench_loads_struct():
+    header = BenchHeader()
+    data = [header.obj_to_bytestring(state, STATE_CODE) for state in payloads()['states']]
+    return lambda: [header.bytestring_to_obj(d, STATE_CODE) for d in data], len(data)
+
+@bench("obj_to_bytestring_delta")
+def bench_dumps_delta():
+    header = BenchHeader()
+    deltas = payloads()['deltas']
+    return lambda: [header.obj_to_bytestring(delta, DELTA_CODE) for delta in deltas], len(deltas)
+
+@bench("bytestring_to_obj_delta")
+def bench_loads_delta():
+    header = BenchHeader()
+    data = [header.obj_to_bytestring(delta, DELTA_CODE) for delta in payloads()['deltas']]
+    return lambda: [header.bytestring_to_obj(d, DELTA_CODE) for d in data], len(data)
+
+#UNO GAME
+
+#valid_move for every card in the current hand
+@bench("uno_valid_move")
+def bench_valid_move():
+    random.seed(0)
+    games = []
+    for i in range(50):
+        game = uno.UnoGame(4)
+        game.verbose = False
+        game.start()
+        games.append(game)
+    checks = [(game, ind) for game in games for ind in range(len(game.player_hands[game.turn]))]
+    return lambda: [game.valid_move(ind) for game, ind in checks], len(checks)
+
+#legal_moves for the current hand (the same hands as uno_valid_move), per hand
+@bench("uno_legal_moves")
+def bench_legal_moves():
+    random.seed(0)
+    games = []
+    for i in range(50):
+        game = uno.UnoGame(4)
+        game.verbose = False
+        game.start()
+        games.append(game)
+    return lambda: [game.legal_moves() for game in games], len(games)
+
+#whole random games: valid_move over the hand + play_card, per move
+def bench_play(compact):
+    def play():
+        random.seed(1)
+        moves = 0
+        for i in range(20):
+            game = uno.UnoGame(4, compact=compact)
+            game.verbose = False
+            game.start()
+            while game.winner is None and moves < 100000:
+                hand = game.player_hands[game.turn]
+                options = [ind for ind in range(len(hand)) if game.valid_move(ind, other_info='red')]
+                game.play_card(options[0] if options else len(hand), other_info='red')
+                moves += 1
+        return moves
+    return play, play()
+
+BENCHES["uno_play_card"] = lambda: bench_play(False)
+BENCHES["uno_play_card_compact"] = lambda: bench_play(True)
+
+#draw a starting hand
+def bench_draw(deck_class):
+    deck = deck_class()
+    def draw():
+        for i in range(1000):
+            deck.top = 0
+            deck.draw(7)
+    return draw, 1000
+
+def bench_shuffle(deck_class):
+    deck = deck_class()
+    def shuffle():
+        for i in range(100):
+            deck.top = 0
+            deck.shuffle()
+    return shuffle, 100
+
+BENCHES["deck_draw7"] = lambda: bench_draw(uno.UnoDeck)
+BENCHES["deck_draw7_compact"] = lambda: bench_draw(uno.CompactUnoDeck)
+BENCHES["deck_shuffle"] = lambda: bench_shuffle(uno.UnoDeck)
+BENCHES["deck_shuffle_compact"] = lambda: bench_shuffle(uno.CompactUnoDeck)
+
+#BROADCAST over loopback: per broadcast_message of a state, until every client has read it
+#PUBLISH: same, but publish() to a topic only some of the clients are subscribed to
+
+class BenchServer(GenericHeader, GenericServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_header(object_send=False)
+        set_uno_serializers(self)
+
+def bench_broadcast(event_loop, num_clients=16, num_msgs=200, num_subscribers=None):
+    port = random.randint(20000, 60000)
+    serv = BenchServer(num_clients, '127.0.0.1', port, event_loop=event_loop, queue_size=num_msgs*4)
+    #a blocking accept() doesn't return when end() closes the socket, don't let it keep the bench running
+    serv.server_thread.daemon = True
+    serv.run()
+    time.sleep(0.1)
+    clients = [socket.create_connection(('127.0.0.1', port)) for i in range(num_clients)]
+    while len(serv.client_tids()) < num_clients:
+        time.sleep(0.01)
+    #only the first num_subscribers clients get published messages
+    listeners = range(num_clients)
+    if num_subscribers is not None:
+        listeners = range(num_subscribers)
+        for tid in listeners:
+            serv.subscribe(tid, 'bench')
+    state = payloads()['states'][0]
+    frame_size = len(serv.encode(state, header=STATE_CODE, pickle=True))
+    received = [0]*num_clients
+    #each client just counts bytes
+    def drain(i):
+        while True:
+            try:
+                data = clients[i].recv(1 << 16)
+            except OSError:
+                return
+            if not data:
+                return
+            received[i] += len(data)
+    for i in range(num_clients):
+        Thread(target=drain, args=(i,), daemon=True).start()
+    def broadcast():
+        target = [n + frame_size*num_msgs for n in received]
+        for i in range(num_msgs):
+            if num_subscribers is None:
+                serv.broadcast_message(state, header=STATE_CODE, pickle=True)
+            else:
+                serv.publish('bench', state, header=STATE_CODE, pickle=True)
+        while any(received[i] < target[i] for i in listeners):
+            time.sleep(0.0002)
+    def end():
+        for client in clients:
+            client.close()
+        serv.end()
+    return broadcast, num_msgs, end
+
+BENCHES["broadcast_loopback_threads"] = lambda: bench_broadcast(False)
+BENCHES["broadcast_loopback_event_loop"] = lambda: bench_broadcast(True)
+BENCHES["publish_loopback_event_loop"] = lambda: bench_broadcast(True, num_clients=128, num_subscribers=16)
+
+#fcn to run the benches, returns name -> us per op
+def run_benches(names, repeat=5, min_time=0.2):
+    results = {}
+    for name in names:
+        setup = BENCHES[name]()
+        fcn, ops = setup[0], setup[1]
+        try:
+            fcn() #warm up
+            #enough calls per run to take about min_time
+            t = time.perf_counter()
+            fcn()
+            number = max(1, int(min_time / max(time.perf_counter() - t, 1e-9)))
+            best = min(timeit.repeat(fcn, number=number, repeat=repeat)) / number
+        finally:
+            if len(setup) > 2:
+                setup[2]()
+        results[name] = best / ops * 1e6
+        print("{:34s} {:10.3f} us/op".format(name, results[name]))
+    return results
+
+#fcn to compare results to a baseline, returns names that got slower than threshold x baseline
+def compare(results, baseline, threshold):
+    regressions = []
+    print("\nvs baseline ({}):".format(baseline.get('time', '?')))
+    for name, us in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print("{:34s} (new)".format(name))
+            continue
+        ratio = us / base
+        slower = ratio > threshold
+        if slower:
+            regressions.append(name)
+        print("{:34s} {:10.3f} -> {:10.3f} us/op  x{:.2f}{}".format(name, base, us, ratio, "  REGRESSION" if slower else ""))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="pyserver microbenchmarks")
+    parser.add_argument('--out', help="write results json here")
+    parser.add_argument('--baseline', default='bench_baseline.json', help="results json to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="save these results as the baseline")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slower than threshold x baseline is a regression")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help="only run benches with this in their name")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHES if args.filter in name]
+    results = {
+        'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': run_benches(names, repeat=args.repeat),
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("saved baseline to", args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results['results'], baseline, args.threshold)
+        if regressions:
+            print("\n{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+#python loadtest.py example --clients 100,500,1000 --duration 10 --serve
+#python loadtest.py uno --clients 400 --players 4 --duration 10 --serve --event-loop
+#python loadtest.py uno --clients 100 --duration 5 --serve --event-loop --capture uno.cap   (then python replay.py uno.cap --serve uno --event-loop)
+#network load generator: opens lots of synthetic client connections to a running server (or one it starts with --serve),
+#drives a message mix and reports messages/sec and p50/p99/p999 round trip latency
+#HOW IT WORKS:
+# a client connection here is a socket + FrameReader + the same encode/serializers GenericClient/UnoClient use,
+#  all of them driven from one selector loop (per --procs process) so thousands of them don't need thousands of threads
+# every client keeps one request in flight (closed loop), waiting --think seconds between a reply and its next request
+# example mode talks to LoadServer (below): 'echo' (tid request, like ExampleServerWithHeader), 'state' (pickled state back),
+#  'broadcast' (sent to everyone, latency is until the sender gets its own copy back) and 'direct' (server sends it to the
+#  tid named in the message, the client's own, like ExampleServerWithHeader's direct send)
+# uno mode plays bot games on UnoServer: clients quick join rooms, play a random legal card on their turn, ack every delta
+#  and join a new room when their game ends. Latency is from sending a move until the mover gets the next delta
+# --clients takes a list, each step runs on fresh connections, so the table shows where the server saturates
+import sys
+import time
+import random
+import socket
+import argparse
+import selectors
+import heapq
+import multiprocessing
+from array import array
+sys.path.append('../')
+from pyserver.GenericServer import *
+from pyserver.UNO import uno
+from pyserver.UNO.uno_protocol import *
+
+#LoadServer header codes
+ECHO_CODE = 1
+BROADCAST_CODE = 2
+STATE_REQUEST_CODE = 3
+DIRECT_CODE = 4
+MIX_CODES = {'echo': ECHO_CODE, 'broadcast': BROADCAST_CODE, 'state': STATE_REQUEST_CODE, 'direct': DIRECT_CODE}
+
+#server for example mode: the ExampleServerWithHeader message types, with codes that work for any number of clients
+class LoadServer(GenericHeader, GenericServer):
+    def __init__(self, max_connections, host, port, debug=False, **kwargs):
+        super().__init__(max_connections, host, port, debug=debug, **kwargs)
+        self.set_header()
+        self.state = {"test_var_int": 1, "test_var_str": "hi", "test_var_arr": [1, 2, ["asd"]]}
+
+    @header_code(ECHO_CODE)
+    def tid_request(self, data, tid=None):
+        self.send_message(str(tid), tid, header=ECHO_CODE)
+
+    @header_code(BROADCAST_CODE)
+    def broadcast(self, data, tid=None):
+        self.broadcast_message(data.decode('utf-8'), header=BROADCAST_CODE)
+
+    @header_code(STATE_REQUEST_CODE)
+    def state_request(self, data, tid=None):
+        self.send_message(self.state, tid, header=0, pickle=True)
+
+    #data is "<tid to send to>:<msg>"
+    @header_code(DIRECT_CODE)
+    def direct(self, data, tid=None):
+        recv_tid, msg = data.decode('utf-8').split(':', 1)
+        self.send_message(msg, int(recv_tid), header=DIRECT_CODE)
+
+    def parse_message(self, data, tid):
+        self.decode(data, tid=tid)
+
+#encode + serializers of a client, without a connection (GenericServer.__init__ isn't called)
+class LoadCodec(GenericHeader, GenericServer):
+    def __init__(self):
+        self.debug = False
+        self.max_data_size = 2048
+        self.set_header()
+        set_uno_serializers(self)
+
+#one synthetic client
+class LoadConnection:
+    def __init__(self, test, cid, sock):
+        self.test = test
+        self.cid = cid
+        self.sock = sock
+        self.reader = FrameReader()
+        self.out = bytearray()
+        #(name, send time, broadcast token) of the request in flight, None if waiting to send
+        self.pending = None
+        self.seq = 0
+
+    def send(self, frame):
+        self.out += frame
+        self.test.flush(self)
+
+    #fcn to send a request and wait for its reply
+    def request(self, name, frame, token=None):
+        self.pending = (name, time.perf_counter(), token)
+        self.send(frame)
+
+    #fcn to record the round trip of the request in flight
+    def replied(self):
+        name, sent, token = self.pending
+        self.test.record(name, time.perf_counter() - sent)
+        self.pending = None
+
+class ExampleConnection(LoadConnection):
+    def __init__(self, test, cid, sock):
+        super().__init__(test, cid, sock)
+        self.tid = None
+
+    def start(self):
+        self.request('echo', self.test.codec.encode("tid?", header=ECHO_CODE))
+
+    def next_request(self):
+        name = self.test.pick()
+        codec = self.test.codec
+        self.seq += 1
+        token = "{}.{}".format(self.cid, self.seq)
+        if name == 'direct':
+            frame = codec.encode("{}:{}".format(self.tid, token), header=DIRECT_CODE)
+        else:
+            frame = codec.encode(token, header=MIX_CODES[name])
+        self.request(name, frame, token)
+
+    def on_frame(self, code, data):
+        if code == BROADCAST_CODE:
+            #everyone's broadcasts arrive here, only our own ends our request
+            if self.pending is not None and self.pending[2] == bytes(data).decode('utf-8'):
+                self.replied()
+                self.test.schedule(self)
+            return
+        if self.pending is None:
+            return
+        if code == ECHO_CODE and self.tid is None:
+            self.tid = int(bytes(data))
+        self.replied()
+        self.test.schedule(self)
+
+class UnoConnection(LoadConnection):
+    def __init__(self, test, cid, sock):
+        super().__init__(test, cid, sock)
+        self.uno_game = uno.UnoPlayerView()
+        self.sync = ClientSync()
+        #game over, waiting to join another room
+        self.game_over = False
+
+    def start(self):
+        self.send(self.test.codec.encode("Init message", header=INIT_PLAYER_CODE))
+
+    #rejoin after a game ended (server drops the room once it has a winner, so INIT_PLAYER_CODE quick joins a new one)
+    def next_request(self):
+        self.game_over = False
+        self.sync = ClientSync()
+        self.start()
+
+    def on_frame(self, code, data):
+        if code != DELTA_CODE:
+            #JOIN_ROOM_CODE replies + error strings
+            return
+        codec = self.test.codec
+        delta = codec.bytestring_to_obj(bytes(data), DELTA_CODE)
+        sync_state = self.sync.apply(delta)
+        if sync_state is None:
+            self.start()
+            return
+        self.uno_game.set_sync_state(sync_state)
+        self.send(codec.encode({'version': delta['version']}, header=ACK_CODE, pickle=True))
+        game = self.uno_game
+        if self.pending is not None:
+            self.replied()
+        if game.winner is not None:
+            if not self.game_over:
+                self.game_over = True
+                #one count per room
+                if game.player_id == 0:
+                    self.test.games += 1
+                self.test.schedule(self)
+            return
+        if game.turn == game.player_id and self.pending is None:
+            hand = game.player_hands[game.player_id]
+            color = random.choice(uno.CARD_COLORS)
+            #cards it can play, draw only if there are none
+            options = game.legal_moves()[:-1] or [uno.DRAW_MOVE]
+            index = random.choice(options)
+            move = {'index': index, 'chosen_color': color if game.requires_color(index) else ''}
+            self.request('move', codec.encode(move, header=MOVE_CODE, pickle=True))
+
+#one step of the load test in this process: num_clients connections for duration seconds
+class LoadTest:
+    def __init__(self, mode, host, port, num_clients, duration, mix, think, seed):
+        self.mode = mode
+        self.num_clients = num_clients
+        self.duration = duration
+        self.think = think
+        self.rng = random.Random(seed)
+        random.seed(seed)
+        self.mix_names = list(mix)
+        self.mix_weights = list(mix.values())
+        self.codec = LoadCodec()
+        self.selector = selectors.DefaultSelector()
+        #name -> array of round trip seconds
+        self.latencies = {}
+        self.received = 0
+        self.sent = 0
+        self.games = 0
+        self.errors = 0
+        #(time, cid) for clients waiting out their think time
+        self.timers = []
+        connection_class = UnoConnection if mode == 'uno' else ExampleConnection
+        self.connections = []
+        for cid in range(num_clients):
+            sock = socket.create_connection((host, port))
+            #don't let Nagle on our side hold requests back, we want to see the server's latency
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            conn = connection_class(self, cid, sock)
+            self.connections.append(conn)
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def pick(self):
+        return self.rng.choices(self.mix_names, self.mix_weights)[0]
+
+    def record(self, name, seconds):
+        if name not in self.latencies:
+            self.latencies[name] = array('d')
+        self.latencies[name].append(seconds)
+
+    #fcn to make the next request of conn, after the think time
+    def schedule(self, conn):
+        if self.think <= 0:
+            conn.next_request()
+            return
+        heapq.heappush(self.timers, (time.perf_counter() + self.rng.expovariate(1 / self.think), conn.cid))
+
+    #fcn to write as much of conn's output as the socket takes
+    def flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.out)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.errors += 1
+            conn.out.clear()
+            return
+        del conn.out[:sent]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.out else selectors.EVENT_READ
+        if self.selector.get_key(conn.sock).events != events:
+            self.selector.modify(conn.sock, events, conn)
+
+    def read(self, conn):
+        try:
+            frames = conn.reader.recv_messages(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            frames = None
+        if frames is None:
+            self.errors += 1
+            self.selector.unregister(conn.sock)
+            return
+        header_size = self.codec.header_size
+        for frame in frames:
+            self.received += 1
+            conn.on_frame(int.from_bytes(frame[:header_size], "big"), frame[header_size:])
+
+    def run(self):
+        for conn in self.connections:
+            conn.start()
+        start = time.perf_counter()
+        end = start + self.duration
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            while self.timers and self.timers[0][0] <= now:
+                due, cid = heapq.heappop(self.timers)
+                self.connections[cid].next_request()
+            timeout = end - now
+            if self.timers:
+                timeout = min(timeout, self.timers[0][0] - now)
+            for key, mask in self.selector.select(max(timeout, 0)):
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self.read(conn)
+                if mask & selectors.EVENT_WRITE and conn.out:
+                    self.flush(conn)
+        elapsed = time.perf_counter() - start
+        for conn in self.connections:
+            conn.sock.close()
+        self.selector.close()
+        return {'elapsed': elapsed, 'received': self.received, 'games': self.games, 'errors': self.errors,
+                'latencies': {name: lat.tobytes() for name, lat in self.latencies.items()}}
+
+#fcn to run one step in a worker process
+def run_step(args):
+    mode, host, port, num_clients, duration, mix, think, seed = args
+    return LoadTest(mode, host, port, num_clients, duration, mix, think, seed).run()
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q*len(sorted_values)))]
+
+#fcn to merge the results of the worker processes + print them
+def report(num_clients, results):
+    elapsed = max(result['elapsed'] for result in results)
+    received = sum(result['received'] for result in results)
+    latencies = {}
+    for result in results:
+        for name, data in result['latencies'].items():
+            lat = array('d')
+            lat.frombytes(data)
+            latencies.setdefault(name, array('d')).extend(lat)
+    replies = sum(len(lat) for lat in latencies.values())
+    games = sum(result['games'] for result in results)
+    errors = sum(result['errors'] for result in results)
+    print("{:>7d} clients: {:9.0f} req/s  {:9.0f} msgs recv/s{}{}".format(num_clients, replies/elapsed, received/elapsed,
+        "  {:.1f} games/s".format(games/elapsed) if games else "", "  {} errors".format(errors) if errors else ""))
+    for name in sorted(latencies):
+        lat = sorted(latencies[name])
+        print("    {:10s} n={:<8d} p50 {:8.2f} ms  p99 {:8.2f} ms  p999 {:8.2f} ms  max {:8.2f} ms".format(name, len(lat),
+            percentile(lat, 0.5)*1e3, percentile(lat, 0.99)*1e3, percentile(lat, 0.999)*1e3, lat[-1]*1e3))
+
+#fcn to run a server in its own process (--serve), until stop is set
+#capture=path records its traffic for replay.py, seed seeds random first (uno decks) so a replay can deal the same cards
+def serve(mode, host, port, max_connections, event_loop, num_players, stop, capture=None, seed=None):
+    if seed is not None:
+        random.seed(seed)
+    if capture is not None:
+        capture = Capture(capture, seed=seed)
+    if mode == 'uno':
+        from pyserver.UNO.uno_server import UnoServer
+        uno.UnoGame.verbose = False
+        serv = UnoServer(max_connections, host, port, event_loop=event_loop, num_players=num_players, capture=capture)
+    else:
+        serv = LoadServer(max_connections, host, port, event_loop=event_loop, capture=capture)
+    serv.server_thread.daemon = True
+    serv.run()
+    stop.wait()
+    serv.end()
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=') if '=' in item else (item, 1)
+        if name not in MIX_CODES:
+            raise ValueError("unknown message type {} in --mix, use {}".format(name, ", ".join(MIX_CODES)))
+        weights[name] = float(weight)
+    return weights
+
+def main():
+    parser = argparse.ArgumentParser(description="pyserver network load generator")
+    parser.add_argument('mode', choices=['example', 'uno'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1021)
+    parser.add_argument('--clients', default='100', help="number of connections, comma separated for several steps")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per step")
+    parser.add_argument('--mix', default='echo=1,state=1,broadcast=1,direct=1', help="example mode message weights")
+    parser.add_argument('--think', type=float, default=0, help="mean seconds between a reply and the next request")
+    parser.add_argument('--procs', type=int, default=1, help="processes to spread the connections over")
+    parser.add_argument('--players', type=int, default=4, help="uno mode players per room")
+    parser.add_argument('--serve', action='store_true', help="start the server too (in its own process)")
+    parser.add_argument('--event-loop', action='store_true', help="with --serve, use the server's event loop mode")
+    parser.add_argument('--capture', help="with --serve, record the server's traffic to this file (see replay.py)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    steps = [int(n) for n in args.clients.split(',')]
+    mix = parse_mix(args.mix)
+    stop = None
+    if args.serve:
+        stop = multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, daemon=True,
+            args=(args.mode, args.host, args.port, sum(steps), args.event_loop, args.players, stop, args.capture, args.seed))
+        server.start()
+        time.sleep(0.5)
+    print("{} mode against {}:{}, {}s per step".format(args.mode, args.host, args.port, args.duration))
+    with multiprocessing.Pool(args.procs) as pool:
+        for num_clients in steps:
+            per_proc = [num_clients // args.procs + (1 if i < num_clients % args.procs else 0) for i in range(args.procs)]
+            jobs = [(args.mode, args.host, args.port, n, args.duration, mix, args.think, args.seed + i) for i, n in enumerate(per_proc) if n > 0]
+            report(num_clients, pool.map(run_step, jobs))
+    if stop is not None:
+        stop.set()
+        server.join(5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#python replay.py uno.cap --speed 0 --serve uno --event-loop
+#python replay.py uno.cap --host 127.0.0.1 --port 1019 --speed 2
+#python replay.py uno.cap --info
+#replays a capture (see GenericCapture, eg from loadtest.py --serve --capture) against a server: every captured client
+#connects, sends what it sent and goes when it went, so the server can be timed / profiled on real traffic without real clients
+#HOW IT WORKS:
+# records are replayed in the order they were captured, at --speed times the original pace (0 = as fast as possible)
+# before sending a message, the replay waits (up to --gate-timeout) until the server sent every client as many frames as it
+#  had in the capture by then: the message may be an answer to them (eg a move after the delta saying it's our turn), and
+#  messages of different clients must not reach the server in another order than it handled them in (eg players joining
+#  at once would get each other's seats). So even a fast replay gives the server the same messages in the same order
+#  Framed (GenericHeader) servers only. A client still missing frames when the gate times out stopped matching the capture
+#  (its game went another way), it isn't waited for after that
+#  NOTE: without event_loop the server handles clients in their own threads, so the capture's order is only the order messages
+#  were read in, capture with event_loop=True for replays that play out the same
+# the server hands out its own tids, and needs the random state the captured one had if its replies depend on random
+#  (eg UnoServer decks): --serve seeds the server it starts with the capture's seed
+# requests (GenericHeader REQUEST_CODE) are timed until their reply, gate waits are timed too (how long the server took
+#  to send what a client was waiting for). To profile a server, run it under a profiler and replay against it
+# all clients are driven from one selector loop, like loadtest.py
+import sys
+import time
+import socket
+import argparse
+import selectors
+import multiprocessing
+from array import array
+sys.path.append('../')
+from pyserver.GenericServer import *
+from pyserver import loadtest
+
+#one captured client
+class ReplayClient:
+    def __init__(self, tid, sock, reader):
+        #tid it had in the capture
+        self.tid = tid
+        self.sock = sock
+        self.reader = reader
+        self.out = bytearray()
+        #frames the server sent it so far, and frames the captured server had sent it by now
+        self.received = 0
+        self.expected = 0
+        #rid -> send time of requests waiting for their reply
+        self.requests = {}
+        #client went in the capture, close once out is sent
+        self.closing = False
+        #False once the server stopped sending it what the captured one did, the gate doesn't wait for it anymore
+        self.gated = True
+
+class Replayer:
+    #records between polls for replies when replaying as fast as possible
+    poll_every = 64
+
+    def __init__(self, path, host, port, speed=1.0, gate=True, gate_timeout=0.25, drain=1.0):
+        self.capture = CaptureReader(path)
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.gate = gate and self.capture.framed
+        self.gate_timeout = gate_timeout
+        #seconds to wait for replies after the last record
+        self.drain = drain
+        self.selector = selectors.DefaultSelector()
+        #captured tid -> client connected for it
+        self.clients = {}
+        #frames gated clients are still missing, the gate waits until it is 0
+        self.behind = 0
+        self.latencies = array('d')
+        self.gate_waits = array('d')
+        #clients whose gate timed out (server sent less than the captured one)
+        self.diverged = 0
+        self.records = 0
+        self.sent = 0
+        self.received = 0
+        self.captured_sends = 0
+        self.errors = 0
+        #time of the last record, how long the capture took
+        self.last_time = 0
+
+    def run(self):
+        start = time.perf_counter()
+        for t, kind, tid, data in self.capture:
+            self.records += 1
+            self.last_time = t
+            if self.speed > 0:
+                self.wait_until(start + t / self.speed)
+            elif self.records % self.poll_every == 0:
+                self.poll(0)
+            if kind == CAPTURE_CONNECT:
+                self.connect(tid)
+            elif kind == CAPTURE_RECV:
+                self.send(tid, data)
+            elif kind == CAPTURE_SEND:
+                self.captured_sends += 1
+                client = self.clients.get(tid)
+                if client is not None and client.gated:
+                    client.expected += 1
+                    if client.received < client.expected:
+                        self.behind += 1
+            elif kind == CAPTURE_DISCONNECT:
+                self.disconnect(tid)
+            del data
+        replayed = time.perf_counter() - start
+        #let the server answer what is still in flight
+        self.wait_until(time.perf_counter() + self.drain,
+                        lambda: all(len(client.requests) == 0 for client in self.clients.values()))
+        for client in list(self.clients.values()):
+            self.close_client(client)
+        self.selector.close()
+        self.capture.close()
+        return {'records': self.records, 'elapsed': replayed, 'captured_duration': self.last_time,
+                'sent': self.sent, 'received': self.received, 'captured_sends': self.captured_sends, 'errors': self.errors,
+                'diverged': self.diverged, 'latencies': self.latencies, 'gate_waits': self.gate_waits}
+
+    #fcn to handle replies until deadline (or until done() is true)
+    def wait_until(self, deadline, done=None):
+        while True:
+            now = time.perf_counter()
+            if now >= deadline or (done is not None and done()):
+                return
+            self.poll(deadline - now)
+
+    def poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            client = key.data
+            if client.sock.fileno() == -1:
+                #closed by an earlier event of this round
+                continue
+            if mask & selectors.EVENT_READ:
+                self.read(client)
+            if mask & selectors.EVENT_WRITE and client.out:
+                self.flush(client)
+
+    def connect(self, tid):
+        try:
+            sock = socket.create_connection((self.host, self.port))
+        except OSError:
+            self.errors += 1
+            return
+        set_nodelay(sock)
+        sock.setblocking(False)
+        reader = FrameReader() if self.capture.framed else RawReader(65536)
+        client = ReplayClient(tid, sock, reader)
+        self.clients[tid] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    #fcn to send a captured message, once the server sent the client what it had got before it in the capture
+    def send(self, tid, data):
+        client = self.clients.get(tid)
+        if client is None:
+            #connected before the capture started, or connect failed
+            return
+        if self.gate and self.behind > 0:
+            start = time.perf_counter()
+            self.wait_until(start + self.gate_timeout, lambda: self.behind == 0)
+            self.gate_waits.append(time.perf_counter() - start)
+            if self.behind > 0:
+                for behind in self.clients.values():
+                    if behind.gated and behind.received < behind.expected:
+                        self.diverged += 1
+                        self.ungate(behind)
+        if self.capture.framed:
+            header_size = self.capture.header_size
+            if int.from_bytes(data[:header_size], "big") == REQUEST_CODE:
+                client.requests[Request.rid_struct.unpack_from(data, header_size)[0]] = time.perf_counter()
+            client.out += FrameReader.prefix.pack(len(data))
+        client.out += data
+        self.sent += 1
+        self.flush(client)
+
+    def disconnect(self, tid):
+        client = self.clients.pop(tid, None)
+        if client is None:
+            return
+        if client.out:
+            client.closing = True
+        else:
+            self.close_client(client)
+
+    def read(self, client):
+        try:
+            frames = client.reader.recv_messages(client.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            frames = None
+        if frames is None:
+            #server closed it
+            self.close_client(client)
+            return
+        header_size = self.capture.header_size
+        for frame in frames:
+            client.received += 1
+            self.received += 1
+            if client.gated and client.received <= client.expected:
+                self.behind -= 1
+            if client.requests and int.from_bytes(frame[:header_size], "big") == REQUEST_CODE:
+                sent = client.requests.pop(Request.rid_struct.unpack_from(frame, header_size)[0], None)
+                if sent is not None:
+                    self.latencies.append(time.perf_counter() - sent)
+
+    #fcn to write as much of client's output as the socket takes
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.out)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.errors += 1
+            self.close_client(client)
+            return
+        del client.out[:sent]
+        if client.closing and not client.out:
+            self.close_client(client)
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if client.out else selectors.EVENT_READ
+        if self.selector.get_key(client.sock).events != events:
+            self.selector.modify(client.sock, events, client)
+
+    #fcn to stop waiting for client's frames
+    def ungate(self, client):
+        if client.gated:
+            self.behind -= max(0, client.expected - client.received)
+            client.gated = False
+
+    def close_client(self, client):
+        if client.sock.fileno() == -1:
+            return
+        self.ungate(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        if self.clients.get(client.tid) is client:
+            del self.clients[client.tid]
+
+def report(result):
+    print("replayed {} records in {:.2f}s (captured over {:.2f}s)".format(result['records'], result['elapsed'], result['captured_duration']))
+    print("    sent {} msgs, received {} frames (capture had {}){}".format(result['sent'], result['received'], result['captured_sends'],
+        "  {} errors".format(result['errors']) if result['errors'] else ""))
+    for name, values in (('requests', result['latencies']), ('gate waits', result['gate_waits'])):
+        if len(values) == 0:
+            continue
+        values = sorted(values)
+        print("    {:10s} n={:<8d} p50 {:8.2f} ms  p99 {:8.2f} ms  max {:8.2f} ms".format(name, len(values),
+            loadtest.percentile(values, 0.5)*1e3, loadtest.percentile(values, 0.99)*1e3, values[-1]*1e3))
+    if result['diverged']:
+        print("    {} clients got less than in the capture and were replayed without waiting".format(result['diverged']))
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a pyserver capture against a server")
+    parser.add_argument('capture', help="capture file (see GenericCapture)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1021)
+    parser.add_argument('--speed', type=float, default=1, help="times the captured pace, 0 for as fast as possible")
+    parser.add_argument('--no-gate', action='store_true', help="don't wait for the server's frames before sending")
+    parser.add_argument('--gate-timeout', type=float, default=0.25, help="seconds a message waits for the server's frames at most")
+    parser.add_argument('--drain', type=float, default=1, help="seconds to wait for replies after the last record")
+    parser.add_argument('--info', action='store_true', help="only print what is in the capture")
+    parser.add_argument('--serve', choices=['example', 'uno'], help="start this server too (in its own process), see loadtest.py")
+    parser.add_argument('--event-loop', action='store_true', help="with --serve, use the server's event loop mode")
+    parser.add_argument('--players', type=int, default=4, help="with --serve uno, players per room")
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.capture)
+    summary = reader.summary()
+    reader.close()
+    print("{}: {} records over {:.2f}s, {} clients, {} msgs in ({} B), {} frames out ({} B), seed {}".format(args.capture,
+        summary['records'], summary['duration'], summary['counts']['connect'], summary['counts']['recv'], summary['bytes']['recv'],
+        summary['counts']['send'], summary['bytes']['send'], summary['seed']))
+    if args.info:
+        return
+    stop = None
+    if args.serve:
+        stop = multiprocessing.Event()
+        #seeded like the captured server
+        server = multiprocessing.Process(target=loadtest.serve, daemon=True, args=(args.serve, args.host, args.port,
+            max(1, summary['counts']['connect']), args.event_loop, args.players, stop, None, summary['seed']))
+        server.start()
+        time.sleep(0.5)
+    replayer = Replayer(args.capture, args.host, args.port, speed=args.speed, gate=not args.no_gate,
+                        gate_timeout=args.gate_timeout, drain=args.drain)
+    report(replayer.run())
+    if stop is not None:
+        stop.set()
+        server.join(5)
+
+if __name__ == "__main__":
+    main()
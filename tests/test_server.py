@@ -0,0 +1,346 @@
+#python -m pytest tests (the package is imported as pyserver, like everywhere else: the repo's parent dir goes on the path)
+import os
+import sys
+import time
+import asyncio
+import functools
+import random
+import socket
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from pyserver.GenericServer import *
+from pyserver.GenericClient import *
+from pyserver.GenericAsyncClient import *
+
+#fcn to send one framed message (header byte + data) from a raw socket
+def send_frame(sock, header, data):
+    frame = bytes([header]) + data
+    sock.sendall(FrameReader.prefix.pack(len(frame)) + frame)
+
+#fcn to block until the server closes sock, returns True if it did within timeout
+def closed_by_server(sock, timeout=2):
+    sock.settimeout(timeout)
+    try:
+        while sock.recv(4096):
+            pass
+    except socket.timeout:
+        return False
+    except OSError:
+        pass
+    return True
+
+#fcn to pick a port for a test server: under linux's ephemeral range (32768 up), so a connection left in TIME_WAIT by an
+#earlier test can't be holding it. Not from the random module, tests seed it
+def server_port():
+    return random.SystemRandom().randint(20000, 32000)
+
+#fcn to poll check() until it's true or timeout runs out, returns its last result
+def wait_until(check, timeout=2):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.01)
+    return check()
+
+class EventLoopTest(unittest.TestCase):
+    event_loop = True
+
+    def setUp(self):
+        self.port = server_port()
+        self.server = ExampleServerWithHeader(8, '127.0.0.1', self.port, debug=False, event_loop=self.event_loop)
+        self.server.run()
+        time.sleep(0.1)
+
+    def tearDown(self):
+        self.server.end()
+
+    #fcn to start another server like self.server with kwargs, it is ended with the test. Returns (server, port)
+    def serve(self, **kwargs):
+        port = server_port()
+        server = ExampleServerWithHeader(8, '127.0.0.1', port, debug=False, event_loop=self.event_loop, **kwargs)
+        server.run()
+        self.addCleanup(server.end)
+        time.sleep(0.1)
+        return server, port
+
+    #fcn to check the server still answers requests
+    def assert_serving(self):
+        client = ExampleClientWithHeader('127.0.0.1', self.port, debug=False)
+        client.run()
+        try:
+            reply = client.send_message(1, "", request=True).result(2)
+        finally:
+            client.end()
+        self.assertEqual(reply[0], 1)
+
+    #a length prefix is the peer's word: one over max_frame_size closes the connection before anything is allocated for it
+    def test_oversized_frame_closes_connection(self):
+        bad = socket.create_connection(('127.0.0.1', self.port))
+        bad.sendall(FrameReader.prefix.pack(MAX_FRAME_SIZE + 1) + b'\0'*64)
+        self.assertTrue(closed_by_server(bad))
+        bad.close()
+        self.assert_serving()
+
+    #unregistered code + bytes that aren't utf-8: unknown_code raises in the handler
+    def test_handler_error_only_drops_its_client(self):
+        bad = socket.create_connection(('127.0.0.1', self.port))
+        send_frame(bad, 200, b'\xff\xfe')
+        self.assertTrue(closed_by_server(bad))
+        bad.close()
+        self.assert_serving()
+
+    #a StructSerializer message that doesn't decode is a ProtocolError, the server drops just that client
+    def test_undecodable_struct_message_drops_client(self):
+        self.server.set_serializer(7, StructSerializer([('color', EnumField(['red', 'blue']))]))
+        self.server.register_handler(7, lambda data, **kwargs: self.server.bytestring_to_obj(data, 7))
+        bad = socket.create_connection(('127.0.0.1', self.port))
+        send_frame(bad, 7, b'\x05')
+        self.assertTrue(closed_by_server(bad))
+        bad.close()
+        self.assert_serving()
+
+    #requests and their replies are counted under the code they wrap
+    def test_request_metrics_by_code(self):
+        self.assert_serving()
+        snapshot = self.server.metrics_snapshot()
+        self.assertEqual(snapshot['msgs_in'], {1: 1})
+        self.assertEqual(snapshot['msgs_out'], {1: 1})
+
+    #handler timings are keyed by code: a partial has no __name__, and the same fcn on two codes stays two entries
+    def test_handler_timings_by_code(self):
+        handled = []
+        for code in (5, 6):
+            self.server.register_handler(code, functools.partial(lambda code, data, **kwargs: handled.append(code), code))
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        send_frame(sock, 5, b'')
+        send_frame(sock, 6, b'')
+        send_frame(sock, 6, b'')
+        deadline = time.time() + 2
+        while len(handled) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        sock.close()
+        handlers = self.server.metrics_snapshot()['handlers']
+        self.assertEqual(handlers[5]['calls'], 1)
+        self.assertEqual(handlers[6]['calls'], 2)
+        self.assertIsNone(handlers[5]['name'])
+
+    #a client that sends nothing for idle_timeout is disconnected, its slot is free again
+    def test_idle_client_dropped(self):
+        server, port = self.serve(idle_timeout=0.3)
+        sock = socket.create_connection(('127.0.0.1', port))
+        start = time.monotonic()
+        self.assertTrue(closed_by_server(sock))
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+        sock.close()
+        self.assertTrue(wait_until(lambda: len(server.free_tids) == 1))
+        self.assertEqual(server.client_tids(), ())
+        self.assertEqual(server.metrics_snapshot()['idle_dropped'], 1)
+
+    #a client that answers heartbeats stays connected however long it has nothing to say, one that doesn't (raw socket) is dropped
+    def test_heartbeat_keeps_client_alive(self):
+        server, port = self.serve(heartbeat=0.1, idle_timeout=0.4)
+        client = ExampleClientWithHeader('127.0.0.1', port, debug=False)
+        client.run()
+        self.addCleanup(client.end)
+        silent = socket.create_connection(('127.0.0.1', port))
+        self.assertTrue(closed_by_server(silent))
+        silent.close()
+        time.sleep(0.6)
+        self.assertEqual(len(server.client_tids()), 1)
+        self.assertTrue(client.running)
+        self.assertEqual(server.metrics_snapshot()['idle_dropped'], 1)
+
+    #a topic's messages go to its subscribers only, closing the topic takes everyone off it
+    def test_publish_to_subscribers(self):
+        got = {}
+        clients = []
+        for i in range(3):
+            client = ExampleClientWithHeader('127.0.0.1', self.port, debug=False)
+            client.register_handler(9, functools.partial(lambda i, data, **kwargs: got.setdefault(i, []).append(bytes(data)), i))
+            client.run()
+            self.addCleanup(client.end)
+            clients.append(client)
+        clients[0].subscribe('news').result(2)
+        clients[1].subscribe('news').result(2)
+        clients[2].subscribe('other').result(2)
+        self.assertEqual(self.server.publish('news', 'hi', header=9), 2)
+        self.assertTrue(wait_until(lambda: len(got) == 2))
+        self.assertEqual(got, {0: [b'hi'], 1: [b'hi']})
+        clients[1].unsubscribe('news').result(2)
+        self.assertEqual(self.server.publish('news', 'again', header=9), 1)
+        self.server.close_topic('news')
+        self.assertEqual(self.server.publish('news', 'gone', header=9), 0)
+        self.assertEqual(list(self.server.topics), ['other'])
+        self.assertEqual([topics for topics in self.server.client_topics if topics], [{'other'}])
+        self.assertTrue(wait_until(lambda: len(got[0]) == 2))
+        time.sleep(0.1)
+        self.assertEqual(got, {0: [b'hi', b'again'], 1: [b'hi']})
+
+#same tests with a reader thread per client
+class ThreadModeTest(EventLoopTest):
+    event_loop = False
+
+#clients against a bare listening socket, the test plays the server
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    #a message the client can't handle closes the connection: pending requests fail, wait_for returns
+    def test_handler_error_closes_connection(self):
+        client = ExampleClientWithHeader('127.0.0.1', self.port, debug=False)
+        client.run()
+        server_side, address = self.listener.accept()
+        future = client.send_message(1, "", request=True)
+        #code 0 is a pickled object, these bytes aren't one
+        send_frame(server_side, 0, b'not a pickle')
+        with self.assertRaises(ConnectionError):
+            future.result(2)
+        self.assertFalse(client.wait_for(lambda: False, timeout=2))
+        self.assertFalse(client.running)
+        client.receiver_thread.join(2)
+        self.assertFalse(client.receiver_thread.is_alive())
+        self.assertTrue(closed_by_server(server_side))
+        server_side.close()
+
+    #fcn to run the async client against the test's listener: sends a request, then the test's frame comes in
+    def run_async_client(self, frame, max_frame_size=MAX_FRAME_SIZE):
+        async def session():
+            client = ExampleAsyncClientWithHeader('127.0.0.1', self.port, debug=False)
+            client.max_frame_size = max_frame_size
+            await client.connect()
+            server_side = await asyncio.get_running_loop().run_in_executor(None, lambda: self.listener.accept()[0])
+            future = client.send_message(1, "", request=True)
+            server_side.sendall(frame)
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(future, 2)
+            self.assertFalse(client.running)
+            self.assertTrue(closed_by_server(server_side))
+            server_side.close()
+            await client.end()
+        asyncio.run(session())
+
+    def test_async_handler_error_closes_connection(self):
+        self.run_async_client(FrameReader.prefix.pack(13) + bytes([0]) + b'not a pickle')
+
+    #a length prefix over max_frame_size is a ProtocolError, nothing is read (or allocated) for it
+    def test_async_oversized_frame_closes_connection(self):
+        self.run_async_client(FrameReader.prefix.pack(1 << 20) + b'x'*64, max_frame_size=1024)
+
+#socket stand in: recv_into hands out data in chunks
+class ChunkedConnection:
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+
+    def recv_into(self, view):
+        n = min(len(view), self.chunk, len(self.data))
+        view[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+class FrameReaderTest(unittest.TestCase):
+    def test_buffer_shrinks_after_big_frame(self):
+        big = b'x'*100000
+        data = FrameReader.prefix.pack(len(big)) + big + FrameReader.prefix.pack(2) + b'hi'
+        reader = FrameReader(2048)
+        connection = ChunkedConnection(data, 4096)
+        frames = []
+        while connection.data:
+            frames += [bytes(frame) for frame in reader.recv_messages(connection)]
+        self.assertEqual(frames, [big, b'hi'])
+        reader.make_room()
+        self.assertEqual(len(reader.buffer), 2048)
+
+    def test_max_frame_size(self):
+        reader = FrameReader(2048, max_frame_size=10)
+        with self.assertRaises(ProtocolError):
+            reader.recv_messages(ChunkedConnection(FrameReader.prefix.pack(11) + b'x'*11, 4096))
+
+#deadlines are given as offsets from base, the wheel starts at time.monotonic()
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(0.1, 8)
+        self.base = time.monotonic()
+
+    def schedule(self, key, offset):
+        self.wheel.schedule(key, self.base + offset)
+
+    def expire(self, offset):
+        return sorted(self.wheel.expire(self.base + offset))
+
+    #keys come out once their deadline passed, not just their bucket: a deadline later in the current tick waits
+    def test_expire(self):
+        self.schedule('a', 0.15)
+        self.schedule('b', 0.17)
+        self.schedule('c', 0.35)
+        self.assertEqual(self.expire(0.1), [])
+        self.assertEqual(self.expire(0.16), ['a'])
+        self.assertEqual(self.expire(0.2), ['b'])
+        self.assertEqual(len(self.wheel), 1)
+        #a long pause: every bucket is looked at once
+        self.assertEqual(self.expire(5), ['c'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        self.schedule('a', 0.15)
+        self.schedule('b', 0.15)
+        self.wheel.cancel('a')
+        self.wheel.cancel('a')
+        self.wheel.cancel('never scheduled')
+        self.assertEqual(self.expire(0.2), ['b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    #schedule again replaces the key's deadline, sooner or later, also one more than a turn of the wheel away
+    #(same bucket as a sooner tick, it stays until its own deadline)
+    def test_reschedule(self):
+        self.schedule('a', 0.15)
+        self.schedule('a', 1.25)
+        self.schedule('b', 0.55)
+        self.schedule('b', 0.05)
+        self.assertEqual(len(self.wheel), 2)
+        self.assertEqual(self.expire(0.1), ['b'])
+        self.assertEqual(self.expire(0.3), [])
+        self.assertEqual(self.expire(0.5), [])
+        self.assertEqual(self.expire(1.2), [])
+        self.assertEqual(self.expire(1.3), ['a'])
+        #a deadline that passed already goes in the current bucket, it is due at the next expire
+        self.schedule('c', -1)
+        self.assertEqual(self.expire(1.3), ['c'])
+
+class OutboundQueueTest(unittest.TestCase):
+    #replies are never dropped to make space, the oldest other message goes instead
+    def test_drop_oldest_keeps_replies(self):
+        for policy in ('drop_oldest', 'coalesce'):
+            queue = OutboundQueue(3, policy)
+            self.assertTrue(queue.put('reply', reply=True))
+            self.assertTrue(queue.put('a', 5))
+            self.assertTrue(queue.put('b', 6))
+            self.assertTrue(queue.put('c', 5))
+            self.assertEqual(queue.get_all(block=False), ['reply', 'b', 'c'])
+            self.assertEqual(queue.dropped, 1)
+
+    #a queue full of replies has nothing to drop: the client is disconnected instead
+    def test_full_of_replies_disconnects(self):
+        queue = OutboundQueue(2, 'drop_oldest')
+        self.assertTrue(queue.put('r1', reply=True))
+        self.assertTrue(queue.put('r2', reply=True))
+        self.assertFalse(queue.put('a'))
+        self.assertIsNone(queue.get_all(block=False))
+
+class StructSerializerTest(unittest.TestCase):
+    def test_bad_data_is_protocol_error(self):
+        serializer = StructSerializer([('index', 'h'), ('color', EnumField(['red', 'blue']))])
+        self.assertEqual(serializer.loads(serializer.dumps({'index': 3, 'color': 'blue'})), {'index': 3, 'color': 'blue'})
+        for data in (b'', b'\x00', b'\x00\x03\x09', b'\x00\x03\x01\x00'):
+            with self.assertRaises(ProtocolError):
+                serializer.loads(data)
+        strings = StructSerializer([('name', StringField()), ('values', ListField('i'))])
+        for data in (b'\x00\x02\xff\xfe\x00\x00', b'\x00\x00\x00\x05\x00'):
+            with self.assertRaises(ProtocolError):
+                strings.loads(data)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,457 @@
+#python -m pytest tests (the package is imported as pyserver, like everywhere else: the repo's parent dir goes on the path)
+import os
+import sys
+import time
+import random
+import asyncio
+import pickle
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from array import array
+from threading import Event
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from pyserver.GenericServer import *
+from pyserver.UNO import uno
+from pyserver.UNO.uno_server import *
+from pyserver.UNO.uno_client import *
+#uno_sim needs numpy, the rest of the package doesn't
+try:
+    import numpy as np
+    from pyserver.UNO import uno_sim
+except ImportError:
+    uno_sim = None
+
+uno.UnoGame.verbose = False
+
+#fcn to pick a port for a test server: under linux's ephemeral range (32768 up), so a connection left in TIME_WAIT by an
+#earlier test can't be holding it. Not from the random module, tests seed it
+def server_port():
+    return random.SystemRandom().randint(20000, 32000)
+
+#fcn to poll until check() is true, returns its last value
+def wait_until(check, timeout=2):
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.01)
+    return check()
+
+class UnoServerTest(unittest.TestCase):
+    event_loop = True
+
+    def setUp(self):
+        self.port = server_port()
+        self.server = UnoServer(8, '127.0.0.1', self.port, num_players=2, event_loop=self.event_loop)
+        self.server.run()
+        time.sleep(0.1)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.end()
+        self.server.end()
+
+    def connect(self):
+        client = UnoClient('127.0.0.1', self.port)
+        client.run()
+        self.clients.append(client)
+        return client
+
+    #a job still queued for a client that left must not run for the next client given its tid
+    def test_tid_not_reused_before_queued_jobs_ran(self):
+        block = Event()
+        for worker in range(len(self.server.workers.jobs)):
+            self.server.workers.submit(worker, block.wait)
+        a = self.connect()
+        a.join_room(0)
+        time.sleep(0.1)
+        a.end()
+        self.assertTrue(wait_until(lambda: len(self.server.client_tids()) == 0))
+        b = self.connect()
+        self.assertTrue(wait_until(lambda: len(self.server.client_tids()) == 1))
+        block.set()
+        time.sleep(0.3)
+        self.assertEqual(b.room_id, -1)
+        self.assertEqual(self.server.players, {})
+        self.assertEqual(self.server.rooms.get(0).players(), [])
+        #once the workers are past the old client's jobs, its tid is free again
+        self.assertTrue(wait_until(lambda: len(self.server.free_tids) == 1))
+
+    #rooms through RoomRegistry + RoomWorkers: create seats the creator, join by id and quick joins fill rooms (oldest open one
+    #first), a full room starts and isn't open anymore, a quick join with no open room makes one, a room everyone left is closed
+    #(room 0 is made by the server for clients that only send INIT_PLAYER_CODE)
+    def test_create_join_quick_join_close(self):
+        a, b, c, d, e, f, g, h = [self.connect() for i in range(8)]
+        a.create_room(3).result(2)
+        self.assertEqual((a.room_id, a.seat), (1, 0))
+        b.join_room(1).result(2)
+        self.assertEqual((b.room_id, b.seat), (1, 1))
+        c.create_room(2).result(2)
+        self.assertEqual((c.room_id, c.seat), (2, 0))
+        self.assertEqual(list(self.server.rooms.open_rooms), [0, 1, 2])
+        for client, room_seat in ((d, (0, 0)), (e, (0, 1)), (f, (1, 2)), (g, (2, 1))):
+            client.join_room().result(2)
+            self.assertEqual((client.room_id, client.seat), room_seat)
+        self.assertTrue(wait_until(lambda: all(self.server.rooms.get(room_id).started for room_id in range(3))))
+        self.assertEqual(list(self.server.rooms.open_rooms), [])
+        h.join_room().result(2)
+        self.assertEqual((h.room_id, h.seat), (3, 0))
+        self.assertEqual(self.server.rooms.get(3).info(), {'room_id': 3, 'num_players': 2, 'seated': 1, 'started': False, 'bots': 0})
+        for client in (a, b, f, h):
+            client.end()
+        self.assertTrue(wait_until(lambda: sorted(self.server.rooms.rooms) == [0, 2]))
+        self.assertEqual(list(self.server.rooms.open_rooms), [])
+        self.assertEqual(sorted(self.server.players), sorted(self.server.client_tids()))
+
+    #a spectator gets its room's public state when it subscribes and after each move, never a hand or a seat,
+    #and is taken off the room's topic when the room closes
+    def test_spectator(self):
+        a, b = self.connect(), self.connect()
+        a.init_uno().result(2)
+        b.init_uno().result(2)
+        self.assertTrue(wait_until(lambda: a.last_uno_update > 0 and b.last_uno_update > 0))
+        spectator = self.connect()
+        self.assertTrue(wait_until(lambda: len(self.server.client_tids()) == 3))
+        spectator_tid = (set(self.server.client_tids()) - set(self.server.players)).pop()
+        room = self.server.rooms.get(0)
+        spectator.spectate(0).result(2)
+        self.assertTrue(wait_until(lambda: 0 in spectator.watched))
+        self.assertEqual(spectator.watched[0], self.server.public_state(room))
+        player = a if a.my_turn() else b
+        player.send_move(DRAW_MOVE).result(2)
+        self.assertTrue(wait_until(lambda: spectator.watched[0]['moves'] == 1))
+        self.assertEqual(spectator.watched[0], self.server.public_state(room))
+        self.assertEqual(sorted(spectator.watched[0]), sorted(PUBLIC_STATE_SERIALIZER.keys))
+        self.assertEqual((spectator.room_id, spectator.seat, spectator.last_uno_update, spectator.sync.states), (-1, -1, 0, {}))
+        self.assertNotIn(spectator_tid, self.server.players)
+        a.end()
+        b.end()
+        self.assertTrue(wait_until(lambda: self.server.rooms.get(0) is None))
+        self.assertNotIn(room_topic(0), self.server.topics)
+        self.assertEqual(self.server.client_topics[spectator_tid], set())
+        self.assertTrue(spectator.running)
+
+class UnoServerThreadModeTest(UnoServerTest):
+    event_loop = False
+
+class UnoGameTest(unittest.TestCase):
+    #DECK_CODES is made from the card tables, it has to be the same cards as an UnoDeck
+    def test_deck_codes(self):
+        self.assertEqual(list(uno.DECK_CODES), sorted(uno.card_to_code(card) for card in uno.UnoDeck().cards))
+
+    #MAX_ROOM_PLAYERS hands of HAND_SIZE and the first current card come out of one deck
+    def test_max_room_players_can_start(self):
+        for compact in (False, True):
+            g = uno.UnoGame(MAX_ROOM_PLAYERS, compact=compact)
+            g.start()
+            self.assertEqual([len(hand) for hand in g.player_hands], [uno.HAND_SIZE]*MAX_ROOM_PLAYERS)
+
+    #the hand's index (UnoHand) gives the same moves as checking every card with valid_move, at every turn of seeded random
+    #games: stacked +2/+4 chains, and hands the index is updated on (draws, plays) rather than built from scratch
+    def test_legal_moves_match_valid_move(self):
+        rng = random.Random(7)
+        stacked = 0
+        for i in range(60):
+            random.seed(i)
+            game = uno.UnoGame(4, compact=i % 2 == 0)
+            game.start()
+            for turn in range(500):
+                if game.winner is not None:
+                    break
+                hand = game.player_hands[game.turn]
+                legal = game.legal_moves()
+                self.assertEqual(legal[-1], uno.DRAW_MOVE)
+                self.assertEqual(legal[:-1], [index for index in range(len(hand)) if game.valid_move(index)])
+                stacked += len(game.stack) > 1
+                game.play_card(rng.choice(legal), other_info=rng.choice(uno.CARD_COLORS))
+        #the games did chain +2/+4s
+        self.assertGreater(stacked, 0)
+
+    def test_player_view_has_no_deck(self):
+        self.assertIsNone(uno.UnoPlayerView(4, 1).deck)
+
+#StateSync (server) -> DELTA_SERIALIZER -> ClientSync (client) for seat 0 of seeded games. Each update can be lost, arrive
+#without its ack getting back, or arrive and be acked. Stretches with no acks make the server fall back to a snapshot,
+#and the client sometimes loses its states (reconnect) so the next delta's base is missing and it has to ask for a resync
+class DeltaSyncTest(unittest.TestCase):
+    def setUp(self):
+        uno.UnoGame.verbose = False
+
+    def test_round_trip(self):
+        seen = {'lost': 0, 'unacked': 0, 'fallback': 0, 'resync': 0}
+        for seed in range(20):
+            random.seed(seed)
+            rng = random.Random(seed)
+            game = uno.UnoGame(3, compact=True)
+            game.start()
+            server = StateSync()
+            server.max_unacked = 8
+            client = ClientSync()
+            resync = True
+            no_acks = 0
+            for turn in range(300):
+                if game.winner is not None:
+                    break
+                state = game.get_sync_state(0)
+                #a snapshot while the client has acked something: only once too many versions went unacked
+                acked, unacked = server.acked, len(server.sent)
+                delta = server.next_delta(state, snapshot=resync)
+                if not resync and acked is not None and delta['base'] == -1:
+                    self.assertGreater(unacked, server.max_unacked)
+                    seen['fallback'] += 1
+                resync = False
+                if no_acks == 0 and rng.random() < 0.05:
+                    no_acks = 12
+                fate = rng.random()
+                if fate < 0.2:
+                    seen['lost'] += 1
+                else:
+                    got = client.apply(DELTA_SERIALIZER.loads(DELTA_SERIALIZER.dumps(delta)))
+                    if got is None:
+                        self.assertNotIn(delta['base'], client.states)
+                        seen['resync'] += 1
+                        resync = True
+                    else:
+                        self.assertEqual(got, state, "seed {} version {}".format(seed, delta['version']))
+                        if no_acks > 0 or fate < 0.4:
+                            seen['unacked'] += 1
+                        else:
+                            server.ack(delta['version'])
+                no_acks = max(no_acks - 1, 0)
+                if rng.random() < 0.03:
+                    client = ClientSync()
+                game.play_card(rng.choice(game.legal_moves()), other_info=rng.choice(uno.CARD_COLORS))
+        for key, count in seen.items():
+            self.assertGreater(count, 0, key)
+
+#fcn to deal room's game and log it, like UnoServer.start_game
+def start_logged(room, move_log):
+    room.uno_game.start()
+    room.started = True
+    move_log.log_snapshot(room)
+
+#fcn to play n random legal moves in room and log them like UnoServer.play_move, returns (room.moves, snapshot) after each
+def play_logged(room, move_log, n, rng):
+    states = []
+    for i in range(n):
+        index = rng.choice(room.uno_game.legal_moves())
+        move = {'index': index, 'chosen_color': rng.choice(uno.CARD_COLORS)}
+        room.uno_game.play_card(index, other_info=move['chosen_color'])
+        room.moves += 1
+        move_log.log_move(room, move)
+        states.append(room_state(room))
+    return states
+
+def room_state(room):
+    return room.moves, room.uno_game.get_snapshot()
+
+#fcn to get what a MoveLog on path brings back: room_id -> (moves, snapshot)
+def recovered(path):
+    move_log = MoveLog(path)
+    rooms = {room.room_id: room_state(room) for room in move_log.restore_rooms()}
+    move_log.close()
+    return rooms
+
+#fcn to copy the files of a running move_log to copy_path, what a crash would leave on disk, then close move_log
+#(close() checkpoints, which would leave nothing to replay)
+def crashed_copy(move_log, copy_path):
+    #writer syncs every sync_interval
+    time.sleep(0.3)
+    shutil.copyfile(move_log.log_path, copy_path + '.log')
+    if os.path.exists(move_log.snap_path):
+        shutil.copyfile(move_log.snap_path, copy_path + '.snap')
+    move_log.close()
+
+#runs in its own process: a server with a move log, clients playing in 2 rooms, then the process dies without any cleanup
+#the rooms' (moves, snapshot) from just before are pickled to expected_path
+def play_and_crash(path, port, expected_path):
+    uno.UnoGame.verbose = False
+    server = UnoServer(8, '127.0.0.1', port, num_players=2, move_log=MoveLog(path, snapshot_every=8, checkpoint_size=512))
+    server.run()
+    time.sleep(0.1)
+    async def play(seed):
+        rng = random.Random(seed)
+        client = AsyncUnoClient('127.0.0.1', port)
+        await client.connect()
+        await client.init_uno()
+        await client.wait_for(lambda: client.last_uno_update > 0, 10)
+        #less than uno.HAND_SIZE moves can't empty a hand, no game ends (a finished game's room is closed)
+        for i in range(uno.HAND_SIZE - 1):
+            if not await client.wait_for_turn(3) or client.uno_game.winner is not None:
+                break
+            await client.send_move(rng.choice(client.uno_game.legal_moves()), rng.choice(uno.CARD_COLORS))
+    #the clients stay connected until the process dies, leaving would close the rooms
+    async def play_all():
+        await asyncio.gather(*[play(seed) for seed in range(4)])
+        #writer syncs every sync_interval
+        await asyncio.sleep(0.5)
+        with open(expected_path, 'wb') as f:
+            pickle.dump({room.room_id: room_state(room) for room in server.rooms.rooms.values() if room.started}, f)
+        os._exit(0)
+    asyncio.run(play_all())
+
+class MoveLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'game')
+        uno.UnoGame.verbose = False
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    #each room comes back from its last snapshot + the moves logged after it
+    def test_snapshot_and_tail_replay(self):
+        move_log = MoveLog(self.path, snapshot_every=8)
+        rooms = [UnoRoom(room_id, 3) for room_id in range(2)]
+        rng = random.Random(1)
+        for room in rooms:
+            start_logged(room, move_log)
+        for room in rooms:
+            play_logged(room, move_log, 21, rng)
+        move_log.close()
+        move_log = MoveLog(self.path)
+        #snapshots at moves 0, 8, 16: replaying 21 starts from the one at 16
+        self.assertEqual([len(move_log.rooms[room.room_id]) for room in rooms], [1 + 21 - 16]*2)
+        restored = {room.room_id: room_state(room) for room in move_log.restore_rooms()}
+        move_log.close()
+        self.assertEqual(restored, {room.room_id: room_state(room) for room in rooms})
+
+    #a record cut short by a crash is dropped and cut off the log, new records go after the last whole one
+    def test_torn_last_record(self):
+        move_log = MoveLog(self.path)
+        room = UnoRoom(0, 2)
+        start_logged(room, move_log)
+        play_logged(room, move_log, 5, random.Random(2))
+        crashed = self.path + '.crashed'
+        crashed_copy(move_log, crashed)
+        size = os.path.getsize(crashed + '.log')
+        with open(crashed + '.log', 'ab') as f:
+            f.write(MoveLog.record_head.pack(100, 0, MOVE_RECORD, 0, 6) + b'\x01\x02')
+        move_log = MoveLog(crashed)
+        self.assertEqual(os.path.getsize(crashed + '.log'), size)
+        self.assertEqual({room.room_id: room_state(room) for room in move_log.restore_rooms()}, {0: room_state(room)})
+        move_log.close()
+
+    #a record whose crc doesn't match ends the log there: the game goes back to just before it
+    def test_crc_rejects_record(self):
+        move_log = MoveLog(self.path, snapshot_every=100)
+        room = UnoRoom(0, 2)
+        start_logged(room, move_log)
+        states = play_logged(room, move_log, 5, random.Random(3))
+        crashed = self.path + '.crashed'
+        crashed_copy(move_log, crashed)
+        with open(crashed + '.log', 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+        self.assertEqual(recovered(crashed), {0: states[-2]})
+
+    #past checkpoint_size the log is rolled into path.snap, recovery reads the snap file and the log written after it
+    def test_checkpoint_rotation(self):
+        move_log = MoveLog(self.path, snapshot_every=8, checkpoint_size=2048)
+        rooms = [UnoRoom(room_id, 2) for room_id in range(3)]
+        rng = random.Random(4)
+        for room in rooms:
+            start_logged(room, move_log)
+        for i in range(10):
+            for room in rooms:
+                play_logged(room, move_log, 3, rng)
+            time.sleep(0.06)
+        #a closed room isn't in the next snap file
+        move_log.log_close(rooms[2].room_id)
+        crashed = self.path + '.crashed'
+        crashed_copy(move_log, crashed)
+        self.assertTrue(os.path.exists(crashed + '.snap'))
+        self.assertLess(os.path.getsize(crashed + '.log'), 2048 + 512)
+        self.assertEqual(recovered(crashed), {room.room_id: room_state(room) for room in rooms[:2]})
+
+    #kill a server mid-game, start one from its log: the rooms are where the games were
+    def test_server_restart_after_kill(self):
+        port = server_port()
+        expected_path = os.path.join(self.dir.name, 'expected.pkl')
+        process = multiprocessing.get_context('spawn').Process(target=play_and_crash, args=(self.path, port, expected_path))
+        process.start()
+        process.join(60)
+        with open(expected_path, 'rb') as f:
+            expected = pickle.load(f)
+        self.assertEqual(len(expected), 2)
+        self.assertTrue(os.path.exists(self.path + '.snap'))
+        server = UnoServer(8, '127.0.0.1', port, num_players=2, move_log=self.path)
+        try:
+            self.assertEqual({room_id: room_state(server.rooms.get(room_id)) for room_id in expected}, expected)
+        finally:
+            server.end()
+
+#fcn to make a UnoGame in the state of game g of a UnoSim: hands, current card, stack, turn, deck left to draw
+def sim_to_game(sim, g):
+    game = uno.UnoGame(sim.num_players, compact=True)
+    game.player_hands = [uno.UnoHand(uno.CARDS[code] for code in np.repeat(np.arange(uno_sim.HAND_CODES), sim.counts[g, player]))
+                         for player in range(sim.num_players)]
+    game.current_card = uno.CARDS[sim.current[g]]
+    #only the sum and the last +x of the stack matter
+    game.stack = [int(plus) for plus in (sim.stack_sum[g] - sim.stack_top[g], sim.stack_top[g]) if plus > 0]
+    game.turn = int(sim.turn[g])
+    game.turn_dir = int(sim.turn_dir[g])
+    game.deck.cards = array('B', sim.deck[g, sim.top[g]:sim.deck_size[g]].tolist())
+    game.deck.top = 0
+    game.deck.discard_pile = array('B', sim.discard[g, :sim.discard_size[g]].tolist())
+    return game
+
+#codes of a hand, to compare hands without their order
+def hand_codes(hand):
+    return sorted(uno.card_to_code(card) for card in hand)
+
+#UnoSim plays by UnoGame's rules: at every turn the legal cards are the same, and the move leaves both games in the same state
+@unittest.skipIf(uno_sim is None, "needs numpy")
+class UnoSimTest(unittest.TestCase):
+    def test_sim_matches_uno_game(self):
+        sim = uno_sim.UnoSim(40, 4, seed=3)
+        games = np.flatnonzero(sim.winner == -1)
+        turns = 0
+        while len(games) > 0 and turns < 400:
+            hands = sim.hands(games)
+            mask = sim.legal_mask(games, hands)
+            codes, colors = uno_sim.random_policy(sim, games, mask, hands)
+            reference = {}
+            for i, g in enumerate(games):
+                game = sim_to_game(sim, g)
+                hand = game.player_hands[game.turn]
+                legal = game.legal_moves()
+                self.assertEqual(sorted({uno.card_to_code(hand[index]) for index in legal[:-1]}), np.flatnonzero(mask[i]).tolist())
+                if codes[i] < 0:
+                    #a draw the sim's deck can't cover is reshuffled with a different rng, only the hand sizes can match
+                    same_cards = len(game.deck) >= max(1, sum(game.stack))
+                    game.play_card(uno.DRAW_MOVE)
+                else:
+                    same_cards = True
+                    index = [uno.card_to_code(card) for card in hand].index(codes[i])
+                    game.play_card(index, other_info=uno.CARD_COLORS[colors[i]])
+                reference[g] = (game, same_cards)
+            sim.step(games, codes, colors)
+            for g, (game, same_cards) in reference.items():
+                self.assertEqual(-1 if game.winner is None else game.winner, sim.winner[g])
+                if game.winner is None:
+                    self.assertEqual((game.turn, game.turn_dir, sum(game.stack)), (sim.turn[g], sim.turn_dir[g], sim.stack_sum[g]))
+                    self.assertEqual(uno.card_to_code(game.current_card), sim.current[g])
+                for player, hand in enumerate(game.player_hands):
+                    self.assertEqual(len(hand), sim.hand_size[g, player])
+                    if same_cards:
+                        self.assertEqual(hand_codes(hand), np.repeat(np.arange(uno_sim.HAND_CODES), sim.counts[g, player]).tolist())
+            games = games[sim.winner[games] == -1]
+            turns += 1
+        self.assertEqual(len(games), 0)
+
+    #weights past 127 (a hand grown by long +2/+4 chains) still pick a card that is in the hand
+    def test_random_policy_big_hands(self):
+        sim = uno_sim.UnoSim(1, 2, seed=0)
+        hands = np.zeros((1, uno_sim.HAND_CODES), dtype=np.int8)
+        hands[0, :] = 4
+        mask = np.ones((1, uno_sim.HAND_CODES), dtype=bool)
+        for i in range(200):
+            codes, colors = uno_sim.random_policy(sim, np.arange(1), mask, hands)
+            self.assertTrue(0 <= codes[0] < uno_sim.HAND_CODES)
+
+if __name__ == "__main__":
+    unittest.main()